@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from cache_sim import (L1_HIT_TIME, L2_HIT_TIME, MISS_PENALTY, TraceReader, WriteBackCache, WriteThroughCache,
+                       load_trace, run_trace)
+
+BENCH_ACCESSES = 200000
+BENCH_SEED = 529
+BENCH_CACHE_SIZES = [1024, 16384, 65536]
+BENCH_BLOCK_SIZE = 32
+BENCH_ASSOCIATIVITY = 2
+# fraction of a baseline's accesses/s a benchmark may lose before it counts as a regression
+DEFAULT_THRESHOLD = 0.2
+
+
+# Synthetic traces. Every generator returns (access types uint8, addresses uint64) arrays
+# with 0 read, 1 write, 2 instruction fetch, and the same seed gives the same trace.
+
+def _data_types(rng, num_accesses, write_fraction=0.3):
+    return (rng.random(num_accesses) < write_fraction).astype(np.uint8)
+
+
+def sequential_trace(num_accesses, seed=BENCH_SEED, word_size=4):
+    # data accesses walking through memory one word after the other
+    rng = np.random.default_rng(seed)
+    addresses = np.arange(num_accesses, dtype=np.uint64) * np.uint64(word_size) + np.uint64(0x10000000)
+    return _data_types(rng, num_accesses), addresses
+
+
+def strided_trace(num_accesses, seed=BENCH_SEED, stride=256, span=1 << 20):
+    # data accesses at a fixed stride, wrapping around a span of memory
+    rng = np.random.default_rng(seed)
+    addresses = (np.arange(num_accesses, dtype=np.uint64) * np.uint64(stride)) % np.uint64(span)
+    return _data_types(rng, num_accesses), addresses + np.uint64(0x10000000)
+
+
+def uniform_trace(num_accesses, seed=BENCH_SEED, span=1 << 24):
+    # data accesses spread uniformly over a span of memory
+    rng = np.random.default_rng(seed)
+    addresses = rng.integers(0, span, num_accesses, dtype=np.uint64) & ~np.uint64(3)
+    return _data_types(rng, num_accesses), addresses
+
+
+def zipf_trace(num_accesses, seed=BENCH_SEED, num_blocks=8192, alpha=1.1, block_size=64):
+    # data accesses to a working set of blocks whose popularity follows a Zipf law
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, num_blocks + 1) ** alpha
+    ranks = rng.choice(num_blocks, num_accesses, p=weights / weights.sum())
+    # scatter the popular blocks over the address space instead of packing them together
+    blocks = rng.permutation(num_blocks * 16)[:num_blocks].astype(np.uint64)
+    offsets = rng.integers(0, block_size, num_accesses, dtype=np.uint64) & ~np.uint64(3)
+    addresses = blocks[ranks] * np.uint64(block_size) + offsets
+    return _data_types(rng, num_accesses), addresses
+
+
+def mixed_trace(num_accesses, seed=BENCH_SEED, instruction_fraction=0.5, branch_probability=0.1):
+    # interleaved instruction fetches (straight-line code with random branches) and
+    # Zipf-distributed data accesses
+    rng = np.random.default_rng(seed)
+    is_instruction = rng.random(num_accesses) < instruction_fraction
+    num_instructions = int(is_instruction.sum())
+    # the program counter starts over at a random target on every branch
+    branches = rng.random(num_instructions) < branch_probability
+    branches[:1] = True
+    segment = np.cumsum(branches) - 1
+    targets = rng.integers(0, 1 << 14, int(branches.sum()))
+    steps = np.arange(num_instructions) - np.flatnonzero(branches)[segment]
+    pcs = (targets[segment] + steps).astype(np.uint64) * np.uint64(4) + np.uint64(0x400000)
+
+    data_types, data_addresses = zipf_trace(num_accesses - num_instructions, seed + 1)
+    access_types = np.empty(num_accesses, dtype=np.uint8)
+    addresses = np.empty(num_accesses, dtype=np.uint64)
+    access_types[is_instruction] = 2
+    addresses[is_instruction] = pcs
+    access_types[~is_instruction] = data_types
+    addresses[~is_instruction] = data_addresses
+    return access_types, addresses
+
+
+GENERATORS = {
+    "sequential": sequential_trace,
+    "strided": strided_trace,
+    "uniform": uniform_trace,
+    "zipf": zipf_trace,
+    "mixed": mixed_trace,
+}
+
+
+def write_trace(trace_file_path, access_types, addresses):
+    # the "<type> <hex address>" text format main() reads
+    with open(trace_file_path, "w") as file:
+        for memory_access_type, address in zip(access_types.tolist(), addresses.tolist()):
+            file.write(f"{memory_access_type} {address:x}\n")
+
+
+def generate_traces(directory, num_accesses=BENCH_ACCESSES, seed=BENCH_SEED, names=None):
+    # writes one trace per generator (all of them by default), returns {generator name: path}
+    paths = {}
+    for name in names or GENERATORS:
+        generator = GENERATORS[name]
+        path = os.path.join(directory, f"{name}-{num_accesses}-{seed}.trace")
+        if not os.path.exists(path):
+            write_trace(path, *generator(num_accesses, seed))
+        paths[name] = path
+    return paths
+
+
+# Benchmarks. Each one builds its caches, runs them over a trace and returns the number
+# of accesses simulated.
+
+def bench_ingest(trace_file_path, cache_size):
+    return sum(len(access_types) for access_types, _ in TraceReader(trace_file_path))
+
+
+def bench_write_through(trace, cache_size):
+    l1d_cache = WriteThroughCache(cache_size, BENCH_BLOCK_SIZE, BENCH_ASSOCIATIVITY, L1_HIT_TIME, MISS_PENALTY, None)
+    l1i_cache = WriteThroughCache(cache_size, BENCH_BLOCK_SIZE, BENCH_ASSOCIATIVITY, L1_HIT_TIME, MISS_PENALTY, None)
+    run_trace(l1d_cache, l1i_cache, trace, None)
+    return len(trace)
+
+
+def bench_write_back(trace, cache_size):
+    l1d_cache = WriteBackCache(cache_size, BENCH_BLOCK_SIZE, BENCH_ASSOCIATIVITY, L1_HIT_TIME, MISS_PENALTY, None)
+    l1i_cache = WriteBackCache(cache_size, BENCH_BLOCK_SIZE, BENCH_ASSOCIATIVITY, L1_HIT_TIME, MISS_PENALTY, None)
+    run_trace(l1d_cache, l1i_cache, trace, None)
+    return len(trace)
+
+
+def bench_l1_l2(trace, cache_size):
+    # L2 sixteen times the size of the L1, as in the Part 5 configuration
+    l2_cache = WriteBackCache(cache_size * 16, 128, 8, L2_HIT_TIME, MISS_PENALTY, None)
+    l1d_cache = WriteBackCache(cache_size, BENCH_BLOCK_SIZE, BENCH_ASSOCIATIVITY, L1_HIT_TIME, MISS_PENALTY, l2_cache)
+    l1i_cache = WriteBackCache(cache_size, BENCH_BLOCK_SIZE, BENCH_ASSOCIATIVITY, L1_HIT_TIME, MISS_PENALTY, l2_cache)
+    run_trace(l1d_cache, l1i_cache, trace, l2_cache)
+    return len(trace)
+
+
+# name: (function, takes the trace path instead of the loaded trace, cache sizes)
+BENCHMARKS = {
+    "ingest": (bench_ingest, True, [None]),
+    "write-through": (bench_write_through, False, BENCH_CACHE_SIZES),
+    "write-back": (bench_write_back, False, BENCH_CACHE_SIZES),
+    "l1-l2": (bench_l1_l2, False, BENCH_CACHE_SIZES),
+}
+
+
+def measure(function, *args, repeat=3):
+    # best wall time of `repeat` runs, then one more run under tracemalloc for the peak
+    # memory allocated while it ran (tracemalloc slows the run down, so it is not timed)
+    seconds = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        accesses = function(*args)
+        elapsed = time.perf_counter() - started
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "accesses": accesses,
+        "seconds": seconds,
+        "accesses_per_second": accesses / seconds if seconds else 0,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def run_benchmarks(trace_paths, benchmarks=None, repeat=3):
+    # returns {"<benchmark>/<trace>[/<cache size>]": measurement}
+    results = {}
+    for trace_name, path in trace_paths.items():
+        trace = load_trace(path, use_sidecar=False)
+        for bench_name in benchmarks or BENCHMARKS:
+            function, takes_path, cache_sizes = BENCHMARKS[bench_name]
+            for cache_size in cache_sizes:
+                name = f"{bench_name}/{trace_name}" + (f"/{cache_size}" if cache_size else "")
+                results[name] = measure(function, path if takes_path else trace, cache_size, repeat=repeat)
+                print(f"{name}: {results[name]['accesses_per_second']:,.0f} accesses/s", file=sys.stderr)
+        trace.close()
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold=DEFAULT_THRESHOLD):
+    # returns [(name, baseline accesses/s, current accesses/s)] for every benchmark that lost
+    # more than `threshold` of its baseline throughput; benchmarks missing on either side are skipped
+    regressions = []
+    for name, measurement in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]["accesses_per_second"]
+        if measurement["accesses_per_second"] < expected * (1 - threshold):
+            regressions.append((name, expected, measurement["accesses_per_second"]))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print("|" + ('-' * 32 + "|") + ('-' * 16 + "|")*4)
+    print(f'|{"Benchmark":32}|{"Accesses/s":16}|{"Baseline":16}|{"Change":16}|{"Peak memory":16}|')
+    print("|" + ('-' * 32 + "|") + ('-' * 16 + "|")*4)
+    for name, measurement in results.items():
+        rate = measurement["accesses_per_second"]
+        if baseline and name in baseline:
+            expected = baseline[name]["accesses_per_second"]
+            change = f"{(rate / expected - 1) * 100:+15.1f}%"
+            expected = f"{expected:16,.0f}"
+        else:
+            expected = change = f"{'-':>16}"
+        peak_memory = f"{measurement['peak_memory_bytes'] / 1024:13,.0f} KB"
+        print(f"|{name:32}|{rate:16,.0f}|{expected}|{change}|{peak_memory}|")
+    print("|" + ('-' * 32 + "|") + ('-' * 16 + "|")*4)
+
+
+def load_baseline(baseline_path):
+    with open(baseline_path) as file:
+        return json.load(file)["results"]
+
+
+def save_baseline(baseline_path, results, num_accesses, seed):
+    with open(baseline_path, "w") as file:
+        json.dump({"accesses": num_accesses, "seed": seed, "results": results}, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cache simulator throughput on synthetic traces.")
+    parser.add_argument("--accesses", type=int, default=BENCH_ACCESSES, help="accesses per synthetic trace")
+    parser.add_argument("--seed", type=int, default=BENCH_SEED)
+    parser.add_argument("--traces", nargs="+", choices=list(GENERATORS), help="generators to run (default: all)")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark, the best one counts")
+    parser.add_argument("--trace-dir", help="keep the generated traces here (default: a temporary directory)")
+    parser.add_argument("--baseline", help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed throughput loss against the baseline, as a fraction")
+    parser.add_argument("--save-baseline", help="write the results to this baseline JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        trace_dir = args.trace_dir or scratch_dir
+        os.makedirs(trace_dir, exist_ok=True)
+        trace_paths = generate_traces(trace_dir, args.accesses, args.seed, args.traces)
+        results = run_benchmarks(trace_paths, args.benchmarks, args.repeat)
+
+    baseline = load_baseline(args.baseline) if args.baseline else None
+    print_results(results, baseline)
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results, args.accesses, args.seed)
+    if baseline:
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        for name, expected, rate in regressions:
+            print(f"Regression: {name} {rate:,.0f} accesses/s, baseline {expected:,.0f} "
+                  f"(more than {args.threshold:.0%} slower)", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,240 @@
+import argparse
+import bisect
+import contextlib
+import csv
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import lzma
+import math
+import mmap
 import os
-import matplotlib.pyplot as plt
+import random
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+import numpy as np
+
+# Sidecar layout: magic, source size, source mtime (ns), access count, content digest,
+# then the access-type bytes padded to 8 bytes and the uint64 addresses (native byte order).
+TRACE_MAGIC = b"CSTRACE2"
+TRACE_HEADER = struct.Struct("<8sQQQ16s")
+TRACE_SUFFIX = ".bin"
+TRACE_BATCH_SIZE = 1 << 16
+# Cache checkpoints (save_checkpoint): format tag, default accesses between checkpoints
+CHECKPOINT_FORMAT = "cache_sim checkpoint 3"
+CHECKPOINT_INTERVAL = 1 << 20
+# Bytes one write access stores; the traces carry no access size
+WRITE_SIZE_BYTES = 4
+
+class LRUReplacement:
+    # Least recently used way. Each set's lines are kept in a dict in recency order,
+    # least recent first, so a reference moves its line to the end and the victim is
+    # the first line, both O(1) whatever the associativity.
+    # Replacement policies keep their state in flat per-line arrays (line = set_index *
+    # set_size + way) or per-set structures. insert() is called when a block is placed in
+    # a line, touch() when a cached block is referenced again, victim(start) picks a line
+    # of the full set starting at `start` and invalidate() frees a line.
+    def __init__(self, num_sets, set_size):
+        self.set_size = set_size
+        # free lines stay in the order too; victim() is only asked for full sets
+        self._set_orders([dict.fromkeys(range(start, start + set_size))
+                          for start in range(0, num_sets * set_size, set_size)])
+
+    def _set_orders(self, orders):
+        self.orders = orders
+        # the order of each line's set, indexed by line
+        self.line_orders = [order for order in orders for _ in range(self.set_size)]
+
+    def touch(self, line):
+        order = self.line_orders[line]
+        order[line] = order.pop(line)
+
+    insert = touch
+
+    def victim(self, start):
+        return next(iter(self.orders[start // self.set_size]))
+
+    def invalidate(self, line):
+        pass
+
+    def state(self):
+        # arrays for a checkpoint; load_state() takes them back
+        return {"order": np.array([line for order in self.orders for line in order], dtype=np.int64)}
+
+    def load_state(self, state):
+        lines = state["order"].tolist()
+        set_size = self.set_size
+        self._set_orders([dict.fromkeys(lines[start:start + set_size]) for start in range(0, len(lines), set_size)])
+
+
+
+class FIFOReplacement(LRUReplacement):
+    # Evicts the way filled longest ago; hits do not change the order
+    def touch(self, line):
+        pass
+
+    def insert(self, line):
+        order = self.line_orders[line]
+        order[line] = order.pop(line)
+
+
+class RandomReplacement:
+    # Evicts a uniformly random way, reproducibly for a given seed
+    def __init__(self, num_sets, set_size, seed=0):
+        self.set_size = set_size
+        self.random = random.Random(seed)
+
+    def touch(self, line):
+        pass
+
+    insert = touch
+    invalidate = touch
+
+    def victim(self, start):
+        return start + self.random.randrange(self.set_size)
+
+    def state(self):
+        return {"random": np.array(self.random.getstate()[1], dtype=np.uint64)}
+
+    def load_state(self, state):
+        version, _, gauss_next = self.random.getstate()
+        self.random.setstate((version, tuple(state["random"].tolist()), gauss_next))
+
+
+class TreePLRUReplacement:
+    # Tree pseudo-LRU: set_size - 1 bits per set, each pointing at the half of its subtree
+    # to evict from next. A reference flips the bits on its path to point away from it.
+    def __init__(self, num_sets, set_size):
+        if set_size & (set_size - 1):
+            raise ValueError(f"Tree-PLRU needs a power-of-two associativity, not {set_size}")
+        self.set_size = set_size
+        self.nodes = max(set_size - 1, 1)
+        self.bits = bytearray(num_sets * self.nodes)
+        # per way: the (node, bit) pairs a reference to it sets, root first; nodes are
+        # numbered from 1 like a binary heap and stored at node - 1
+        self.paths = []
+        for way in range(set_size):
+            path = []
+            node = way + set_size
+            while node > 1:
+                path.append((node // 2 - 1, 1 - (node & 1)))
+                node //= 2
+            self.paths.append(path[::-1])
+
+    def touch(self, line):
+        set_index, way = divmod(line, self.set_size)
+        base = set_index * self.nodes
+        bits = self.bits
+        for node, bit in self.paths[way]:
+            bits[base + node] = bit
+
+    insert = touch
+
+    def victim(self, start):
+        base = start // self.set_size * self.nodes
+        bits = self.bits
+        node = 1
+        while node < self.set_size:
+            node = 2 * node + bits[base + node - 1]
+        return start + node - self.set_size
+
+    def invalidate(self, line):
+        pass
+
+    def state(self):
+        return {"bits": np.frombuffer(self.bits, dtype=np.uint8).copy()}
+
+    def load_state(self, state):
+        self.bits = bytearray(state["bits"].tobytes())
+
+
+class SRRIPReplacement:
+    # Static re-reference interval prediction: an M-bit RRPV per line. Blocks are inserted
+    # with a long re-reference interval (max - 1), a hit resets it to 0, and the victim is
+    # the first way at max, after ageing the whole set until one gets there.
+    def __init__(self, num_sets, set_size, rrpv_bits=2):
+        self.set_size = set_size
+        self.max_rrpv = (1 << rrpv_bits) - 1
+        self.rrpv = bytearray([self.max_rrpv]) * (num_sets * set_size)
+
+    def touch(self, line):
+        self.rrpv[line] = 0
+
+    def insert(self, line):
+        self.rrpv[line] = self.max_rrpv - 1
+
+    def victim(self, start):
+        rrpv = self.rrpv
+        end = start + self.set_size
+        age = self.max_rrpv - max(rrpv[start:end])
+        if age:
+            for line in range(start, end):
+                rrpv[line] += age
+        return rrpv.index(self.max_rrpv, start, end)
+
+    def invalidate(self, line):
+        self.rrpv[line] = self.max_rrpv
+
+    def state(self):
+        return {"rrpv": np.frombuffer(self.rrpv, dtype=np.uint8).copy()}
+
+    def load_state(self, state):
+        self.rrpv = bytearray(state["rrpv"].tobytes())
+
+
+class BRRIPReplacement(SRRIPReplacement):
+    # Bimodal RRIP: inserts at the distant interval (max) except for one fill in every
+    # `long_interval` (max - 1), so a scan larger than the cache cannot flush it
+    def __init__(self, num_sets, set_size, rrpv_bits=2, long_interval=32):
+        super().__init__(num_sets, set_size, rrpv_bits)
+        self.long_interval = long_interval
+        self.fills = 0
+
+    def insert(self, line):
+        self.fills += 1
+        if self.fills % self.long_interval:
+            self.rrpv[line] = self.max_rrpv
+        else:
+            self.rrpv[line] = self.max_rrpv - 1
+
+    def state(self):
+        return {**super().state(), "fills": np.array(self.fills)}
+
+    def load_state(self, state):
+        super().load_state(state)
+        self.fills = int(state["fills"])
+
+
+REPLACEMENT_POLICIES = {
+    "lru": LRUReplacement,
+    "plru": TreePLRUReplacement,
+    "srrip": SRRIPReplacement,
+    "brrip": BRRIPReplacement,
+    "fifo": FIFOReplacement,
+    "random": RandomReplacement,
+}
+
+
+def make_replacement(replacement_policy, num_sets, set_size):
+    # replacement_policy: a REPLACEMENT_POLICIES name, or a callable taking
+    # (num_sets, set_size), e.g. functools.partial(RandomReplacement, seed=7)
+    if isinstance(replacement_policy, str):
+        if replacement_policy not in REPLACEMENT_POLICIES:
+            raise ValueError(f"Unknown replacement policy: {replacement_policy}")
+        replacement_policy = REPLACEMENT_POLICIES[replacement_policy]
+    return replacement_policy(num_sets, set_size)
+
 
 class CacheBase:
-    def __init__(self, total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache):
+    def __init__(self, total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache,
+                 replacement_policy="lru"):
         self.total_size_bytes = total_size_bytes
         self.block_size_bytes = block_size_bytes
         self.set_associativity = set_associativity
@@ -12,15 +244,24 @@ class CacheBase:
         self.num_sets = total_size_bytes // (block_size_bytes * set_associativity)
         self.set_size = set_associativity
 
-        self.cache = [[] for _ in range(self.num_sets)]
-        self.valid_bits = [[False] * self.set_size for _ in range(self.num_sets)]
-        self.lru_counters = [[0] * self.set_size for _ in range(self.num_sets)]
+        # Per-line state in flat arrays, line = set_index * set_size + way
+        num_lines = self.num_sets * self.set_size
+        self.tags = [-1] * num_lines  # block address held by the line, -1 when empty
+        self.dirty = bytearray(num_lines)
+        self.replacement_policy = replacement_policy
+        self.replacement = make_replacement(replacement_policy, self.num_sets, self.set_size)
+        # Per set: block address -> line, for O(1) hit lookup
+        self.cache = [{} for _ in range(self.num_sets)]
 
         # Additional attributes to track cache statistics
         self.access_hits = 0
         self.access_misses = 0
         self.access_total = 0
         self.access_hit_rate = 0  # Added attribute for instruction hit rate
+        # Traffic with the next level (memory for the last one): blocks fetched, and
+        # written back or written through
+        self.bytes_from_next_level = 0
+        self.bytes_to_next_level = 0
 
         # Next level cache (L2 and up)
         self.next_cache = next_cache
@@ -35,6 +276,93 @@ class CacheBase:
         block_addr = address // self.block_size_bytes
         return set_index, block_addr
 
+    def _allocate(self, set_index, block_addr):
+        # Place block_addr in a free way of its set, or in the replacement policy's victim.
+        # Returns the line and the evicted block address (-1 if none) and dirty flag.
+        lines = self.cache[set_index]
+        set_size = self.set_size
+        tags = self.tags
+        replacement = self.replacement
+        start = set_index * set_size
+        if len(lines) < set_size:
+            line = tags.index(-1, start, start + set_size)
+            evicted_addr = -1
+            evicted_dirty = False
+        else:
+            # a direct-mapped set has nothing to choose from
+            line = replacement.victim(start) if set_size > 1 else start
+            evicted_addr = tags[line]
+            evicted_dirty = self.dirty[line] == 1
+            del lines[evicted_addr]
+        tags[line] = block_addr
+        self.dirty[line] = 0
+        lines[block_addr] = line
+        replacement.insert(line)
+        return line, evicted_addr, evicted_dirty
+
+    def _fetch(self, address, set_index, block_addr, next_level_cache):
+        # Bring a missing block in from the next level (memory when there is none)
+        if next_level_cache is not None:
+            next_level_cache.read_from_cache(address, next_level_cache.next_cache)
+        self.bytes_from_next_level += self.block_size_bytes
+        return self._allocate(set_index, block_addr)
+
+    def _send_write(self, address, size_bytes, next_level_cache):
+        # Write size_bytes at address to the next level (memory when there is none)
+        if next_level_cache is not None:
+            next_level_cache.write_to_cache(address, write_flag=True, next_level_cache=next_level_cache.next_cache,
+                                            size_bytes=size_bytes)
+        self.bytes_to_next_level += size_bytes
+
+    def _invalidate(self, set_index, block_addr):
+        # Drop block_addr from its set; returns whether the line was dirty (None if absent)
+        line = self.cache[set_index].pop(block_addr, None)
+        if line is None:
+            return None
+        was_dirty = self.dirty[line] == 1
+        self.tags[line] = -1
+        self.dirty[line] = 0
+        self.replacement.invalidate(line)
+        return was_dirty
+
+    def drain_write_buffer(self, next_level_cache):
+        # Called at the end of a run; only a WriteThroughCache buffers writes
+        pass
+
+    def _counters(self):
+        return [self.access_hits, self.access_misses, self.access_total,
+                self.bytes_from_next_level, self.bytes_to_next_level]
+
+    def _index_lines(self):
+        # rebuild the per-set block -> line dicts from tags
+        self.cache = [{} for _ in range(self.num_sets)]
+        for line, block_addr in enumerate(self.tags):
+            if block_addr != -1:
+                self.cache[line // self.set_size][block_addr] = line
+
+    def _checkpoint_kind(self):
+        # what a checkpoint must have been taken from to be loaded into this cache
+        return (f"{type(self).__name__} {type(self.replacement).__name__} {self.total_size_bytes} "
+                f"{self.block_size_bytes} {self.set_associativity}")
+
+    def _checkpoint_state(self):
+        state = {"kind": np.array(self._checkpoint_kind()),
+                 "counters": np.array(self._counters(), dtype=np.int64),
+                 "tags": np.array(self.tags, dtype=np.int64),
+                 "dirty": np.frombuffer(self.dirty, dtype=np.uint8).copy()}
+        for name, array in self.replacement.state().items():
+            state[f"replacement.{name}"] = array
+        return state
+
+    def _load_checkpoint_state(self, state):
+        (self.access_hits, self.access_misses, self.access_total,
+         self.bytes_from_next_level, self.bytes_to_next_level) = state["counters"].tolist()
+        self.tags = state["tags"].tolist()
+        self.dirty = bytearray(state["dirty"].tobytes())
+        self.replacement.load_state({name[len("replacement."):]: array for name, array in state.items()
+                                     if name.startswith("replacement.")})
+        self._index_lines()
+
     # def calculate_percentage(self, value, total=None):
     #     total = total or value
     #     if total == 0:
@@ -54,100 +382,938 @@ class CacheBase:
 
 
 class WriteThroughCache(CacheBase):
-    def __init__(self, total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache):
-        super().__init__(total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache)
+    # Every write is passed on to the next level (memory when there is none). Without a
+    # write buffer each write waits for that and counts as a miss. With
+    # write_buffer_entries > 0, writes go to a coalescing buffer of that many block-wide
+    # entries and only count as a miss when the buffer is full and its oldest entry has
+    # to drain first. A miss on a block with a pending entry drains that entry before
+    # fetching the block, and drain_write_buffer writes out what is left at the end of a
+    # run. write_allocate: a write miss also brings the block into the cache, unless the
+    # write covers the whole block and there is nothing to fetch.
+    def __init__(self, total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache,
+                 replacement_policy="lru", write_allocate=True, write_buffer_entries=0):
+        super().__init__(total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache,
+                         replacement_policy)
+        self.write_allocate = write_allocate
+        self.write_buffer_entries = write_buffer_entries
+        # block address -> bit mask of the words written to it, oldest entry first
+        self.write_buffer = {}
         # print(f"*******{self.access_hits}, {self.access_misses}")
 
-    def write_to_cache(self, address, write_flag, next_level_cache):
+    def write_to_cache(self, address, write_flag, next_level_cache, size_bytes=WRITE_SIZE_BYTES):
+        # find_set_and_block, inlined on the hot paths
+        block_addr = address // self.block_size_bytes
+        set_index = block_addr % self.num_sets
+        line = self.cache[set_index].get(block_addr)
+        if line is not None:
+            self.replacement.touch(line)
+        elif self.write_allocate:
+            if size_bytes < self.block_size_bytes:
+                if block_addr in self.write_buffer:
+                    self._drain_entry(block_addr, next_level_cache)
+                # _fetch, inlined
+                if next_level_cache is not None:
+                    next_level_cache.read_from_cache(address, next_level_cache.next_cache)
+                self.bytes_from_next_level += self.block_size_bytes
+                self._allocate(set_index, block_addr)
+            else:
+                # the write covers the whole block: nothing to fetch
+                self._allocate(set_index, block_addr)
+        self.access_total += 1
+        if not self.write_buffer_entries:
+            # no buffer: every write waits for the next level
+            if next_level_cache is not None:
+                next_level_cache.write_to_cache(address, True, next_level_cache.next_cache, size_bytes)
+            self.bytes_to_next_level += size_bytes
+            self.access_misses += 1
+        elif self._buffer_write(address, block_addr, size_bytes, next_level_cache):
+            self.access_hits += 1
+        else:
+            self.access_misses += 1
+
+    def read_from_cache(self, address, next_level_cache):
+        block_addr = address // self.block_size_bytes
+        set_index = block_addr % self.num_sets
+        line = self.cache[set_index].get(block_addr)
         self.access_total += 1
+        if line is not None:
+            self.access_hits += 1
+            self.replacement.touch(line)
+            return
         self.access_misses += 1
-        set_index, block_addr = self.find_set_and_block(address)
+        if block_addr in self.write_buffer:
+            # the next level gets the pending words before it serves the block
+            self._drain_entry(block_addr, next_level_cache)
+        # _fetch, inlined
+        if next_level_cache is not None:
+            next_level_cache.read_from_cache(address, next_level_cache.next_cache)
+        self.bytes_from_next_level += self.block_size_bytes
+        self._allocate(set_index, block_addr)
 
-        # in case address already in cache, remove from cache
-        if block_addr in self.cache[set_index]:
-            self.cache[set_index].remove(block_addr)
+    def _allocate(self, set_index, block_addr):
+        # CacheBase._allocate without the dirty bits, which stay clear in a write-through cache
+        lines = self.cache[set_index]
+        set_size = self.set_size
+        tags = self.tags
+        start = set_index * set_size
+        if len(lines) < set_size:
+            line = tags.index(-1, start, start + set_size)
+            evicted_addr = -1
+        else:
+            line = self.replacement.victim(start) if set_size > 1 else start
+            evicted_addr = tags[line]
+            del lines[evicted_addr]
+        tags[line] = block_addr
+        lines[block_addr] = line
+        self.replacement.insert(line)
+        return line, evicted_addr, False
 
-        # insert to front for most recent reference
-        self.cache[set_index].insert(0, block_addr)
-        if len(self.cache[set_index]) > self.set_size:
-            # pop from tail (least recently used item)
-            self.cache[set_index].pop()
-            self.access_total += 0
+    def drain_write_buffer(self, next_level_cache):
+        # Write out every pending entry, oldest first; their bytes were counted already
+        while self.write_buffer:
+            self._drain_entry(next(iter(self.write_buffer)), next_level_cache)
 
-    def read_from_cache(self, address, next_level_cache):
-        set_index, block_addr = self.find_set_and_block(address)
-        for block in self.cache[set_index]:
-            if block == block_addr:
-                self.access_hits += 1
-                self.access_total += 1
-                # Move matched address to front (most recent reference)
-                self.cache[set_index].remove(block_addr)
-                self.cache[set_index].insert(0, block_addr)
-                return
-        self.write_to_cache(address, False, None)
+    def _buffer_write(self, address, block_addr, size_bytes, next_level_cache):
+        # Returns whether the write was absorbed by the write buffer without waiting.
+        # Traffic is counted when a word enters the buffer: what the buffer will write.
+        # bit mask of the words written, one word at least
+        first_word = address % self.block_size_bytes // WRITE_SIZE_BYTES
+        word = ((1 << max(size_bytes // WRITE_SIZE_BYTES, 1)) - 1) << first_word
+        words = self.write_buffer.get(block_addr)
+        if words is not None:
+            # coalesced into the pending entry of the block
+            if word & ~words:
+                self.bytes_to_next_level += (word & ~words).bit_count() * WRITE_SIZE_BYTES
+                self.write_buffer[block_addr] = words | word
+            return True
+        stalled = len(self.write_buffer) >= self.write_buffer_entries
+        if stalled:
+            oldest = next(iter(self.write_buffer))
+            self._drain_entry(oldest, next_level_cache)
+        self.write_buffer[block_addr] = word
+        self.bytes_to_next_level += word.bit_count() * WRITE_SIZE_BYTES
+        return not stalled
+
+    def _drain_entry(self, block_addr, next_level_cache):
+        # Write the pending words of block_addr to the next level as one write
+        words = self.write_buffer.pop(block_addr)
+        if next_level_cache is not None:
+            next_level_cache.write_to_cache(block_addr * self.block_size_bytes, write_flag=True,
+                                            next_level_cache=next_level_cache.next_cache,
+                                            size_bytes=words.bit_count() * WRITE_SIZE_BYTES)
+
+    def _checkpoint_kind(self):
+        return (f"{super()._checkpoint_kind()} write_allocate={self.write_allocate} "
+                f"write_buffer_entries={self.write_buffer_entries}")
+
+    def _checkpoint_state(self):
+        state = super()._checkpoint_state()
+        state["write_buffer.blocks"] = np.array(list(self.write_buffer), dtype=np.int64)
+        # masks may be wider than 64 bits for large blocks: store them as word offsets
+        state["write_buffer.entries"], state["write_buffer.words"] = (
+            np.array([[i, word] for i, words in enumerate(self.write_buffer.values())
+                      for word in range(words.bit_length()) if words >> word & 1], dtype=np.int64)
+            .reshape(-1, 2).T)
+        return state
+
+    def _load_checkpoint_state(self, state):
+        super()._load_checkpoint_state(state)
+        blocks = state["write_buffer.blocks"].tolist()
+        masks = [0] * len(blocks)
+        for i, word in zip(state["write_buffer.entries"].tolist(), state["write_buffer.words"].tolist()):
+            masks[i] |= 1 << word
+        self.write_buffer = dict(zip(blocks, masks))
 
 
 class WriteBackCache(CacheBase):
-    def __init__(self, total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache):
-        super().__init__(total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache)
-
-    def write_to_cache(self, address, write_flag,
-                       next_level_cache):  # write_flag = False when a write is caused by a read miss
-        dirty_bit = False
-        set_index, block_addr = self.find_set_and_block(address)
-        # Only toggle dirty_bits for write access (not write to cache from memory due to a missed read)
-        if write_flag == True:
-            dirty_bit = True
-        # in case address already in cache, remove from cache
-        for i in range(len(self.cache[set_index])):
-            # address[0] is address, address[1] is dirty bit
-            if self.cache[set_index][i][0] == block_addr:
-                self.cache[set_index].pop(i)
-                break
-        # insert to front for most recent reference
-        self.cache[set_index].insert(0, [block_addr, dirty_bit])
-        if len(self.cache[set_index]) > self.set_size:
-            evicted = self.cache[set_index].pop()
-            # if evicted address is dirty, it needs to be written to memory, hence count as a miss
-            if evicted[1] == True:
-                if next_level_cache != None:
-                    next_level_cache.write_to_cache(evicted[1] * self.block_size_bytes, write_flag,
-                                                    next_level_cache.next_cache)
-                else:
-                    self.access_total += 1
-                    self.access_misses += 1
-                    return
-        if write_flag == True:
-            self.access_total += 1
+    # Writes only dirty the cached block; a dirty block is written back to the next level
+    # (memory when there is none) when it is evicted. write_allocate: a write miss brings
+    # the block in and dirties it (without fetching it when the write covers the whole
+    # block, as a writeback from a cache above with the same block size does), otherwise
+    # the write goes straight to the next level and counts as a miss. Writes to the cache
+    # count as hits unless they have to wait for a dirty block to be written back to memory.
+    def __init__(self, total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache,
+                 replacement_policy="lru", write_allocate=True):
+        super().__init__(total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache,
+                         replacement_policy)
+        self.write_allocate = write_allocate
+
+    def write_to_cache(self, address, write_flag, next_level_cache, size_bytes=WRITE_SIZE_BYTES):
+        # find_set_and_block, inlined on the hot paths
+        block_addr = address // self.block_size_bytes
+        set_index = block_addr % self.num_sets
+        line = self.cache[set_index].get(block_addr)
+        self.access_total += 1
+        if line is not None:
+            self.replacement.touch(line)
+            self.dirty[line] = 1
             self.access_hits += 1
-        else:
-            self.access_total += 1
+            return
+        if not self.write_allocate:
+            self._send_write(address, size_bytes, next_level_cache)
+            self.access_misses += 1
+            return
+        line, evicted_dirty = self._fill(address, set_index, block_addr, next_level_cache,
+                                         size_bytes < self.block_size_bytes)
+        self.dirty[line] = 1
+        # if evicted address is dirty, it needs to be written to memory, hence count as a miss
+        if evicted_dirty and next_level_cache is None:
             self.access_misses += 1
+        else:
+            self.access_hits += 1
+
+    def read_from_cache(self, address, next_level_cache):
+        block_addr = address // self.block_size_bytes
+        set_index = block_addr % self.num_sets
+        line = self.cache[set_index].get(block_addr)
+        self.access_total += 1
+        if line is not None:
+            self.access_hits += 1
+            self.replacement.touch(line)
+            return
+        self.access_misses += 1
+        self._fill(address, set_index, block_addr, next_level_cache)
+
+    def _fill(self, address, set_index, block_addr, next_level_cache, fetch=True):
+        # Fetch a missing block (only allocate its line without fetch); a dirty victim is
+        # written back to the next level. Returns the line and whether the victim was dirty.
+        if fetch:
+            line, evicted_addr, evicted_dirty = self._fetch(address, set_index, block_addr, next_level_cache)
+        else:
+            line, evicted_addr, evicted_dirty = self._allocate(set_index, block_addr)
+        if evicted_dirty:
+            self._send_write(evicted_addr * self.block_size_bytes, self.block_size_bytes, next_level_cache)
+        return line, evicted_dirty
+
+    def _checkpoint_kind(self):
+        return f"{super()._checkpoint_kind()} write_allocate={self.write_allocate}"
+
+
+class SharedCache(WriteBackCache):
+    # A WriteBackCache shared by num_cores cores (see MultiCoreSystem). `core` is the core
+    # whose access is being served, set by its CorePort. Each line remembers the core whose
+    # miss brought it in, and inter_core_evictions[evicting core][owner] counts the lines
+    # one core pushed out of the cache while another core owned them.
+    def __init__(self, total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache,
+                 num_cores, replacement_policy="lru", write_allocate=True):
+        super().__init__(total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, next_cache,
+                         replacement_policy, write_allocate)
+        self.num_cores = num_cores
+        self.core = 0
+        self.owners = [-1] * (self.num_sets * self.set_size)
+        self.inter_core_evictions = [[0] * num_cores for _ in range(num_cores)]
+
+    def _allocate(self, set_index, block_addr):
+        line, evicted_addr, evicted_dirty = super()._allocate(set_index, block_addr)
+        owner = self.owners[line]
+        if evicted_addr != -1 and owner != self.core:
+            self.inter_core_evictions[self.core][owner] += 1
+        self.owners[line] = self.core
+        return line, evicted_addr, evicted_dirty
 
+    def evicted_by_other_cores(self, core):
+        # lines owned by `core` that other cores evicted
+        return sum(evictions[core] for evictions in self.inter_core_evictions)
 
-#**********************************************************************
+    def evicted_other_cores(self, core):
+        # lines of other cores that `core` evicted
+        return sum(self.inter_core_evictions[core])
 
+    def _checkpoint_kind(self):
+        return f"{super()._checkpoint_kind()} num_cores={self.num_cores}"
 
-    #**********************************************************************
+    def _checkpoint_state(self):
+        state = super()._checkpoint_state()
+        state["owners"] = np.array(self.owners, dtype=np.int64)
+        state["inter_core_evictions"] = np.array(self.inter_core_evictions, dtype=np.int64)
+        return state
+
+    def _load_checkpoint_state(self, state):
+        super()._load_checkpoint_state(state)
+        self.owners = state["owners"].tolist()
+        self.inter_core_evictions = state["inter_core_evictions"].tolist()
+
+
+class CacheStats:
+    # Counters of one simulated configuration, laid out like the CacheBase attributes
+    # so the table printers accept either.
+    def __init__(self, total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty):
+        self.total_size_bytes = total_size_bytes
+        self.block_size_bytes = block_size_bytes
+        self.set_associativity = set_associativity
+        self.hit_time = hit_time
+        self.miss_penalty = miss_penalty
+        self.num_sets = total_size_bytes // (block_size_bytes * set_associativity)
+
+        self.access_hits = 0
+        self.access_misses = 0
+        self.access_total = 0
+        self.bytes_from_next_level = 0
+        self.bytes_to_next_level = 0
+
+    @classmethod
+    def from_cache(cls, cache):
+        stats = cls(cache.total_size_bytes, cache.block_size_bytes, cache.set_associativity,
+                    cache.hit_time, cache.miss_penalty)
+        stats.access_hits = cache.access_hits
+        stats.access_misses = cache.access_misses
+        stats.access_total = cache.access_total
+        stats.bytes_from_next_level = cache.bytes_from_next_level
+        stats.bytes_to_next_level = cache.bytes_to_next_level
+        return stats
+
+
+class CacheProfile:
+    # Per-set counters, per-set reuse distances and the hottest blocks of one cache,
+    # recorded by instrument(cache). Only sets with set_index % sample_every == 0 are
+    # recorded. hits/misses follow the cache's own access_hits/access_misses accounting.
+    # reuse_distances[d] counts accesses with d distinct other blocks of the same set
+    # referenced since the previous access to the block; the last bucket collects every
+    # distance >= max_distance, cold_accesses the first access to each block.
+    # block_accesses keeps the access counts of at most PROFILE_BLOCKS_PER_TOP * top_n
+    # blocks: past that only the most accessed half is kept, and a dropped block counts
+    # as cold again if it comes back after leaving its set's reuse stack.
+    def __init__(self, cache, sample_every=1, top_n=10, max_distance=64):
+        self.cache = cache
+        self.sample_every = sample_every
+        self.top_n = top_n
+        self.max_distance = max_distance
+        num_sets = cache.num_sets
+        self.hits = [0] * num_sets
+        self.misses = [0] * num_sets
+        self.evictions = [0] * num_sets
+        self.dirty_writebacks = [0] * num_sets
+        self.reuse_distances = [0] * (max_distance + 1)
+        self.cold_accesses = 0
+        self.block_accesses = {}
+        self.max_blocks = PROFILE_BLOCKS_PER_TOP * max(top_n, 1)
+        # per sampled set: its blocks, most recent first, at most max_distance of them
+        self._stacks = {}
+
+    def sampled_sets(self):
+        return range(0, self.cache.num_sets, self.sample_every)
+
+    def hottest_blocks(self, top_n=None):
+        # [(block address in bytes, accesses)], most accessed first
+        block_size = self.cache.block_size_bytes
+        return [(block_addr * block_size, count) for block_addr, count in
+                heapq.nlargest(top_n or self.top_n, self.block_accesses.items(), key=lambda item: item[1])]
+
+    def _record_reuse(self, set_index, block_addr):
+        count = self.block_accesses.get(block_addr)
+        stack = self._stacks.setdefault(set_index, [])
+        try:
+            distance = stack.index(block_addr)
+            del stack[distance]
+        except ValueError:
+            if count is not None:
+                distance = self.max_distance
+            else:
+                self.cold_accesses += 1
+                distance = None
+        if distance is not None:
+            self.reuse_distances[distance] += 1
+        stack.insert(0, block_addr)
+        if len(stack) > self.max_distance:
+            stack.pop()
+        if count is not None:
+            self.block_accesses[block_addr] = count + 1
+        else:
+            self.block_accesses[block_addr] = 1
+            if len(self.block_accesses) > self.max_blocks:
+                self.block_accesses = dict(heapq.nlargest(self.max_blocks // 2, self.block_accesses.items(),
+                                                          key=lambda item: item[1]))
+
+    def set_rows(self):
+        # one dict per sampled set, for print_profile and the exports
+        return [{"set": set_index, "accesses": self.hits[set_index] + self.misses[set_index],
+                 "hits": self.hits[set_index], "misses": self.misses[set_index],
+                 "evictions": self.evictions[set_index], "dirty_writebacks": self.dirty_writebacks[set_index]}
+                for set_index in self.sampled_sets()]
+
+    def to_dict(self):
+        cache = self.cache
+        return {
+            "total_size_bytes": cache.total_size_bytes,
+            "block_size_bytes": cache.block_size_bytes,
+            "set_associativity": cache.set_associativity,
+            "sample_every": self.sample_every,
+            "sets": self.set_rows(),
+            "reuse_distances": self.reuse_distances,
+            "cold_accesses": self.cold_accesses,
+            "hottest_blocks": [{"address": hex(address), "accesses": count}
+                               for address, count in self.hottest_blocks()],
+        }
+
+    def write_json(self, json_path):
+        with open(json_path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def write_csv(self, csv_path):
+        # per-set counters only; the histogram and hottest blocks are in the JSON export
+        with open(csv_path, "w", newline="") as file:
+            writer = csv.DictWriter(file, ["set", "accesses", "hits", "misses", "evictions", "dirty_writebacks"])
+            writer.writeheader()
+            writer.writerows(self.set_rows())
+
+
+def instrument(cache, sample_every=1, top_n=10, max_distance=64):
+    # Start recording a CacheProfile for a WriteThroughCache/WriteBackCache. The counting
+    # versions of read_from_cache, write_to_cache and _allocate are installed on this
+    # instance only, so caches that are not instrumented run the plain class methods.
+    if not hasattr(cache, "read_from_cache"):
+        raise TypeError(f"{type(cache).__name__} cannot be instrumented")
+    uninstrument(cache)
+    profile = CacheProfile(cache, sample_every, top_n, max_distance)
+
+    block_size = cache.block_size_bytes
+    num_sets = cache.num_sets
+
+    def count(method, set_index, block_addr, args):
+        hits = cache.access_hits
+        misses = cache.access_misses
+        method(*args)
+        profile.hits[set_index] += cache.access_hits - hits
+        profile.misses[set_index] += cache.access_misses - misses
+        profile._record_reuse(set_index, block_addr)
+
+    # find_set_and_block, inlined: accesses to sets that are not sampled go straight to
+    # the cache's own method
+    read_from_cache = cache.read_from_cache
+    write_to_cache = cache.write_to_cache
+
+    def counted_read(address, next_level_cache):
+        block_addr = address // block_size
+        set_index = block_addr % num_sets
+        if set_index % sample_every:
+            return read_from_cache(address, next_level_cache)
+        count(read_from_cache, set_index, block_addr, (address, next_level_cache))
+
+    def counted_write(address, write_flag, next_level_cache, size_bytes=WRITE_SIZE_BYTES):
+        block_addr = address // block_size
+        set_index = block_addr % num_sets
+        if set_index % sample_every:
+            return write_to_cache(address, write_flag, next_level_cache, size_bytes)
+        count(write_to_cache, set_index, block_addr, (address, write_flag, next_level_cache, size_bytes))
+
+    allocate = cache._allocate
+
+    def counted_allocate(set_index, block_addr):
+        line, evicted_addr, evicted_dirty = allocate(set_index, block_addr)
+        if evicted_addr != -1 and not set_index % sample_every:
+            profile.evictions[set_index] += 1
+            profile.dirty_writebacks[set_index] += evicted_dirty
+        return line, evicted_addr, evicted_dirty
+
+    cache.read_from_cache = counted_read
+    cache.write_to_cache = counted_write
+    cache._allocate = counted_allocate
+    cache.profile = profile
+    return profile
+
+
+def uninstrument(cache):
+    # Back to the plain class methods; returns the profile recorded so far, if any
+    for name in ("read_from_cache", "write_to_cache", "_allocate"):
+        cache.__dict__.pop(name, None)
+    return cache.__dict__.pop("profile", None)
+
+
+def print_profile(profile, limit=10):
+    # the `limit` sets with the most misses, then the hottest blocks
+    rows = sorted(profile.set_rows(), key=lambda row: row["misses"], reverse=True)[:limit]
+    print("|" + ('-' * 13 + "|")*6)
+    print(f'|{"Set":13}|{"Accesses":13}|{"Hits":13}|{"Misses":13}|{"Evictions":13}|{"Dirty WB":13}|')
+    print("|" + ('-' * 13 + "|")*6)
+    for row in rows:
+        print(f'|{row["set"]:13}|{row["accesses"]:13}|{row["hits"]:13}|{row["misses"]:13}|'
+              f'{row["evictions"]:13}|{row["dirty_writebacks"]:13}|')
+    print("|" + ('-' * 13 + "|")*6)
+    print("|" + ('-' * 20 + "|") + ('-' * 13 + "|"))
+    print(f'|{"Hot block":20}|{"Accesses":13}|')
+    print("|" + ('-' * 20 + "|") + ('-' * 13 + "|"))
+    for address, count in profile.hottest_blocks():
+        print(f"|{hex(address):20}|{count:13}|")
+    print("|" + ('-' * 20 + "|") + ('-' * 13 + "|"))
+
+
+class _StackLevel:
+    # The LRU caches of a forest that share a set count. Under LRU an A-way set holds
+    # exactly the top A entries of the per-set recency stack, so one stack per set capped
+    # at the largest associativity answers every associativity of the level.
+    def __init__(self, num_sets, stats):
+        self.num_sets = num_sets
+        self.stats = sorted(stats, key=lambda s: s.set_associativity)
+        self.associativities = [s.set_associativity for s in self.stats]
+        self.depth = self.associativities[-1]
+
+        # Most recent block first
+        self.stacks = [[] for _ in range(num_sets)]
+        # reads_at_distance[d]: reads whose block was d entries below the top of its
+        # stack (d == depth: not in the stack at all); the same for writes
+        self.reads_at_distance = [0] * (self.depth + 1)
+        self.writes_at_distance = [0] * (self.depth + 1)
+        # Write-back only. For a block written since it last entered the stack, the
+        # largest stack distance it has been read at since that write; the block is
+        # dirty in every A-way cache with A > that distance.
+        self.dirty_depth = {}
+        # dirty blocks pushed out by write misses and by read misses, per associativity
+        self.write_dirty_evictions = [0] * len(self.associativities)
+        self.read_dirty_evictions = [0] * len(self.associativities)
+
+    def finish(self, write_back, block_size, write_size):
+        reads = sum(self.reads_at_distance)
+        writes = sum(self.writes_at_distance)
+        for i, stats in enumerate(self.stats):
+            read_hits = sum(self.reads_at_distance[:stats.set_associativity])
+            write_misses = sum(self.writes_at_distance[stats.set_associativity:])
+            _set_sweep_counters(stats, write_back, block_size, write_size, reads, writes, read_hits, write_misses,
+                                self.write_dirty_evictions[i], self.read_dirty_evictions[i])
+
+
+class _CacheLevel:
+    # A level of a forest with a single associativity: its stacks are the cache sets
+    # themselves (least recent block first) and `dirty` holds the dirty blocks, which is
+    # cheaper than the distance bookkeeping _StackLevel needs for several associativities.
+    def __init__(self, num_sets, stats):
+        self.num_sets = num_sets
+        self.stats = stats
+        self.associativity = stats[0].set_associativity
+        self.stacks = [[] for _ in range(num_sets)]
+        self.dirty = set()
+        # read misses, write misses, and dirty blocks they pushed out
+        self.counts = [0, 0, 0, 0]
+
+    def finish(self, write_back, block_size, write_size, reads, writes):
+        read_misses, write_misses, read_dirty_evictions, write_dirty_evictions = self.counts
+        for stats in self.stats:
+            _set_sweep_counters(stats, write_back, block_size, write_size, reads, writes, reads - read_misses,
+                                write_misses, write_dirty_evictions, read_dirty_evictions)
+
+
+def _set_sweep_counters(stats, write_back, block_size, write_size, reads, writes, read_hits, write_misses,
+                        write_dirty_evictions, read_dirty_evictions):
+    stats.access_total = reads + writes
+    # read and write misses both fetch the block (write-allocate), unless the writes
+    # cover whole blocks
+    if write_size >= block_size:
+        write_misses = 0
+    stats.bytes_from_next_level = (reads - read_hits + write_misses) * block_size
+    if write_back:
+        # writes count as hits unless they push out a dirty block
+        stats.access_hits = read_hits + writes - write_dirty_evictions
+        stats.bytes_to_next_level = (write_dirty_evictions + read_dirty_evictions) * block_size
+    else:
+        # write-through counts every write as a miss
+        stats.access_hits = read_hits
+        stats.bytes_to_next_level = writes * write_size
+    stats.access_misses = stats.access_total - stats.access_hits
+
+
+class _LRUStackForest:
+    # LRU caches sharing a block size, whatever their set counts and associativities,
+    # simulated in one pass: one level per set count, each access updating the stack of
+    # its set in every level (a forest of stacks keyed on the block address modulo the
+    # set count, i.e. its low bits for power-of-two set counts).
+    # The set of a block in any level lies within its "coarse set", the block address
+    # modulo the gcd of the set counts. An access to the block last accessed in its
+    # coarse set is on top of all its stacks and changes nothing but the counters, so
+    # such repeats are found with array ops and only counted.
+    def __init__(self, block_size_bytes, stats, write_back):
+        self.block_size_bytes = block_size_bytes
+        self.write_back = write_back
+        by_num_sets = {}
+        for s in stats:
+            by_num_sets.setdefault(s.num_sets, []).append(s)
+        self.levels = []
+        for num_sets, level_stats in sorted(by_num_sets.items()):
+            if len({s.set_associativity for s in level_stats}) == 1:
+                self.levels.append(_CacheLevel(num_sets, level_stats))
+            else:
+                self.levels.append(_StackLevel(num_sets, level_stats))
+        self.num_coarse_sets = math.gcd(*by_num_sets)
+        # last block accessed in each coarse set, carried between batches
+        self.last_blocks = np.full(self.num_coarse_sets, -1, dtype=np.int64)
+        self.reads = 0
+        self.writes = 0
+        self.repeated_reads = 0
+        self.repeated_writes = 0
+
+    def access_batch(self, block_addrs, write_flags):
+        if len(block_addrs) == 0:
+            return
+        write_back = self.write_back
+        # group accesses by coarse set, keeping trace order inside each: sets are
+        # independent, so they can be simulated one after the other
+        if self.num_coarse_sets == 1:
+            sets = np.zeros(len(block_addrs), dtype=np.int64)
+            blocks = block_addrs
+            writes = write_flags
+        else:
+            coarse_sets = block_addrs % self.num_coarse_sets
+            if self.num_coarse_sets <= 1 << 16:
+                # NumPy's stable sort is a radix sort for 16-bit keys
+                order = np.argsort(coarse_sets.astype(np.uint16), kind="stable")
+            else:
+                order = np.argsort(coarse_sets, kind="stable")
+            sets = coarse_sets[order]
+            blocks = block_addrs[order]
+            writes = write_flags[order]
+
+        first = np.ones(len(sets), dtype=bool)
+        first[1:] = sets[1:] != sets[:-1]
+        previous = np.empty_like(blocks)
+        previous[1:] = blocks[:-1]
+        previous[first] = self.last_blocks[sets[first]]
+        repeated = blocks == previous
+        num_writes = int(np.count_nonzero(writes))
+        num_repeated_writes = int(np.count_nonzero(repeated & writes))
+        self.writes += num_writes
+        self.reads += len(writes) - num_writes
+        self.repeated_writes += num_repeated_writes
+        self.repeated_reads += int(np.count_nonzero(repeated)) - num_repeated_writes
+
+        # a run is an access and the repeats after it; the first run of a coarse set
+        # may continue one from the last batch. An access is followed by a write to its
+        # block (dirtying it in every level) iff its run has a write.
+        run_start = ~repeated | first
+        run_id = np.cumsum(run_start) - 1
+        run_dirty = np.bincount(run_id, weights=writes, minlength=run_id[-1] + 1) > 0
+        last = np.ones(len(sets), dtype=bool)
+        last[:-1] = first[1:]
+        self.last_blocks[sets[last]] = blocks[last]
+
+        kept = ~repeated
+        if write_back:
+            carried = first & repeated & run_dirty[run_id]
+            for block_addr in blocks[carried].tolist():
+                for level in self.levels:
+                    if isinstance(level, _CacheLevel):
+                        level.dirty.add(block_addr)
+                    else:
+                        level.dirty_depth[block_addr] = 0
+            dirtied = run_dirty[run_id[kept]]
+        else:
+            dirtied = np.zeros(int(np.count_nonzero(kept)), dtype=bool)
+        accesses = (blocks[kept].tolist(), writes[kept].tolist(), dirtied.tolist())
+        cache_levels = [(level.num_sets, level.stacks, level.associativity, level.dirty, level.counts)
+                        for level in self.levels if isinstance(level, _CacheLevel)]
+        if cache_levels:
+            self._access_cache_levels(cache_levels, *accesses)
+        stack_levels = [level for level in self.levels if isinstance(level, _StackLevel)]
+        if stack_levels:
+            self._access_stack_levels(stack_levels, *accesses)
+
+    @staticmethod
+    def _access_cache_levels(levels, block_addrs, write_flags, dirtied_flags):
+        for block_addr, write_flag, dirtied in zip(block_addrs, write_flags, dirtied_flags):
+            for num_sets, stacks, associativity, dirty, counts in levels:
+                stack = stacks[block_addr % num_sets]
+                if block_addr in stack:
+                    if stack[-1] != block_addr:
+                        stack.remove(block_addr)
+                        stack.append(block_addr)
+                else:
+                    counts[write_flag] += 1
+                    if len(stack) == associativity:
+                        evicted = stack.pop(0)
+                        if evicted in dirty:
+                            dirty.remove(evicted)
+                            counts[2 + write_flag] += 1
+                    stack.append(block_addr)
+                if dirtied:
+                    dirty.add(block_addr)
+
+    def _access_stack_levels(self, stack_levels, block_addrs, write_flags, dirtied_flags):
+        write_back = self.write_back
+        levels = [(level.num_sets, level.stacks, level.depth, level.associativities, level.reads_at_distance,
+                   level.writes_at_distance, level.dirty_depth, level.write_dirty_evictions,
+                   level.read_dirty_evictions) for level in stack_levels]
+        for block_addr, write_flag, dirtied in zip(block_addrs, write_flags, dirtied_flags):
+            for (num_sets, stacks, depth, associativities, reads_at_distance, writes_at_distance, dirty_depth,
+                 write_dirty_evictions, read_dirty_evictions) in levels:
+                stack = stacks[block_addr % num_sets]
+                try:
+                    distance = stack.index(block_addr)
+                except ValueError:
+                    distance = depth
+
+                if write_back:
+                    # an A-way cache misses when A <= distance and evicts stack[A - 1] if full
+                    dirty_evictions = write_dirty_evictions if write_flag else read_dirty_evictions
+                    for i, associativity in enumerate(associativities):
+                        if associativity > distance or associativity > len(stack):
+                            break
+                        if dirty_depth.get(stack[associativity - 1], associativity) < associativity:
+                            dirty_evictions[i] += 1
+                    if dirtied:
+                        dirty_depth[block_addr] = 0
+                    elif block_addr in dirty_depth:
+                        # a read of a block that is dirty in the larger associativities
+                        if distance == depth:
+                            del dirty_depth[block_addr]
+                        elif distance > dirty_depth[block_addr]:
+                            dirty_depth[block_addr] = distance
+
+                if write_flag:
+                    writes_at_distance[distance] += 1
+                else:
+                    reads_at_distance[distance] += 1
+
+                if distance:
+                    if distance < depth:
+                        del stack[distance]
+                    stack.insert(0, block_addr)
+                    if len(stack) > depth:
+                        dropped = stack.pop()
+                        if write_back:
+                            dirty_depth.pop(dropped, None)
+
+    def finish(self, write_size):
+        for level in self.levels:
+            if isinstance(level, _CacheLevel):
+                level.finish(self.write_back, self.block_size_bytes, write_size, self.reads, self.writes)
+            else:
+                # repeats are hits on top of every stack
+                level.reads_at_distance[0] += self.repeated_reads
+                level.writes_at_distance[0] += self.repeated_writes
+                level.finish(self.write_back, self.block_size_bytes, write_size)
+
+
+class _DirectMappedGroup:
+    # Direct-mapped caches sharing a block size and set count, resolved with array ops.
+    # An access hits iff the previous access to its set used the same block, and a
+    # write-back line is dirty iff any write happened since that block was brought in.
+    def __init__(self, block_size_bytes, num_sets, stats, write_back):
+        self.block_size_bytes = block_size_bytes
+        self.num_sets = num_sets
+        self.stats = stats
+        self.write_back = write_back
+
+        # Line contents carried between batches
+        self.resident = np.full(num_sets, -1, dtype=np.int64)
+        self.resident_dirty = np.zeros(num_sets, dtype=bool)
+        self.reads = 0
+        self.read_hits = 0
+        self.writes = 0
+        self.write_hits = 0
+        # dirty lines pushed out by write misses and by read misses
+        self.write_dirty_evictions = 0
+        self.read_dirty_evictions = 0
+
+    def access_batch(self, block_addrs, write_flags):
+        if len(block_addrs) == 0:
+            return
+        num_writes = int(np.count_nonzero(write_flags))
+        self.writes += num_writes
+        self.reads += len(write_flags) - num_writes
+
+        # An access to the same block as the access before it always hits. When there
+        # are enough of those (instruction fetches), count them here and resolve only
+        # the first access of each repeat; dirtied says whether its repeats wrote.
+        repeated = np.zeros(len(block_addrs), dtype=bool)
+        np.equal(block_addrs[1:], block_addrs[:-1], out=repeated[1:])
+        num_repeated = int(np.count_nonzero(repeated))
+        dirtied = write_flags
+        if num_repeated * 8 > len(block_addrs):
+            kept = np.flatnonzero(~repeated)
+            num_repeated_writes = int(np.count_nonzero(repeated & write_flags)) if num_writes else 0
+            self.write_hits += num_repeated_writes
+            self.read_hits += num_repeated - num_repeated_writes
+            if num_repeated_writes:
+                dirtied = np.logical_or.reduceat(write_flags, kept)
+            block_addrs = block_addrs[kept]
+            write_flags = write_flags[kept]
+            if not num_repeated_writes:
+                dirtied = write_flags
+
+        set_indices = block_addrs % self.num_sets
+        # group accesses by set, keeping trace order inside each set
+        if self.num_sets <= 1 << 16:
+            # NumPy's stable sort is a radix sort for 16-bit keys
+            order = np.argsort(set_indices.astype(np.uint16), kind="stable")
+        else:
+            order = np.argsort(set_indices, kind="stable")
+        sets = set_indices[order]
+        blocks = block_addrs[order]
+        writes = write_flags[order]
+
+        first = np.ones(len(sets), dtype=bool)
+        first[1:] = sets[1:] != sets[:-1]
+        previous = np.empty_like(blocks)
+        previous[1:] = blocks[:-1]
+        previous[first] = self.resident[sets[first]]
+        hit = blocks == previous
+
+        num_write_hits = int(np.count_nonzero(hit & writes)) if num_writes else 0
+        self.write_hits += num_write_hits
+        self.read_hits += int(np.count_nonzero(hit)) - num_write_hits
+
+        if not self.write_back:
+            # write-through lines are never dirty, only the resident blocks matter
+            last = np.ones(len(sets), dtype=bool)
+            last[:-1] = first[1:]
+            self.resident[sets[last]] = blocks[last]
+            return
+
+        # a run is one residency of a line: it starts at a miss or at the first access
+        # of a set in this batch (continuing the carried line)
+        starts = np.flatnonzero(~hit | first)
+        run_sets = sets[starts]
+        run_first = first[starts]
+        if num_writes:
+            run_dirty = np.logical_or.reduceat(dirtied[order], starts)
+        else:
+            run_dirty = np.zeros(len(starts), dtype=bool)
+        carried = run_first & hit[starts]
+        run_dirty[carried] |= self.resident_dirty[run_sets[carried]]
+
+        # misses that push out a dirty line: the previous run of the set in this
+        # batch, or the line carried over from the last one
+        evicted_dirty = np.empty(len(starts), dtype=bool)
+        evicted_dirty[1:] = run_dirty[:-1]
+        evicted_dirty[run_first] = (self.resident_dirty[run_sets[run_first]]
+                                    & (self.resident[run_sets[run_first]] != -1))
+        evicted_dirty &= ~hit[starts]
+        num_write_evictions = int(np.count_nonzero(evicted_dirty & writes[starts])) if num_writes else 0
+        self.write_dirty_evictions += num_write_evictions
+        self.read_dirty_evictions += int(np.count_nonzero(evicted_dirty)) - num_write_evictions
+
+        # the last run of each set stays resident
+        last = np.ones(len(starts), dtype=bool)
+        last[:-1] = run_first[1:]
+        self.resident[run_sets[last]] = blocks[starts[last]]
+        self.resident_dirty[run_sets[last]] = run_dirty[last]
+
+    def finish(self, write_size):
+        block_size = self.block_size_bytes
+        # writes that cover whole blocks fill without a fetch
+        write_fetches = self.writes - self.write_hits if write_size < block_size else 0
+        for stats in self.stats:
+            stats.access_total = self.reads + self.writes
+            stats.bytes_from_next_level = (self.reads - self.read_hits + write_fetches) * block_size
+            if self.write_back:
+                stats.access_hits = self.read_hits + self.writes - self.write_dirty_evictions
+                stats.bytes_to_next_level = (self.write_dirty_evictions + self.read_dirty_evictions) * block_size
+            else:
+                stats.access_hits = self.read_hits
+                stats.bytes_to_next_level = self.writes * write_size
+            stats.access_misses = stats.access_total - stats.access_hits
+
+
+class StackDistanceSweep:
+    # Simulates many LRU configurations of one cache class in a single trace pass
+    # (Mattson stack distances). It stands in for a last-level cache: pass it where a
+    # cache object is expected and read the per-configuration counters from results().
+    # Accesses are buffered and resolved in NumPy batches; direct-mapped points are
+    # computed entirely with array ops. Every write must have the same size (the block
+    # size of the cache above for its writebacks).
+    # configs: (total_size_bytes, block_size_bytes, set_associativity) tuples
+    batch_size = 1 << 16
+
+    def __init__(self, cache_class, configs, hit_time, miss_penalty):
+        if not issubclass(cache_class, (WriteThroughCache, WriteBackCache)):
+            raise ValueError(f"Unsupported cache class: {cache_class.__name__}")
+        write_back = issubclass(cache_class, WriteBackCache)
+        self.stats = [CacheStats(total_size, block_size, associativity, hit_time, miss_penalty)
+                      for total_size, block_size, associativity in configs]
+        self.hit_time = hit_time
+        self.miss_penalty = miss_penalty
+        self.next_cache = None
+
+        grouped = {}
+        for stats in self.stats:
+            key = sweep_group_key((stats.total_size_bytes, stats.block_size_bytes, stats.set_associativity))
+            grouped.setdefault(key, []).append(stats)
+        self.groups = []
+        for (block_size, num_sets), stats in grouped.items():
+            if num_sets is None:
+                self.groups.append(_LRUStackForest(block_size, stats, write_back))
+            else:
+                self.groups.append(_DirectMappedGroup(block_size, num_sets, stats, write_back))
+
+        self._pending_addresses = []
+        self._pending_writes = []
+        self._finished = False
+        self.write_size = None
 
     def read_from_cache(self, address, next_level_cache):
-        set_index, block_addr = self.find_set_and_block(address)
-        for i in range(len(self.cache[set_index])):
-            if self.cache[set_index][i][0] == block_addr:
-                self.access_hits += 1
-                self.access_total += 1
-                # Move matched address to front (most recent reference)
-                matched_block = self.cache[set_index].pop(i)
-                self.cache[set_index].insert(0, matched_block)
-                return
-        # handle miss by getting address from next level cache
-        self._handle_cache_miss(address, next_level_cache=next_level_cache)
-        # update current cache
-        self.write_to_cache(address, write_flag=False, next_level_cache=None)
+        if next_level_cache is not None:
+            raise ValueError("StackDistanceSweep must be the last cache level")
+        self._pending_addresses.append(address)
+        self._pending_writes.append(False)
+        if len(self._pending_addresses) >= self.batch_size:
+            self._flush()
+
+    def write_to_cache(self, address, write_flag, next_level_cache, size_bytes=WRITE_SIZE_BYTES):
+        if next_level_cache is not None:
+            raise ValueError("StackDistanceSweep must be the last cache level")
+        if not write_flag:
+            raise ValueError("StackDistanceSweep only models write accesses here")
+        if size_bytes != self.write_size:
+            self._set_write_size(size_bytes)
+        self._pending_addresses.append(address)
+        self._pending_writes.append(True)
+        if len(self._pending_addresses) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._pending_addresses:
+            addresses = np.array(self._pending_addresses, dtype=np.uint64)
+            write_flags = np.array(self._pending_writes, dtype=bool)
+            self._pending_addresses = []
+            self._pending_writes = []
+            self.access_batch(addresses, write_flags, self.write_size)
+
+    def _set_write_size(self, size_bytes):
+        if self.write_size is not None:
+            raise ValueError(f"StackDistanceSweep got {size_bytes} byte writes after {self.write_size} byte ones")
+        self.write_size = size_bytes
+
+    def access_batch(self, addresses, write_flags, write_size=WRITE_SIZE_BYTES):
+        # addresses: uint64 array, write_flags: bool array of the same length
+        if write_size != self.write_size and write_flags.any():
+            self._set_write_size(write_size)
+        block_cache = {}
+        for group in self.groups:
+            block_addrs = block_cache.get(group.block_size_bytes)
+            if block_addrs is None:
+                block_addrs = block_cache[group.block_size_bytes] = block_addresses(addresses, group.block_size_bytes)
+            group.access_batch(block_addrs, write_flags)
+
+    def results(self):
+        if not self._finished:
+            self._flush()
+            write_size = WRITE_SIZE_BYTES if self.write_size is None else self.write_size
+            for group in self.groups:
+                group.finish(write_size)
+            self._finished = True
+        return self.stats
+
 
-    def _handle_cache_miss(self, address, next_level_cache):
-        if next_level_cache != None:
-            next_level_cache.read_from_cache(address, next_level_cache=next_level_cache.next_cache)
+def sweep_group_key(config):
+    # Points of a StackDistanceSweep with the same key are simulated together:
+    # direct-mapped ones by block size and set count, the others by block size
+    total_size, block_size, associativity = config
+    if associativity == 1:
+        return block_size, total_size // block_size
+    return block_size, None
+
+
+def block_addresses(addresses, block_size_bytes):
+    # Vectorized block address of CacheBase.find_set_and_block over a uint64 address array
+    return (addresses // np.uint64(block_size_bytes)).astype(np.int64)
+
+
+def sweep_l1_trace(l1d_sweep, l1i_sweep, trace, batch_size=1 << 20):
+    # Batched run_trace for a pair of L1 sweeps: split each batch of the trace into
+    # data and instruction accesses and hand them over as arrays.
+    for types, addresses in trace.iter_batches(batch_size):
+        # index arrays gather much faster than boolean masks here
+        data = np.flatnonzero(types != 2)
+        instruction = np.flatnonzero(types == 2)
+        l1d_sweep.access_batch(addresses[data], types[data] == 1)
+        l1i_sweep.access_batch(addresses[instruction], np.zeros(len(instruction), dtype=bool))
 
 
 def calculate_percentage(value, total=None):
@@ -157,78 +1323,1108 @@ def calculate_percentage(value, total=None):
     return (value / total) * 100
 
 
-def simulate_l1_cache(l1d_cache, l1i_cache, trace_file_path):
-    with open(trace_file_path, "r") as file:
-        for line in file:
-            memory_access_type, address_hex = line.split()
-            address = int(address_hex, 16)
-
-            if memory_access_type == '0':
-                l1d_cache.read_from_cache(address, next_level_cache=None)
-            elif memory_access_type == '1':
-                l1d_cache.write_to_cache(address, write_flag=True, next_level_cache=None)
-            elif memory_access_type == '2':
-                l1i_cache.read_from_cache(address, next_level_cache=None)
-
-        data_hit_rate = calculate_percentage(l1d_cache.access_hits, l1d_cache.access_total)
-        data_miss_rate = calculate_percentage(l1d_cache.access_misses, l1d_cache.access_total)
-        instruction_hit_rate = calculate_percentage(l1i_cache.access_hits, l1i_cache.access_total)
-        instruction_miss_rate = calculate_percentage(l1i_cache.access_misses, l1i_cache.access_total)
-        total_miss_rate = calculate_percentage(l1d_cache.access_misses + l1i_cache.access_misses,
-                                               l1d_cache.access_total + l1i_cache.access_total)
-        amat = l1i_cache.hit_time + (total_miss_rate / 100) * l1i_cache.miss_penalty
-
-        # print(f"L1 Data Hits: {l1d_cache.access_hits} ({data_hit_rate:.2f}) Total: {l1d_cache.access_total}")
-        # print(f"L1 Data Misses: {l1d_cache.access_misses} ({data_miss_rate:.2f})")
-        # print(
-        #     f"L1 Instruction Hits: {l1i_cache.access_hits} ({instruction_hit_rate:.2f}) Total: {l1i_cache.access_total}")
-        # print(f"L1 Instruction Misses: {l1i_cache.access_misses} ({instruction_miss_rate:.2f})")
-        # print(f"AMAT: {amat:.2f}\n")
-
-        print(f"|{l1i_cache.set_associativity:15}|{l1i_cache.access_total:15}|{l1i_cache.access_misses:15}|{instruction_hit_rate:14.2f}%|{l1d_cache.access_total:15}|{l1d_cache.access_misses:15}|{data_hit_rate:14.2f}%|{amat:15.2f}|")
-        print("|" + ('-' * 15 + "|")*8)
-
-
-def simulate_l1_l2_cache(l1d_cache, l1i_cache, l2_cache, trace_file_path, stats):
-    with open(trace_file_path, "r") as file:
-        for line in file:
-            memory_access_type, address_hex = line.split()
-            address = int(address_hex, 16)
-
-            if memory_access_type == '0':
-                l1d_cache.read_from_cache(address, next_level_cache=l2_cache)
-            elif memory_access_type == '1':
-                l1d_cache.write_to_cache(address, write_flag=True, next_level_cache=l2_cache)
-            elif memory_access_type == '2':
-                l1i_cache.read_from_cache(address, next_level_cache=l2_cache)
+class Trace:
+    def __init__(self, access_types, addresses, source_path=None, mapping=None, digest=None, sidecar_path=None):
+        # access_types: one byte per access (0 read, 1 write, 2 instruction fetch)
+        # addresses: one uint64 per access
+        self.access_types = access_types
+        self.addresses = addresses
+        self.source_path = source_path
+        # the sidecar the accesses are mapped from, which worker processes map too
+        self.sidecar_path = sidecar_path
+        self._mapping = mapping
+        # hex digest of the decoded accesses, identifies the trace in the result store
+        self.digest = digest if digest is not None else trace_digest(access_types, addresses)
+        # TraceReader that decoded the text file in this run, None if the sidecar was reused
+        self.ingest = None
 
-        l1d_hit_rate = calculate_percentage(l1d_cache.access_hits, l1d_cache.access_total)
-        l1d_miss_rate = calculate_percentage(l1d_cache.access_misses, l1d_cache.access_total)
+    def __len__(self):
+        return len(self.access_types)
+
+    def __iter__(self):
+        for access_types, addresses in self.iter_batches():
+            yield from zip(access_types.tolist(), addresses.tolist())
+
+    def as_arrays(self):
+        # zero-copy NumPy views of the access types and addresses
+        return (np.frombuffer(self.access_types, dtype=np.uint8),
+                np.frombuffer(self.addresses, dtype=np.uint64))
+
+    def iter_batches(self, batch_size=TRACE_BATCH_SIZE):
+        access_types, addresses = self.as_arrays()
+        for start in range(0, len(access_types), batch_size):
+            yield access_types[start:start + batch_size], addresses[start:start + batch_size]
+
+    def close(self):
+        if self._mapping is not None:
+            self.access_types.release()
+            self.addresses.release()
+            self._mapping.close()
+            self._mapping = None
+
+
+def open_trace_text(trace_file_path):
+    # Text stream of a trace, decompressing .gz/.xz/.zst on the fly
+    if trace_file_path.endswith(".gz"):
+        return gzip.open(trace_file_path, "rt")
+    if trace_file_path.endswith((".xz", ".lzma")):
+        return lzma.open(trace_file_path, "rt")
+    if trace_file_path.endswith((".zst", ".zstd")):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading .zst traces requires the 'zstandard' package") from None
+        raw = open(trace_file_path, "rb")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True))
+    return open(trace_file_path, "r")
+
+
+class TraceReader:
+    # Streams a text trace as (access type uint8 array, address uint64 array) batches of
+    # at most batch_size accesses, so memory stays bounded whatever the trace size.
+    # Lines are "<type> <hex address>"; fields after the address and anything after '#'
+    # are ignored, as are blank lines. Iterating counts accesses and the time spent
+    # reading and decoding, which accesses_per_second reports.
+    def __init__(self, trace_file_path, batch_size=TRACE_BATCH_SIZE):
+        self.source_path = trace_file_path
+        self.batch_size = batch_size
+        self.accesses = 0
+        self.seconds = 0.0
+
+    @property
+    def accesses_per_second(self):
+        if self.seconds == 0:
+            return 0
+        return self.accesses / self.seconds
+
+    def iter_batches(self, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        started = time.perf_counter()
+        access_types = []
+        addresses = []
+        with open_trace_text(self.source_path) as file:
+            for line in file:
+                if "#" in line:
+                    line = line.split("#", 1)[0]
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                access_types.append(int(fields[0]))
+                addresses.append(int(fields[1], 16))
+                if len(access_types) == batch_size:
+                    batch = self._batch(access_types, addresses)
+                    access_types = []
+                    addresses = []
+                    self.seconds += time.perf_counter() - started
+                    yield batch
+                    started = time.perf_counter()
+        if access_types:
+            batch = self._batch(access_types, addresses)
+            self.seconds += time.perf_counter() - started
+            yield batch
+        else:
+            self.seconds += time.perf_counter() - started
+
+    def __iter__(self):
+        return self.iter_batches()
+
+    def _batch(self, access_types, addresses):
+        self.accesses += len(access_types)
+        return np.array(access_types, dtype=np.uint8), np.array(addresses, dtype=np.uint64)
+
+
+def _padded(length):
+    return (length + 7) & ~7
+
+
+def _combine_digests(types_hash, addresses_hash):
+    return hashlib.blake2b(types_hash.digest() + addresses_hash.digest(), digest_size=16)
+
+
+def trace_digest(access_types, addresses):
+    types_hash = hashlib.blake2b(digest_size=16)
+    addresses_hash = hashlib.blake2b(digest_size=16)
+    types_hash.update(access_types)
+    addresses_hash.update(addresses)
+    return _combine_digests(types_hash, addresses_hash).hexdigest()
+
+
+def _write_trace_sidecar(sidecar_path, source_stat, reader):
+    # Stream the batches into the sidecar; addresses go through a scratch file because
+    # the access-type bytes come first and the count is only known at the end.
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    addresses_path = f"{tmp_path}.addresses"
+    try:
+        count = 0
+        types_hash = hashlib.blake2b(digest_size=16)
+        addresses_hash = hashlib.blake2b(digest_size=16)
+        with open(tmp_path, "wb") as file, open(addresses_path, "wb+") as addresses_file:
+            file.write(bytes(TRACE_HEADER.size))
+            for access_types, addresses in reader:
+                file.write(access_types.tobytes())
+                addresses_file.write(addresses.tobytes())
+                types_hash.update(access_types)
+                addresses_hash.update(addresses)
+                count += len(access_types)
+            file.write(bytes(_padded(count) - count))
+            addresses_file.seek(0)
+            shutil.copyfileobj(addresses_file, file, 1 << 20)
+            file.seek(0)
+            file.write(TRACE_HEADER.pack(TRACE_MAGIC, source_stat.st_size, source_stat.st_mtime_ns, count,
+                                         _combine_digests(types_hash, addresses_hash).digest()))
+        os.replace(tmp_path, sidecar_path)
+    finally:
+        for path in (tmp_path, addresses_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _map_trace_sidecar(sidecar_path, source_stat, trace_file_path):
+    try:
+        file = open(sidecar_path, "rb")
+    except OSError:
+        return None
+    with file:
+        header = file.read(TRACE_HEADER.size)
+        if len(header) != TRACE_HEADER.size:
+            return None
+        magic, size, mtime_ns, count, digest = TRACE_HEADER.unpack(header)
+        if magic != TRACE_MAGIC or size != source_stat.st_size or mtime_ns != source_stat.st_mtime_ns:
+            return None
+        if count == 0:
+            return Trace(np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.uint64), trace_file_path,
+                         digest=digest.hex(), sidecar_path=sidecar_path)
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    types_start = TRACE_HEADER.size
+    addresses_start = types_start + _padded(count)
+    if len(mapping) < addresses_start + count * 8:
+        mapping.close()
+        return None
+    view = memoryview(mapping)
+    access_types = view[types_start:types_start + count]
+    addresses = view[addresses_start:addresses_start + count * 8].cast("Q")
+    view.release()
+    return Trace(access_types, addresses, trace_file_path, mapping, digest.hex(), sidecar_path)
+
+
+def _trace_sidecar_paths(trace_file_path):
+    # Where the sidecar of a trace may be: next to it, or in the temp directory (named
+    # after the trace's absolute path) when the trace's directory is read-only
+    name = hashlib.blake2b(os.path.abspath(trace_file_path).encode(), digest_size=8).hexdigest()
+    return [trace_file_path + TRACE_SUFFIX, os.path.join(tempfile.gettempdir(), f"cache_sim-{name}{TRACE_SUFFIX}")]
+
+
+def load_trace(trace_file_path, use_sidecar=True):
+    # Decode a text trace once; later loads memory-map the binary sidecar as long as
+    # the source file's size and mtime are unchanged.
+    source_stat = os.stat(trace_file_path)
+    if use_sidecar:
+        sidecar_paths = _trace_sidecar_paths(trace_file_path)
+        for sidecar_path in sidecar_paths:
+            trace = _map_trace_sidecar(sidecar_path, source_stat, trace_file_path)
+            if trace is not None:
+                return trace
+        for sidecar_path in sidecar_paths:
+            reader = TraceReader(trace_file_path)
+            try:
+                _write_trace_sidecar(sidecar_path, source_stat, reader)
+                trace = _map_trace_sidecar(sidecar_path, source_stat, trace_file_path)
+            except OSError:
+                continue  # read-only directory, try the next one
+            if trace is not None:
+                trace.ingest = reader
+                return trace
+        # nowhere to write a sidecar: keep an in-memory copy instead
+
+    reader = TraceReader(trace_file_path)
+    batches = list(reader)
+    if batches:
+        access_types = np.concatenate([batch[0] for batch in batches])
+        addresses = np.concatenate([batch[1] for batch in batches])
+    else:
+        access_types = np.empty(0, dtype=np.uint8)
+        addresses = np.empty(0, dtype=np.uint64)
+    trace = Trace(access_types, addresses, trace_file_path)
+    trace.ingest = reader
+    return trace
+
+
+def read_trace_timestamps(trace_file_path, batch_size=TRACE_BATCH_SIZE):
+    # The timestamps of a trace whose lines are "<type> <hex address> <timestamp>"
+    # (decimal), one uint64 per access of load_trace, for interleave_traces.
+    batches = []
+    timestamps = []
+    with open_trace_text(trace_file_path) as file:
+        for line_number, line in enumerate(file, 1):
+            if "#" in line:
+                line = line.split("#", 1)[0]
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            if len(fields) < 3:
+                raise ValueError(f"{trace_file_path}:{line_number} has no timestamp")
+            timestamps.append(int(fields[2]))
+            if len(timestamps) == batch_size:
+                batches.append(np.array(timestamps, dtype=np.uint64))
+                timestamps = []
+    batches.append(np.array(timestamps, dtype=np.uint64))
+    return np.concatenate(batches)
+
+
+def run_trace(l1d_cache, l1i_cache, trace, next_level_cache, checkpoint_path=None,
+              checkpoint_interval=CHECKPOINT_INTERVAL):
+    # trace: a loaded Trace or a TraceReader streaming straight from the text file.
+    # With checkpoint_path, the caches are saved there every checkpoint_interval accesses
+    # and at the end; if the checkpoint already exists the run resumes from it, and only
+    # the accesses of the trace past the checkpointed ones are simulated.
+    if checkpoint_path is not None:
+        _run_trace_checkpointed(l1d_cache, l1i_cache, trace, next_level_cache, checkpoint_path,
+                                checkpoint_interval)
+        return
+    for access_types, addresses in trace.iter_batches():
+        _run_accesses(l1d_cache, l1i_cache, access_types.tolist(), addresses.tolist(), next_level_cache)
+    l1d_cache.drain_write_buffer(next_level_cache)
+    l1i_cache.drain_write_buffer(next_level_cache)
+
+
+def _run_accesses(l1d_cache, l1i_cache, access_types, addresses, next_level_cache):
+    for memory_access_type, address in zip(access_types, addresses):
+        if memory_access_type == 0:
+            l1d_cache.read_from_cache(address, next_level_cache=next_level_cache)
+        elif memory_access_type == 1:
+            l1d_cache.write_to_cache(address, write_flag=True, next_level_cache=next_level_cache)
+        elif memory_access_type == 2:
+            l1i_cache.read_from_cache(address, next_level_cache=next_level_cache)
+
+
+def checkpoint_caches(l1d_cache, l1i_cache, next_level_cache):
+    # Every cache a run_trace call updates: the L1s and the next_cache chain below them
+    caches = []
+    for cache in (l1d_cache, l1i_cache, next_level_cache):
+        while cache is not None and not any(cache is seen for seen in caches):
+            if not isinstance(cache, CacheBase):
+                raise TypeError(f"{type(cache).__name__} cannot be checkpointed")
+            caches.append(cache)
+            cache = cache.next_cache
+    return caches
+
+
+def save_checkpoint(checkpoint_path, caches, position, digest):
+    # Contents, dirty bits, replacement state and counters of every cache, with the number
+    # of trace accesses simulated so far and the digest of those accesses, as one .npz
+    arrays = {"format": np.array(CHECKPOINT_FORMAT), "position": np.array(position, dtype=np.uint64),
+              "digest": np.array(digest), "caches": np.array(len(caches))}
+    for i, cache in enumerate(caches):
+        for name, array in cache._checkpoint_state().items():
+            arrays[f"{i}.{name}"] = array
+    tmp_path = f"{checkpoint_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(tmp_path, checkpoint_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_checkpoint(checkpoint_path, caches):
+    # Load a save_checkpoint file into caches configured like the saved ones (same
+    # classes, sizes and replacement policies, in the same order).
+    # Returns the number of accesses it covers and their digest.
+    with np.load(checkpoint_path, allow_pickle=False) as checkpoint:
+        if "format" not in checkpoint.files or str(checkpoint["format"]) != CHECKPOINT_FORMAT:
+            raise ValueError(f"{checkpoint_path} is not a cache checkpoint")
+        if int(checkpoint["caches"]) != len(caches):
+            raise ValueError(f"{checkpoint_path} holds {int(checkpoint['caches'])} caches, not {len(caches)}")
+        states = [{name.split(".", 1)[1]: checkpoint[name] for name in checkpoint.files
+                   if name.split(".", 1)[0] == str(i)} for i in range(len(caches))]
+        for cache, state in zip(caches, states):
+            if str(state["kind"]) != cache._checkpoint_kind():
+                raise ValueError(f"{checkpoint_path} was taken from a {state['kind']} cache, "
+                                 f"not a {cache._checkpoint_kind()} one")
+        for cache, state in zip(caches, states):
+            cache._load_checkpoint_state(state)
+        return int(checkpoint["position"]), str(checkpoint["digest"])
+
+
+def _run_trace_checkpointed(l1d_cache, l1i_cache, trace, next_level_cache, checkpoint_path, checkpoint_interval):
+    caches = checkpoint_caches(l1d_cache, l1i_cache, next_level_cache)
+    resume_position = 0
+    if os.path.exists(checkpoint_path):
+        resume_position, resume_digest = load_checkpoint(checkpoint_path, caches)
+    # digest of the accesses consumed so far, like trace_digest of that prefix
+    types_hash = hashlib.blake2b(digest_size=16)
+    addresses_hash = hashlib.blake2b(digest_size=16)
+    position = 0
+    next_checkpoint = resume_position + checkpoint_interval
+    for access_types, addresses in trace.iter_batches():
+        start = 0
+        if position < resume_position:
+            # already simulated: only check that the trace still starts with these accesses
+            start = min(len(access_types), resume_position - position)
+            types_hash.update(access_types[:start])
+            addresses_hash.update(addresses[:start])
+            position += start
+            if position == resume_position and \
+                    _combine_digests(types_hash, addresses_hash).hexdigest() != resume_digest:
+                raise ValueError(f"{checkpoint_path} was not taken on the start of this trace")
+        while start < len(access_types):
+            end = min(len(access_types), start + next_checkpoint - position)
+            types_hash.update(access_types[start:end])
+            addresses_hash.update(addresses[start:end])
+            _run_accesses(l1d_cache, l1i_cache, access_types[start:end].tolist(), addresses[start:end].tolist(),
+                          next_level_cache)
+            position += end - start
+            start = end
+            if position == next_checkpoint:
+                save_checkpoint(checkpoint_path, caches, position,
+                                _combine_digests(types_hash, addresses_hash).hexdigest())
+                next_checkpoint += checkpoint_interval
+    if position < resume_position:
+        raise ValueError(f"{checkpoint_path} covers {resume_position} accesses, the trace only has {position}")
+    if position != next_checkpoint - checkpoint_interval:
+        save_checkpoint(checkpoint_path, caches, position, _combine_digests(types_hash, addresses_hash).hexdigest())
+    # after the last checkpoint, which keeps the pending writes a longer trace would coalesce
+    l1d_cache.drain_write_buffer(next_level_cache)
+    l1i_cache.drain_write_buffer(next_level_cache)
+
+
+def calculate_amat(hit_times, miss_rates, miss_penalty):
+    # hit_times/miss_rates (in %) from the top level down; the last level misses to memory
+    amat = miss_penalty
+    for hit_time, miss_rate in zip(reversed(hit_times), reversed(miss_rates)):
+        amat = hit_time + (miss_rate / 100) * amat
+    return amat
+
+
+def l1_amat(l1d_cache, l1i_cache):
+    return hierarchy_amat([[l1d_cache, l1i_cache]], l1i_cache.miss_penalty)
+
+
+def l1_l2_amat(l1d_cache, l1i_cache, l2_cache):
+    return hierarchy_amat([[l1d_cache, l1i_cache], [l2_cache]], l2_cache.miss_penalty)
+
+
+def simulate_l1_cache(l1d_cache, l1i_cache, trace, checkpoint_path=None, checkpoint_interval=CHECKPOINT_INTERVAL):
+    run_trace(l1d_cache, l1i_cache, trace, None, checkpoint_path, checkpoint_interval)
+    print_l1_stats(l1d_cache, l1i_cache)
+
+
+def print_l1_stats(l1d_cache, l1i_cache):
+    data_hit_rate = calculate_percentage(l1d_cache.access_hits, l1d_cache.access_total)
+    data_miss_rate = calculate_percentage(l1d_cache.access_misses, l1d_cache.access_total)
+    instruction_hit_rate = calculate_percentage(l1i_cache.access_hits, l1i_cache.access_total)
+    instruction_miss_rate = calculate_percentage(l1i_cache.access_misses, l1i_cache.access_total)
+    amat = l1_amat(l1d_cache, l1i_cache)
+    levels = [[l1d_cache, l1i_cache]]
+    traffic = memory_traffic(levels)
+    bandwidth = effective_bandwidth(levels, l1i_cache.miss_penalty)
+
+    # print(f"L1 Data Hits: {l1d_cache.access_hits} ({data_hit_rate:.2f}) Total: {l1d_cache.access_total}")
+    # print(f"L1 Data Misses: {l1d_cache.access_misses} ({data_miss_rate:.2f})")
+    # print(
+    #     f"L1 Instruction Hits: {l1i_cache.access_hits} ({instruction_hit_rate:.2f}) Total: {l1i_cache.access_total}")
+    # print(f"L1 Instruction Misses: {l1i_cache.access_misses} ({instruction_miss_rate:.2f})")
+    # print(f"AMAT: {amat:.2f}\n")
+
+    print(f"|{l1i_cache.set_associativity:15}|{l1i_cache.access_total:15}|{l1i_cache.access_misses:15}|{instruction_hit_rate:14.2f}%|{l1d_cache.access_total:15}|{l1d_cache.access_misses:15}|{data_hit_rate:14.2f}%|{amat:15.2f}|{traffic:15}|{bandwidth:15.2f}|")
+    print("|" + ('-' * 15 + "|")*10)
+
+
+def simulate_l1_l2_cache(l1d_cache, l1i_cache, l2_cache, trace, stats, checkpoint_path=None,
+                         checkpoint_interval=CHECKPOINT_INTERVAL):
+    run_trace(l1d_cache, l1i_cache, trace, l2_cache, checkpoint_path, checkpoint_interval)
+    print_l1_l2_stats(l1d_cache, l1i_cache, l2_cache, stats)
+
+
+def print_l1_l2_stats(l1d_cache, l1i_cache, l2_cache, stats):
+    l1d_hit_rate = calculate_percentage(l1d_cache.access_hits, l1d_cache.access_total)
+    l1d_miss_rate = calculate_percentage(l1d_cache.access_misses, l1d_cache.access_total)
+    l1i_hit_rate = calculate_percentage(l1i_cache.access_hits, l1i_cache.access_total)
+    l1i_miss_rate = calculate_percentage(l1i_cache.access_misses, l1i_cache.access_total)
+    l2_hit_rate = calculate_percentage(l2_cache.access_hits, l2_cache.access_total)
+    amat = l1_l2_amat(l1d_cache, l1i_cache, l2_cache)
+    levels = [[l1d_cache, l1i_cache], [l2_cache]]
+    traffic = memory_traffic(levels)
+    bandwidth = effective_bandwidth(levels, l2_cache.miss_penalty)
+
+    # print(f"L1 Data Hits: {l1d_cache.access_hits} ({l1d_hit_rate:.2f}) Total: {l1d_cache.access_total}")
+    # print(f"L1 Data Misses: {l1d_cache.access_misses} ({l1d_miss_rate:.2f})")
+    # print(f"L1 Instruction Hits: {l1i_cache.access_hits} ({l1i_hit_rate:.2f}) Total: {l1i_cache.access_total}")
+    # print(f"L1 Instruction Misses: {l1i_cache.access_misses} ({l1i_miss_rate:.2f})")
+    # print(f"L2 Hits: {l2_cache.access_hits} ({l2_hit_rate:.2f}) Total: {l2_cache.access_total}")
+    # print(f"L2 Misses: {l2_cache.access_misses} ({l2_miss_rate:.2f})")
+    # print(f"AMAT: {amat:.2f}\n")
+    print(f"|{l2_cache.set_associativity:13}|{l1i_cache.access_total:13}|{l1i_cache.access_misses:13}|{l1i_hit_rate:12.2f}%|{l1d_cache.access_total:13}|{l1d_cache.access_misses:13}|{l1d_hit_rate:12.2f}%|{l2_cache.access_total:13}|{l2_cache.access_misses:13}|{l2_hit_rate:12.2f}%|{amat:13.2f}|{traffic:13}|{bandwidth:13.2f}|")
+    print("|"+('-' * 13 + "|")*13)
+    if (stats != None):
+        stats[0].append(l1i_hit_rate)
+        stats[1].append(l1d_hit_rate)
+        stats[2].append(l2_hit_rate)
+        stats[3].append(amat)
+
+
+# Events passed between hierarchy levels. READ and WRITE are demand accesses (a READ
+# below L1 is a block fetch), WRITEBACK carries a dirty victim down and VICTIM a clean
+# one. INVALIDATE drops a block the level above just filled without fetching it (from a
+# writeback or a victim). VICTIM and INVALIDATE only matter to exclusive levels.
+EVENT_READ = 0
+EVENT_WRITE = 1
+EVENT_WRITEBACK = 3
+EVENT_VICTIM = 4
+EVENT_INVALIDATE = 5
+
+HIERARCHY_POLICIES = ("inclusive", "exclusive", "non-inclusive")
+
+
+class HierarchyLevel(CacheBase):
+    # A write-back, write-allocate cache that handles the events of the level above (or of
+    # the trace) and sends the events they cause to next_cache. policy is this level's
+    # relation to the levels above it: "non-inclusive" fills on every miss, "inclusive"
+    # also back-invalidates their copies of its victims (done by CacheHierarchy),
+    # "exclusive" only holds victims of the level above and hands blocks up on a hit.
+    # Accesses are counted like WriteBackCache counts them: a write or writeback that
+    # misses is a hit unless it waits for a dirty victim to go to memory (last_level),
+    # and a writeback smaller than the block fetches the rest of it first.
+    def __init__(self, name, total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty,
+                 policy="non-inclusive", replacement_policy="lru"):
+        super().__init__(total_size_bytes, block_size_bytes, set_associativity, hit_time, miss_penalty, None,
+                         replacement_policy)
+        if policy not in HIERARCHY_POLICIES:
+            raise ValueError(f"Unknown inclusion policy: {policy}")
+        self.name = name
+        self.policy = policy
+        self.writebacks = 0
+        self.invalidations = 0
+        # set by CacheHierarchy: the block size of the writebacks this level receives, and
+        # whether memory is right below it
+        self.upper_block_size = block_size_bytes
+        self.last_level = False
+        # set when the level below is exclusive (in a variant sweep, when it may be): it is
+        # sent clean victims and invalidations. Clean victims count as traffic unless
+        # count_clean_victims is off, then their bytes go to clean_victim_bytes instead.
+        self.exclusive_below = False
+        self.count_clean_victims = True
+        self.clean_victim_bytes = 0
+        # exclusive: blocks handed up while dirty, so their clean-looking victim comes back dirty
+        self.dirty_above = set()
+        # set by CacheHierarchy on an inclusive level: (block_addr, dirty) of the victims
+        # the current access evicted, until they are back-invalidated
+        self.evictions = None
+        # exclusive below a split level: its two halves, a block may be cached in both
+        self.split_above = None
+        # set by simulate_hierarchy_variants on recorded halves above an exclusive variant:
+        # fill/evict history of the current batch, which the variants run after the fact
+        self.residency = None
+        self.resident_at_start = None
+
+    def handle(self, kind, address, position):
+        # Process one event of the access at `position`, passing what it causes on to
+        # next_cache (None for memory) right away
+        block_size = self.block_size_bytes
+        # find_set_and_block, inlined
+        block_addr = address // block_size
+        set_index = block_addr % self.num_sets
+        line = self.cache[set_index].get(block_addr)
+        exclusive = self.policy == "exclusive"
+
+        if kind == EVENT_INVALIDATE:
+            if not exclusive:
+                return
+            if line is not None:
+                self._invalidate(set_index, block_addr)
+                self.invalidations += 1
+                self.dirty_above.discard(block_addr)
+                if self.residency is not None:
+                    self._log(block_addr, position, False)
+            elif self.exclusive_below:
+                self.next_cache.handle(EVENT_INVALIDATE, address, position)
+            return
+
+        if kind == EVENT_VICTIM or (exclusive and kind == EVENT_WRITEBACK):
+            if not exclusive:
+                return  # clean victims only matter to exclusive levels
+            if line is None and self.split_above is not None and any(
+                    cache.was_resident(block_addr, position) for cache in self.split_above):
+                # the other half still holds the block: drop a clean victim, pass a
+                # dirty one through
+                if kind == EVENT_WRITEBACK:
+                    self.writebacks += 1
+                    self.bytes_to_next_level += block_size
+                    if self.next_cache is not None:
+                        self.next_cache.handle(EVENT_WRITEBACK, address, position)
+                return
+            dirty = kind == EVENT_WRITEBACK or block_addr in self.dirty_above
+            self.dirty_above.discard(block_addr)
+            if line is None:
+                line = self._fill(set_index, block_addr, position)[0]
+                if self.exclusive_below:
+                    # a block passed through earlier may still be held below
+                    self.next_cache.handle(EVENT_INVALIDATE, address, position)
+            else:
+                self.replacement.touch(line)
+            if dirty:
+                self.dirty[line] = 1
+            return
+
+        self.access_total += 1
+        if line is not None:
+            self.access_hits += 1
+            if exclusive:
+                # the block moves up to the requesting level
+                if self._invalidate(set_index, block_addr):
+                    self.dirty_above.add(block_addr)
+                if self.residency is not None:
+                    self._log(block_addr, position, False)
+                return
+            if kind != EVENT_READ:
+                self.dirty[line] = 1
+            self.replacement.touch(line)
+            return
+
+        if exclusive:
+            # fetched for the level above, filled when that level evicts it
+            self.access_misses += 1
+            self.bytes_from_next_level += block_size
+            if self.next_cache is not None:
+                self.next_cache.handle(EVENT_READ, block_addr * block_size, position)
+            return
+        self._miss(kind, set_index, block_addr, position)
+
+    def _miss(self, kind, set_index, block_addr, position):
+        # A demand access or writeback that missed in a non-exclusive level (counted in
+        # access_total already): fetch the block unless a full-block writeback leaves
+        # nothing to fetch, and fill it
+        block_size = self.block_size_bytes
+        fetch = kind != EVENT_WRITEBACK or self.upper_block_size < block_size
+        if fetch:
+            self.bytes_from_next_level += block_size
+            if self.next_cache is not None:
+                self.next_cache.handle(EVENT_READ, block_addr * block_size, position)
+        line, evicted_dirty = self._fill(set_index, block_addr, position)
+        if kind == EVENT_READ:
+            self.access_misses += 1
+            return
+        self.dirty[line] = 1
+        if evicted_dirty and self.last_level:
+            self.access_misses += 1
+        else:
+            self.access_hits += 1
+        if not fetch and self.exclusive_below:
+            # an exclusive level below may still hold the copy this writeback replaces
+            self.next_cache.handle(EVENT_INVALIDATE, block_addr * block_size, position)
+
+    def _fill(self, set_index, block_addr, position):
+        # Returns the line and whether its victim was dirty
+        line, evicted_addr, evicted_dirty = self._allocate(set_index, block_addr)
+        if evicted_addr != -1:
+            if evicted_dirty:
+                self.writebacks += 1
+                self.bytes_to_next_level += self.block_size_bytes
+                if self.next_cache is not None:
+                    self.next_cache.handle(EVENT_WRITEBACK, evicted_addr * self.block_size_bytes, position)
+            elif self.exclusive_below:
+                if self.count_clean_victims:
+                    self.bytes_to_next_level += self.block_size_bytes
+                else:
+                    self.clean_victim_bytes += self.block_size_bytes
+                self.next_cache.handle(EVENT_VICTIM, evicted_addr * self.block_size_bytes, position)
+            if self.evictions is not None:
+                self.evictions.append((evicted_addr, evicted_dirty))
+            if self.residency is not None:
+                self._log(evicted_addr, position, False)
+        if self.residency is not None:
+            self._log(block_addr, position, True)
+        return line, evicted_dirty
+
+    def _log(self, block_addr, position, present):
+        history = self.residency.get(block_addr)
+        if history is None:
+            history = self.residency[block_addr] = ([], [])
+        history[0].append(position)
+        history[1].append(present)
+
+    def start_batch(self):
+        if self.residency is not None:
+            self.residency = {}
+            self.resident_at_start = set(self.tags)
+
+    def was_resident(self, block_addr, position):
+        # whether block_addr was cached once every event up to `position` was processed
+        if self.residency is None:
+            # run access by access with the level below: that is now
+            return block_addr in self.cache[block_addr % self.num_sets]
+        history = self.residency.get(block_addr)
+        if history is not None:
+            i = bisect.bisect_right(history[0], position)
+            if i:
+                return history[1][i - 1]
+        return block_addr in self.resident_at_start
+
+
+class CacheHierarchy:
+    # An L1/L2/L3... stack built from declarative level specs, e.g.
+    #   [{"name": "L1", "total_size_bytes": 1024, "block_size_bytes": 32, "set_associativity": 2,
+    #     "hit_time": 1, "split": True},
+    #    {"name": "L2", "total_size_bytes": 16384, "block_size_bytes": 128, "set_associativity": 8,
+    #     "hit_time": 10, "policy": "inclusive"}]
+    # "replacement" optionally names a REPLACEMENT_POLICIES entry (LRU by default).
+    # Only the first level may be split into instruction/data caches. Each access goes
+    # through every level it reaches before the next one starts, and the victims an
+    # inclusive level took during it are back-invalidated right after, so the levels
+    # above never see a block their inclusive level below no longer holds.
+    def __init__(self, levels, miss_penalty=None, upstream_block_size=None):
+        # upstream_block_size: block size of recorded levels feeding this stack (see
+        # simulate_hierarchy_variants), None when the first level takes the trace
+        if miss_penalty is None:
+            miss_penalty = MISS_PENALTY
+        if not levels:
+            raise ValueError("A cache hierarchy needs at least one level")
+        self.miss_penalty = miss_penalty
+        self.levels = []
+        for depth, spec in enumerate(levels):
+            spec = dict(spec)
+            name = spec.pop("name", f"L{depth + 1}")
+            split = spec.pop("split", False)
+            policy = spec.pop("policy", "non-inclusive")
+            replacement_policy = spec.pop("replacement", "lru")
+            if split and (depth or upstream_block_size is not None):
+                raise ValueError(f"Only the first level can be split, not {name}")
+            args = (spec["total_size_bytes"], spec["block_size_bytes"], spec["set_associativity"],
+                    spec["hit_time"], miss_penalty)
+            if split:
+                caches = [HierarchyLevel(f"{name}D", *args, policy, replacement_policy),
+                          HierarchyLevel(f"{name}I", *args, policy, replacement_policy)]
+            else:
+                caches = [HierarchyLevel(name, *args, policy, replacement_policy)]
+            self.levels.append(caches)
+
+        for depth, caches in enumerate(self.levels):
+            lower = caches[0]
+            if upstream_block_size is not None and lower.policy == "inclusive":
+                raise ValueError(f"{lower.name} cannot back-invalidate recorded upper levels")
+            if depth == 0:
+                if upstream_block_size is None:
+                    if lower.policy != "non-inclusive":
+                        raise ValueError(f"{lower.name} has no level above it to be {lower.policy} of")
+                    continue
+                upper_block_size = upstream_block_size
+            else:
+                upper_block_size = self.levels[depth - 1][0].block_size_bytes
+            lower.upper_block_size = upper_block_size
+            if lower.policy == "exclusive":
+                if lower.block_size_bytes != upper_block_size:
+                    raise ValueError(f"Exclusive {lower.name} needs the block size of the level above")
+                if depth:
+                    for cache in self.levels[depth - 1]:
+                        cache.exclusive_below = True
+                    if len(self.levels[depth - 1]) == 2:
+                        lower.split_above = self.levels[depth - 1]
+            elif lower.policy == "inclusive":
+                if lower.block_size_bytes % upper_block_size:
+                    raise ValueError(f"Inclusive {lower.name} needs a multiple of the block size above")
+                lower.evictions = []
+        for caches, below in zip(self.levels, self.levels[1:]):
+            for cache in caches:
+                cache.next_cache = below[0]
+        for cache in self.levels[-1]:
+            cache.last_level = True
+        self.inclusive_depths = [depth for depth, caches in enumerate(self.levels) if caches[0].evictions is not None]
+        self.inclusive_levels = [self.levels[depth][0] for depth in self.inclusive_depths]
+        self.position = 0
+
+    def caches(self):
+        return [cache for caches in self.levels for cache in caches]
+
+    def run(self, trace):
+        for access_types, addresses in trace.iter_batches():
+            self.run_batch(access_types, addresses)
+        return self
+
+    def run_batch(self, access_types, addresses):
+        self._run_accesses(access_types.tolist(), addresses.tolist())
+
+    def _run_accesses(self, access_types, addresses):
+        data_cache = self.levels[0][0]
+        instruction_cache = self.levels[0][-1]
+        block_size = data_cache.block_size_bytes
+        num_sets = data_cache.num_sets
+        inclusive_levels = self.inclusive_levels
+        position = self.position
+        instruction_accesses = access_types.count(2)
+        data_cache.access_total += len(access_types) - instruction_accesses
+        instruction_cache.access_total += instruction_accesses
+        for access_type, address in zip(access_types, addresses):
+            # HierarchyLevel.handle for the first level, inlined: it only takes demand
+            # accesses and is never exclusive
+            cache = instruction_cache if access_type == 2 else data_cache
+            block_addr = address // block_size
+            set_index = block_addr % num_sets
+            line = cache.cache[set_index].get(block_addr)
+            if line is not None:
+                cache.access_hits += 1
+                if access_type == EVENT_WRITE:
+                    cache.dirty[line] = 1
+                cache.replacement.touch(line)
+            else:
+                cache._miss(EVENT_READ if access_type == 2 else access_type, set_index, block_addr, position)
+                for level in inclusive_levels:
+                    if level.evictions:
+                        self._back_invalidate(position)
+                        break
+            position += 1
+        self.position = position
+
+    def _run_events(self, events):
+        # events recorded below other levels, see simulate_hierarchy_variants (a stack
+        # fed that way has no inclusive level)
+        handle = self.levels[0][0].handle
+        for kind, address, position in events:
+            handle(kind, address, position)
+
+    def _upper_blocks(self, depth, block_addr, upper):
+        ratio = self.levels[depth][0].block_size_bytes // upper.block_size_bytes
+        return range(block_addr * ratio, (block_addr + 1) * ratio)
+
+    def caches_above(self, depth):
+        return [cache for caches in self.levels[:depth] for cache in caches]
+
+    def _back_invalidate(self, position):
+        # drop upper copies of every block an inclusive level evicted during the access at
+        # `position`; a dirty copy whose victim went down clean still has to be written back
+        progress = True
+        while progress:
+            progress = False
+            for depth in self.inclusive_depths:
+                lower = self.levels[depth][0]
+                evictions = lower.evictions
+                if not evictions:
+                    continue
+                lower.evictions = []
+                progress = True
+                uppers = self.caches_above(depth)
+                for block_addr, evicted_dirty in evictions:
+                    dirty_above = False
+                    for upper in uppers:
+                        for upper_block in self._upper_blocks(depth, block_addr, upper):
+                            set_index = upper_block % upper.num_sets
+                            if upper_block in upper.cache[set_index]:
+                                dirty_above = upper._invalidate(set_index, upper_block) or dirty_above
+                                upper.invalidations += 1
+                    if dirty_above and not evicted_dirty:
+                        line = lower.cache[block_addr % lower.num_sets].get(block_addr)
+                        if line is not None:
+                            # a writeback of the same access filled the block again,
+                            # the dirty data stays in that line
+                            lower.dirty[line] = 1
+                            continue
+                        lower.writebacks += 1
+                        lower.bytes_to_next_level += lower.block_size_bytes
+                        if lower.next_cache is not None:
+                            lower.next_cache.handle(EVENT_WRITEBACK, block_addr * lower.block_size_bytes, position)
+
+    def results(self):
+        return self.caches()
+
+    def amat(self):
+        return hierarchy_amat(self.levels, self.miss_penalty)
+
+
+def hierarchy_amat(levels, miss_penalty):
+    # levels: caches of each level, top first; a split level uses its combined miss rate
+    hit_times = []
+    miss_rates = []
+    for caches in levels:
+        hit_times.append(caches[-1].hit_time)
+        miss_rates.append(calculate_percentage(sum(cache.access_misses for cache in caches),
+                                               sum(cache.access_total for cache in caches)))
+    return calculate_amat(hit_times, miss_rates, miss_penalty)
+
+
+def memory_traffic(levels):
+    # bytes moved between the last level of `levels` and memory
+    return sum(cache.bytes_from_next_level + cache.bytes_to_next_level for cache in levels[-1])
+
+
+def effective_bandwidth(levels, miss_penalty):
+    # memory traffic per cycle, taking every access of the first level to cost the AMAT
+    cycles = hierarchy_amat(levels, miss_penalty) * sum(cache.access_total for cache in levels[0])
+    if cycles == 0:
+        return 0
+    return memory_traffic(levels) / cycles
+
+
+def simulate_hierarchy_variants(upper_levels, variants, trace, miss_penalty=None):
+    # Run upper_levels over the trace once, record the stream leaving them, and evaluate
+    # every lower stack in `variants` (lists of level specs) on that stream alone.
+    # Returns the upper CacheHierarchy and one lower CacheHierarchy per variant; AMAT of
+    # a combination is hierarchy_amat(upper.levels + lower.levels, miss_penalty).
+    # Neither the upper levels nor the variants can be inclusive: the variants could not
+    # back-invalidate the recorded levels. Clean victims of the upper levels only reach
+    # variants that start with an exclusive level. When some variants do and others do
+    # not, their bytes are kept out of the upper caches' bytes_to_next_level and in
+    # clean_victim_bytes, to be added for the exclusive variants.
+    upper = CacheHierarchy(upper_levels, miss_penalty)
+    if upper.inclusive_depths:
+        raise ValueError("Upper levels of a variant sweep cannot be inclusive")
+    lowers = [CacheHierarchy(variant, upper.miss_penalty, upper.levels[-1][0].block_size_bytes)
+              for variant in variants]
+    exclusive = [lower.levels[0][0].policy == "exclusive" for lower in lowers]
+    for cache in upper.levels[-1]:
+        cache.last_level = False
+        cache.exclusive_below = any(exclusive)
+        cache.count_clean_victims = all(exclusive)
+    logged = []
+    if len(upper.levels[-1]) == 2 and any(exclusive):
+        # the variants run after the upper levels took the whole batch
+        logged = upper.levels[-1]
+        for cache in logged:
+            cache.residency = {}
+        for lower in lowers:
+            if lower.levels[0][0].policy == "exclusive":
+                lower.levels[0][0].split_above = logged
+    recorder = _EventRecorder()
+    for cache in upper.levels[-1]:
+        cache.next_cache = recorder
+    for access_types, addresses in trace.iter_batches():
+        for cache in logged:
+            cache.start_batch()
+        recorder.events = []
+        upper._run_accesses(access_types.tolist(), addresses.tolist())
+        for lower in lowers:
+            lower._run_events(recorder.events)
+    return upper, lowers
+
+
+class _EventRecorder:
+    # Stands in for the levels below the upper ones of simulate_hierarchy_variants
+    def __init__(self):
+        self.events = []
+
+    def handle(self, kind, address, position):
+        self.events.append((kind, address, position))
+
+
+def print_hierarchy_stats(levels, miss_penalty):
+    print("|" + ('-' * 13 + "|")*8)
+    print(f'|{"Level":13}|{"Policy":13}|{"Accesses":13}|{"Misses":13}|{"Hit rate":13}|{"Writebacks":13}|{"Invalidated":13}|{"Bytes below":13}|')
+    print("|" + ('-' * 13 + "|")*8)
+    for caches in levels:
+        for cache in caches:
+            hit_rate = calculate_percentage(cache.access_hits, cache.access_total)
+            traffic = cache.bytes_from_next_level + cache.bytes_to_next_level
+            print(f"|{cache.name:13}|{cache.policy:13}|{cache.access_total:13}|{cache.access_misses:13}|{hit_rate:12.2f}%|{cache.writebacks:13}|{cache.invalidations:13}|{traffic:13}|")
+    print("|" + ('-' * 13 + "|")*8)
+    print(f"AMAT: {hierarchy_amat(levels, miss_penalty):.2f}")
+    print(f"Memory traffic: {memory_traffic(levels)} bytes ({effective_bandwidth(levels, miss_penalty):.2f} bytes/cycle)")
+
+
+def simulate_hierarchy(levels, trace, miss_penalty=None):
+    hierarchy = CacheHierarchy(levels, miss_penalty).run(trace)
+    print_hierarchy_stats(hierarchy.levels, hierarchy.miss_penalty)
+    return hierarchy
+
+
+def interleave_traces(traces, timestamps=None, batch_size=TRACE_BATCH_SIZE):
+    # Merge one loaded Trace per core into (core, access type, address) array batches.
+    # Without timestamps the cores take turns, one access each, and a core drops out when
+    # its trace ends. With timestamps (one array per trace, see read_trace_timestamps)
+    # accesses are ordered by timestamp, the lower core first on ties.
+    arrays = [trace.as_arrays() for trace in traces]
+    if timestamps is None:
+        per_core = max(1, batch_size // len(arrays))
+        length = max(len(access_types) for access_types, _ in arrays)
+        for start in range(0, length, per_core):
+            slices = [(access_types[start:start + per_core], addresses[start:start + per_core])
+                      for access_types, addresses in arrays]
+            # stable sort on the position within the round keeps the cores in order
+            order = np.argsort(np.concatenate([np.arange(len(access_types)) for access_types, _ in slices]),
+                               kind="stable")
+            yield (_core_ids(slices)[order], np.concatenate([access_types for access_types, _ in slices])[order],
+                   np.concatenate([addresses for _, addresses in slices])[order])
+        return
+
+    if len(timestamps) != len(arrays):
+        raise ValueError(f"{len(timestamps)} timestamp arrays for {len(arrays)} traces")
+    for trace, trace_timestamps in zip(traces, timestamps):
+        if len(trace_timestamps) != len(trace):
+            raise ValueError(f"{trace.source_path} has {len(trace_timestamps)} timestamps for {len(trace)} accesses")
+        if np.any(trace_timestamps[1:] < trace_timestamps[:-1]):
+            raise ValueError(f"The timestamps of {trace.source_path} go backwards")
+    # the traces are concatenated in core order, so a stable sort breaks ties by core
+    order = np.argsort(np.concatenate(timestamps), kind="stable")
+    cores = _core_ids(arrays)[order]
+    access_types = np.concatenate([access_types for access_types, _ in arrays])[order]
+    addresses = np.concatenate([addresses for _, addresses in arrays])[order]
+    for start in range(0, len(order), batch_size):
+        yield (cores[start:start + batch_size], access_types[start:start + batch_size],
+               addresses[start:start + batch_size])
+
+
+def _core_ids(arrays):
+    # the core of each access when the per-core arrays are concatenated
+    return np.concatenate([np.full(len(access_types), core, dtype=np.uint32)
+                           for core, (access_types, _) in enumerate(arrays)])
+
+
+class CorePort:
+    # One core's view of a SharedCache: the core's L1 caches send their misses and
+    # writebacks here, which serves them as that core and keeps the core's share of the
+    # shared cache counters, laid out like the CacheBase ones.
+    def __init__(self, shared_cache, core):
+        self.shared_cache = shared_cache
+        self.core = core
+        self.next_cache = shared_cache.next_cache
+        self.hit_time = shared_cache.hit_time
+        self.miss_penalty = shared_cache.miss_penalty
+
+        self.access_hits = 0
+        self.access_misses = 0
+        self.access_total = 0
+        self.bytes_from_next_level = 0
+        self.bytes_to_next_level = 0
+
+    def read_from_cache(self, address, next_level_cache):
+        self._serve(self.shared_cache.read_from_cache, address, next_level_cache)
+
+    def write_to_cache(self, address, write_flag, next_level_cache, size_bytes=WRITE_SIZE_BYTES):
+        self._serve(self.shared_cache.write_to_cache, address, write_flag, next_level_cache, size_bytes)
+
+    def _serve(self, access, *args):
+        cache = self.shared_cache
+        cache.core = self.core
+        counters = cache._counters()
+        access(*args)
+        self.access_hits += cache.access_hits - counters[0]
+        self.access_misses += cache.access_misses - counters[1]
+        self.access_total += cache.access_total - counters[2]
+        self.bytes_from_next_level += cache.bytes_from_next_level - counters[3]
+        self.bytes_to_next_level += cache.bytes_to_next_level - counters[4]
+
+
+class MultiCoreSystem:
+    # num_cores cores, each with private l1_class data and instruction caches of l1_config,
+    # sharing one SharedCache L2 of l2_config; configs are (total_size_bytes,
+    # block_size_bytes, set_associativity). Each access is dispatched by indexing the
+    # per-core caches with its core, so its cost does not grow with the number of cores.
+    def __init__(self, num_cores, l1_config, l2_config, l1_class=WriteBackCache, replacement_policy="lru",
+                 l1_hit_time=None, l2_hit_time=None, miss_penalty=None):
+        if num_cores < 1:
+            raise ValueError("A multi-core system needs at least one core")
+        if l1_hit_time is None:
+            l1_hit_time = L1_HIT_TIME
+        if l2_hit_time is None:
+            l2_hit_time = L2_HIT_TIME
+        if miss_penalty is None:
+            miss_penalty = MISS_PENALTY
+        self.num_cores = num_cores
+        self.miss_penalty = miss_penalty
+        self.l2_cache = SharedCache(*l2_config, l2_hit_time, miss_penalty, None, num_cores, replacement_policy)
+        self.ports = [CorePort(self.l2_cache, core) for core in range(num_cores)]
+        self.l1d_caches = [l1_class(*l1_config, l1_hit_time, miss_penalty, port, replacement_policy)
+                           for port in self.ports]
+        self.l1i_caches = [l1_class(*l1_config, l1_hit_time, miss_penalty, port, replacement_policy)
+                           for port in self.ports]
+        self.position = 0
+
+    def run(self, traces, timestamps=None):
+        # traces: one loaded Trace per core, interleaved by interleave_traces
+        if len(traces) != self.num_cores:
+            raise ValueError(f"{len(traces)} traces for {self.num_cores} cores")
+        for cores, access_types, addresses in interleave_traces(traces, timestamps):
+            self.run_batch(cores, access_types, addresses)
+        for l1d_cache, l1i_cache, port in zip(self.l1d_caches, self.l1i_caches, self.ports):
+            l1d_cache.drain_write_buffer(port)
+            l1i_cache.drain_write_buffer(port)
+        return self
+
+    def run_batch(self, cores, access_types, addresses):
+        l1d_caches = self.l1d_caches
+        l1i_caches = self.l1i_caches
+        ports = self.ports
+        for core, memory_access_type, address in zip(cores.tolist(), access_types.tolist(), addresses.tolist()):
+            if memory_access_type == 0:
+                l1d_caches[core].read_from_cache(address, next_level_cache=ports[core])
+            elif memory_access_type == 1:
+                l1d_caches[core].write_to_cache(address, write_flag=True, next_level_cache=ports[core])
+            elif memory_access_type == 2:
+                l1i_caches[core].read_from_cache(address, next_level_cache=ports[core])
+        self.position += len(cores)
+
+    def core_levels(self, core):
+        # the caches of one core, its share of the L2 standing in for the L2
+        return [[self.l1d_caches[core], self.l1i_caches[core]], [self.ports[core]]]
+
+    def levels(self):
+        return [self.l1d_caches + self.l1i_caches, [self.l2_cache]]
+
+    def amat(self, core=None):
+        # of one core, or of every access of every core
+        levels = self.levels() if core is None else self.core_levels(core)
+        return hierarchy_amat(levels, self.miss_penalty)
+
+    def inter_core_evictions(self):
+        return sum(map(sum, self.l2_cache.inter_core_evictions))
+
+
+def print_multicore_stats(system):
+    print("|" + ('-' * 13 + "|")*10)
+    print(f'|{"Core":13}|{"L1I accesses":13}|{"L1I hit rate":13}|{"L1D accesses":13}|{"L1D hit rate":13}|{"L2 accesses":13}|{"L2 hit rate":13}|{"AMAT":13}|{"Lost to other":13}|{"Evicted other":13}|')
+    print("|" + ('-' * 13 + "|")*10)
+    for core in range(system.num_cores):
+        (l1d_cache, l1i_cache), (port,) = system.core_levels(core)
         l1i_hit_rate = calculate_percentage(l1i_cache.access_hits, l1i_cache.access_total)
-        l1i_miss_rate = calculate_percentage(l1i_cache.access_misses, l1i_cache.access_total)
-        l1_total_miss_rate = calculate_percentage(l1d_cache.access_misses + l1i_cache.access_misses,
-                                                  l1d_cache.access_total + l1i_cache.access_total)
-        l2_hit_rate = calculate_percentage(l2_cache.access_hits, l2_cache.access_total)
-        l2_miss_rate = calculate_percentage(l2_cache.access_misses, l2_cache.access_total)
-        amat = l1i_cache.hit_time + (l1_total_miss_rate / 100) * (
-                    l2_cache.hit_time + (l2_miss_rate / 100) * l2_cache.miss_penalty)
-
-        # print(f"L1 Data Hits: {l1d_cache.access_hits} ({l1d_hit_rate:.2f}) Total: {l1d_cache.access_total}")
-        # print(f"L1 Data Misses: {l1d_cache.access_misses} ({l1d_miss_rate:.2f})")
-        # print(f"L1 Instruction Hits: {l1i_cache.access_hits} ({l1i_hit_rate:.2f}) Total: {l1i_cache.access_total}")
-        # print(f"L1 Instruction Misses: {l1i_cache.access_misses} ({l1i_miss_rate:.2f})")
-        # print(f"L2 Hits: {l2_cache.access_hits} ({l2_hit_rate:.2f}) Total: {l2_cache.access_total}")
-        # print(f"L2 Misses: {l2_cache.access_misses} ({l2_miss_rate:.2f})")
-        # print(f"AMAT: {amat:.2f}\n")
-        print(f"|{l2_cache.set_associativity:13}|{l1i_cache.access_total:13}|{l1i_cache.access_misses:13}|{l1i_hit_rate:12.2f}%|{l1d_cache.access_total:13}|{l1d_cache.access_misses:13}|{l1d_hit_rate:12.2f}%|{l2_cache.access_total:13}|{l2_cache.access_misses:13}|{l2_hit_rate:12.2f}%|{amat:13.2f}|")
-        print("|"+('-' * 13 + "|")*11)
-        if (stats != None):
-            stats[0].append(l1i_hit_rate)
-            stats[1].append(l1d_hit_rate)
-            stats[2].append(l2_hit_rate)
-            stats[3].append(amat)
-
-def simulate_cache(cache_type, trace_file_path):
+        l1d_hit_rate = calculate_percentage(l1d_cache.access_hits, l1d_cache.access_total)
+        l2_hit_rate = calculate_percentage(port.access_hits, port.access_total)
+        print(f"|{core:13}|{l1i_cache.access_total:13}|{l1i_hit_rate:12.2f}%|{l1d_cache.access_total:13}|{l1d_hit_rate:12.2f}%|{port.access_total:13}|{l2_hit_rate:12.2f}%|{system.amat(core):13.2f}|{system.l2_cache.evicted_by_other_cores(core):13}|{system.l2_cache.evicted_other_cores(core):13}|")
+    print("|" + ('-' * 13 + "|")*10)
+    l1i_accesses = sum(cache.access_total for cache in system.l1i_caches)
+    l1d_accesses = sum(cache.access_total for cache in system.l1d_caches)
+    l1i_hit_rate = calculate_percentage(sum(cache.access_hits for cache in system.l1i_caches), l1i_accesses)
+    l1d_hit_rate = calculate_percentage(sum(cache.access_hits for cache in system.l1d_caches), l1d_accesses)
+    l2_cache = system.l2_cache
+    l2_hit_rate = calculate_percentage(l2_cache.access_hits, l2_cache.access_total)
+    evictions = system.inter_core_evictions()
+    print(f"|{'All':13}|{l1i_accesses:13}|{l1i_hit_rate:12.2f}%|{l1d_accesses:13}|{l1d_hit_rate:12.2f}%|{l2_cache.access_total:13}|{l2_hit_rate:12.2f}%|{system.amat():13.2f}|{evictions:13}|{evictions:13}|")
+    print("|" + ('-' * 13 + "|")*10)
+    levels = system.levels()
+    print(f"Memory traffic: {memory_traffic(levels)} bytes "
+          f"({effective_bandwidth(levels, system.miss_penalty):.2f} bytes/cycle)")
+
+
+def simulate_multicore(traces, l1_config, l2_config, timestamps=None, **options):
+    # options: the MultiCoreSystem keyword arguments
+    system = MultiCoreSystem(len(traces), l1_config, l2_config, **options).run(traces, timestamps)
+    print_multicore_stats(system)
+    return system
+
+
+L1_HIT_TIME = 1
+L2_HIT_TIME = 10
+MISS_PENALTY = 100
+
+DEFAULT_RESULT_STORE = os.path.join(os.path.expanduser("~"), ".cache_sim", "results.sqlite")
+# Part of every result store key: bump it whenever a change alters the counters a point
+# simulates to, so results stored by older versions are not reused
+SIMULATOR_VERSION = 2
+
+
+class SweepSection:
+    # One table of a simulation part. kind "l1" points are L1 configs
+    # (total_size_bytes, block_size_bytes, set_associativity); kind "l1_l2" points are
+    # (l1_config, l2_config) pairs of those. x_values/x_label/plot_title: plotted sweeps.
+    def __init__(self, title, kind, points, cache_class=WriteBackCache, x_values=None, x_label=None,
+                 plot_title=None):
+        self.title = title
+        self.kind = kind
+        self.points = points
+        self.cache_class = cache_class
+        self.x_values = x_values
+        self.x_label = x_label
+        self.plot_title = plot_title
+
+
+def sweep_sections(cache_type):
     cache_sizes = [1024, 16384]
     block_sizes = [32, 128]
     associativities = [1, 2, 4, 8, 16, 32]
@@ -237,119 +2433,530 @@ def simulate_cache(cache_type, trace_file_path):
     l1_block_sizes = [8, 16, 32, 64, 128]
     l2_cache_sizes = [4096, 8192, 16384, 32768, 65536]
 
-    l1_hit = 1
-    l2_hit = 10
-    miss_penalty = 100
+    l1_config = (cache_sizes[0], block_sizes[0], 2)
+    l2_config = (cache_sizes[1], block_sizes[1], 8)
 
     if cache_type == "Part2-WriteThrough":
-        print(f"******{cache_type}******")
-        print("|" + ('-' * 15 + "|")*8)
-        print(f'|{"Assoc. Level":15}|{"L1I accesses":15}|{"L1I misses":15}|{"L1I hit rate":15}|{"L1D accesses":15}|{"L1D misses":15}|{"L1D hit rate":15}|{"AMAT":15}|')
-        print("|" + ('-' * 15 + "|")*8)
-        for cache_associativity in associativities:
-            l1d_cache = WriteThroughCache(cache_sizes[0], block_sizes[0], cache_associativity, l1_hit, miss_penalty,None)
-            l1i_cache = WriteThroughCache(cache_sizes[0], block_sizes[0], cache_associativity, l1_hit, miss_penalty, None)
-            # print(f"****Instruction: {l1i_cache.access_hits}, Data: {l1d_cache.access_hits}")
-            simulate_l1_cache(l1d_cache, l1i_cache, trace_file_path)
-            # print(f"****Instruction: {l1i_cache.access_hits}, Data: {l1d_cache.access_hits}")
+        points = [(cache_sizes[0], block_sizes[0], cache_associativity) for cache_associativity in associativities]
+        return [SweepSection(None, "l1", points, WriteThroughCache)]
     elif cache_type == "Part4-WriteBack":
-        print(f"******{cache_type}******")
-        print("|" + ('-' * 15 + "|")*8)
-        print(f'|{"Assoc. Level":15}|{"L1I accesses":15}|{"L1I misses":15}|{"L1I hit rate":15}|{"L1D accesses":15}|{"L1D misses":15}|{"L1D hit rate":15}|{"AMAT":15}|')
-        print("|" + ('-' * 15 + "|")*8)
-        for cache_associativity in associativities:
-            l1d_cache = WriteBackCache(cache_sizes[0], block_sizes[0], cache_associativity, l1_hit, miss_penalty, None)
-            l1i_cache = WriteBackCache(cache_sizes[0], block_sizes[0], cache_associativity, l1_hit, miss_penalty, None)
-            simulate_l1_cache(l1d_cache, l1i_cache, trace_file_path)
+        points = [(cache_sizes[0], block_sizes[0], cache_associativity) for cache_associativity in associativities]
+        return [SweepSection(None, "l1", points, WriteBackCache)]
     elif cache_type == "Part5-WriteBack with L2":
-        print(f"******{cache_type}******")
-        print("|"+('-' * 13 + "|")*11)
-        print(f'|{"Assoc. Level":13}|{"L1I accesses":13}|{"L1I misses":13}|{"L1I hit rate":13}|{"L1D accesses":13}|{"L1D misses":13}|{"L1D hit rate":13}|{"L2 accesses":13}|{"L2 misses":13}|{"L2 hit rate":13}|{"AMAT":13}|')
-        print("|"+('-' * 13 + "|")*11)
-        for cache_associativity in associativities_l2:
-            l2_cache = WriteBackCache(cache_sizes[1], block_sizes[1], cache_associativity, l2_hit, miss_penalty, None)
-            l1d_cache = WriteBackCache(cache_sizes[0], block_sizes[0], 2, l1_hit, miss_penalty, l2_cache)
-            l1i_cache = WriteBackCache(cache_sizes[0], block_sizes[0], 2, l1_hit, miss_penalty, l2_cache)
-            simulate_l1_l2_cache(l1d_cache, l1i_cache, l2_cache, trace_file_path, None)
+        points = [(l1_config, (cache_sizes[1], block_sizes[1], cache_associativity))
+                  for cache_associativity in associativities_l2]
+        return [SweepSection(None, "l1_l2", points)]
     elif cache_type == "Part6-Data Collection":
-        l1i_hit_rates = []
-        l1d_hit_rates = []
-        l2_hit_rates = []
-        amats = []
-        stats = [l1i_hit_rates, l1d_hit_rates, l2_hit_rates, amats]
-        print(f"******{cache_type}******")
-        print("****** Varying L1 cache size ****** ")
-        print("|"+('-' * 13 + "|")*11)
-        print(f'|{"Assoc. Level":13}|{"L1I accesses":13}|{"L1I misses":13}|{"L1I hit rate":13}|{"L1D accesses":13}|{"L1D misses":13}|{"L1D hit rate":13}|{"L2 accesses":13}|{"L2 misses":13}|{"L2 hit rate":13}|{"AMAT":13}|')
-        print("|"+('-' * 13 + "|")*11)
-        for cache_size in l1_cache_sizes:
-            l2_cache = WriteBackCache(cache_sizes[1], block_sizes[1], 8, l2_hit, miss_penalty, None)
-            l1d_cache = WriteBackCache(cache_size, block_sizes[0], 2, l1_hit, miss_penalty, l2_cache)
-            l1i_cache = WriteBackCache(cache_size, block_sizes[0], 2, l1_hit, miss_penalty, l2_cache)
-            simulate_l1_l2_cache(l1d_cache, l1i_cache, l2_cache, trace_file_path, stats)
-        
-        # Plotting L1 Cache Size variations
-        plt.plot(l1_cache_sizes, stats[0], marker='o', label='L1 Data Hit Rate')
-        plt.plot(l1_cache_sizes, stats[1], marker='o', label='L1 Instruction Hit Rate')
-        plt.plot(l1_cache_sizes, stats[2], marker='o', label='L2 Hit Rate')
-        plt.plot(l1_cache_sizes, stats[3], marker='o', label='AMAT')
-        plt.xlabel('L1 Cache Size (bytes)')
-        plt.ylabel('Percentage(%) or AMAT(cycle)')
-        plt.title('Cache Performance with Varying L1 Cache Size')
-        plt.legend()
-        plt.show()
-        #########################################################################################
-        l1i_hit_rates = []
-        l1d_hit_rates = []
-        l2_hit_rates = []
-        amats = []
-        stats = [l1i_hit_rates, l1d_hit_rates, l2_hit_rates, amats]
-        print("****** Varying L1 block size ****** ")
-        print("|"+('-' * 13 + "|")*11)
-        print(f'|{"Assoc. Level":13}|{"L1I accesses":13}|{"L1I misses":13}|{"L1I hit rate":13}|{"L1D accesses":13}|{"L1D misses":13}|{"L1D hit rate":13}|{"L2 accesses":13}|{"L2 misses":13}|{"L2 hit rate":13}|{"AMAT":13}|')
-        print("|"+('-' * 13 + "|")*11)
-        for block_size in l1_block_sizes:
-            l2_cache = WriteBackCache(cache_sizes[1], block_sizes[1], 8, l2_hit, miss_penalty, None)
-            l1d_cache = WriteBackCache(cache_sizes[0], block_size, 2, l1_hit, miss_penalty, l2_cache)
-            l1i_cache = WriteBackCache(cache_sizes[0], block_size, 2, l1_hit, miss_penalty, l2_cache)
-            simulate_l1_l2_cache(l1d_cache, l1i_cache, l2_cache, trace_file_path, stats)
-        # Plotting L1 Block Size variations
-        plt.plot(l1_block_sizes, stats[0], marker='o', label='L1 Data Hit Rate')
-        plt.plot(l1_block_sizes, stats[1], marker='o', label='L1 Instruction Hit Rate')
-        plt.plot(l1_block_sizes, stats[2], marker='o', label='L2 Hit Rate')
-        plt.plot(l1_block_sizes, stats[3], marker='o', label='AMAT')
-        plt.xlabel('L1 Block Size (bytes)')
-        plt.ylabel('Percentage(%) or AMAT(cycle)')
-        plt.title('Cache Performance with Varying L1 Block Size')
-        plt.legend()
-        plt.show()
-        #########################################################################################    
-        l1i_hit_rates = []
-        l1d_hit_rates = []
-        l2_hit_rates = []
-        amats = []
-        stats = [l1i_hit_rates, l1d_hit_rates, l2_hit_rates, amats]
-        print("****** Varying L2 cache size ****** ")
-        print("|"+('-' * 13 + "|")*11)
-        print(f'|{"Assoc. Level":13}|{"L1I accesses":13}|{"L1I misses":13}|{"L1I hit rate":13}|{"L1D accesses":13}|{"L1D misses":13}|{"L1D hit rate":13}|{"L2 accesses":13}|{"L2 misses":13}|{"L2 hit rate":13}|{"AMAT":13}|')
-        print("|"+('-' * 13 + "|")*11)
-        for cache_size in l2_cache_sizes:
-            l2_cache = WriteBackCache(cache_size, block_sizes[1], 8, l2_hit, miss_penalty, None)
-            l1d_cache = WriteBackCache(cache_sizes[0], block_sizes[0], 2, l1_hit, miss_penalty, l2_cache)
-            l1i_cache = WriteBackCache(cache_sizes[0], block_sizes[0], 2, l1_hit, miss_penalty, l2_cache)
-            simulate_l1_l2_cache(l1d_cache, l1i_cache, l2_cache, trace_file_path, stats)
-        # Plotting L2 Cache Size variations
-        plt.plot(l2_cache_sizes, stats[0], marker='o', label='L1 Data Hit Rate')
-        plt.plot(l2_cache_sizes, stats[1], marker='o', label='L1 Instruction Hit Rate')
-        plt.plot(l2_cache_sizes, stats[2], marker='o', label='L2 Hit Rate')
-        plt.plot(l2_cache_sizes, stats[3], marker='o', label='AMAT')
-        plt.xlabel('L2 Cache Size (bytes)')
-        plt.ylabel('Percentage(%) or AMAT(cycle)')
-        plt.title('Cache Performance with Varying L2 Cache Size')
-        plt.legend()
+        return [
+            SweepSection("****** Varying L1 cache size ****** ", "l1_l2",
+                         [((cache_size, block_sizes[0], 2), l2_config) for cache_size in l1_cache_sizes],
+                         x_values=l1_cache_sizes, x_label='L1 Cache Size (bytes)',
+                         plot_title='Cache Performance with Varying L1 Cache Size'),
+            SweepSection("****** Varying L1 block size ****** ", "l1_l2",
+                         [((cache_sizes[0], block_size, 2), l2_config) for block_size in l1_block_sizes],
+                         x_values=l1_block_sizes, x_label='L1 Block Size (bytes)',
+                         plot_title='Cache Performance with Varying L1 Block Size'),
+            SweepSection("****** Varying L2 cache size ****** ", "l1_l2",
+                         [(l1_config, (cache_size, block_sizes[1], 8)) for cache_size in l2_cache_sizes],
+                         x_values=l2_cache_sizes, x_label='L2 Cache Size (bytes)',
+                         plot_title='Cache Performance with Varying L2 Cache Size'),
+        ]
+    return []
+
+
+def simulate_l1_points(cache_class, points, trace):
+    # every point comes out of one pass over the trace
+    l1d_sweep = StackDistanceSweep(cache_class, points, L1_HIT_TIME, MISS_PENALTY)
+    l1i_sweep = StackDistanceSweep(cache_class, points, L1_HIT_TIME, MISS_PENALTY)
+    sweep_l1_trace(l1d_sweep, l1i_sweep, trace)
+    return list(zip(l1d_sweep.results(), l1i_sweep.results()))
+
+
+def simulate_l1_l2_points(points, trace):
+    # points sharing an L1 config share one L1 run, with all their L2 variants fed
+    # from its miss stream
+    by_l1_config = {}
+    for i, (l1_config, _) in enumerate(points):
+        by_l1_config.setdefault(l1_config, []).append(i)
+
+    rows = [None] * len(points)
+    for l1_config, indices in by_l1_config.items():
+        l2_sweep = StackDistanceSweep(WriteBackCache, [points[i][1] for i in indices], L2_HIT_TIME, MISS_PENALTY)
+        l1d_cache = WriteBackCache(*l1_config, L1_HIT_TIME, MISS_PENALTY, l2_sweep)
+        l1i_cache = WriteBackCache(*l1_config, L1_HIT_TIME, MISS_PENALTY, l2_sweep)
+        run_trace(l1d_cache, l1i_cache, trace, l2_sweep)
+        l1d_stats = CacheStats.from_cache(l1d_cache)
+        l1i_stats = CacheStats.from_cache(l1i_cache)
+        for i, l2_stats in zip(indices, l2_sweep.results()):
+            rows[i] = (l1d_stats, l1i_stats, l2_stats)
+    return rows
+
+
+def simulate_points(kind, cache_class, points, trace):
+    if kind == "l1":
+        return simulate_l1_points(cache_class, points, trace)
+    return simulate_l1_l2_points(points, trace)
+
+
+class ResultStore:
+    # Persistent memo of simulated sweep points in SQLite. A key names the trace content
+    # and every cache level of the point; the value is the per-level hit/miss/total
+    # counters and the AMAT. Past max_entries the least recently used points are evicted.
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, counters TEXT NOT NULL, "
+                                "amat REAL NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.connection.commit()
+
+    def lookup(self, keys):
+        # -> {key: (counters, amat)} for the keys already simulated
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for key, counters, amat in self.connection.execute(
+                    f"SELECT key, counters, amat FROM results WHERE key IN ({placeholders})", chunk):
+                found[key] = (json.loads(counters), amat)
+        if found:
+            now = time.time()
+            self.connection.executemany("UPDATE results SET last_used = ? WHERE key = ?",
+                                        [(now, key) for key in found])
+            self.connection.commit()
+        return found
+
+    def save(self, records):
+        # records: (key, counters, amat) tuples
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO results (key, counters, amat, last_used) "
+                                    "VALUES (?, ?, ?, ?)",
+                                    [(key, json.dumps(counters), amat, now) for key, counters, amat in records])
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()
+        if count > self.max_entries:
+            self.connection.execute("DELETE FROM results WHERE key IN "
+                                    "(SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                                    (count - self.max_entries,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def _row_levels(section, point):
+    # (name, cache class, config, hit time) of each stats object in a row of the section
+    if section.kind == "l1":
+        return [("L1D", section.cache_class, point, L1_HIT_TIME), ("L1I", section.cache_class, point, L1_HIT_TIME)]
+    l1_config, l2_config = point
+    return [("L1D", WriteBackCache, l1_config, L1_HIT_TIME), ("L1I", WriteBackCache, l1_config, L1_HIT_TIME),
+            ("L2", WriteBackCache, l2_config, L2_HIT_TIME)]
+
+
+def point_key(trace, section, point):
+    # the sweeps model the default write policies (write-allocate, no write buffer)
+    levels = [[name, cache_class.__name__, *config, hit_time, MISS_PENALTY, "write-allocate"]
+              for name, cache_class, config, hit_time in _row_levels(section, point)]
+    return json.dumps([SIMULATOR_VERSION, trace.digest, section.kind, levels])
+
+
+def row_levels(section, row):
+    # the stats of a row grouped by level, for memory_traffic and effective_bandwidth
+    if section.kind == "l1":
+        return [list(row)]
+    return [list(row[:2]), [row[2]]]
+
+
+def row_amat(section, row):
+    if section.kind == "l1":
+        return l1_amat(*row)
+    return l1_l2_amat(*row)
+
+
+def _row_from_record(section, point, record):
+    counters, _ = record
+    row = []
+    levels = _row_levels(section, point)
+    for (_, _, config, hit_time), (hits, misses, total, bytes_from, bytes_to) in zip(levels, counters):
+        stats = CacheStats(*config, hit_time, MISS_PENALTY)
+        stats.access_hits = hits
+        stats.access_misses = misses
+        stats.access_total = total
+        stats.bytes_from_next_level = bytes_from
+        stats.bytes_to_next_level = bytes_to
+        row.append(stats)
+    return tuple(row)
+
+
+# Traces opened by this worker process, by path. Workers map the trace sidecar written
+# by the parent instead of receiving the arrays through pickling.
+_worker_traces = {}
+
+
+def _simulate_points_task(kind, cache_class, points, trace_file_path, sidecar_path):
+    # maps the sidecar the parent loaded the trace from, so no worker parses the trace
+    trace = _worker_traces.get(sidecar_path)
+    if trace is None:
+        trace = _map_trace_sidecar(sidecar_path, os.stat(trace_file_path), trace_file_path)
+        if trace is None:
+            raise ValueError(f"{trace_file_path} changed during the run")
+        _worker_traces[sidecar_path] = trace
+    return simulate_points(kind, cache_class, points, trace)
+
+
+def _split_points(section, indices, num_chunks):
+    # Up to num_chunks lists of point indices. Points that share work stay in one
+    # chunk: the L1 run of an l1_l2 table, the stack group of an l1 table. Groups go
+    # to the least loaded chunk, largest first.
+    groups = {}
+    for i in indices:
+        point = section.points[i]
+        key = point[0] if section.kind == "l1_l2" else sweep_group_key(point)
+        groups.setdefault(key, []).append(i)
+    chunks = [[] for _ in range(max(1, min(num_chunks, len(groups))))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(chunks, key=len).extend(group)
+    return [sorted(chunk) for chunk in chunks if chunk]
+
+
+def submit_cache_simulation(cache_type, trace, executor=None, workers=1, store=None, submitted=None):
+    # Start every table of cache_type. Points already in the result store are not run
+    # again. Without an executor the rest run here, in one chunk per table; with one,
+    # each table is split into up to `workers` chunks of (trace, configuration) points,
+    # keeping points that share an L1 run or a stack group together.
+    # submitted maps the key of every point started so far to (future, position in its
+    # chunk); a point already started by another table, or by an earlier call given the
+    # same dict, reuses that result instead of running again.
+    # Pass the result to report_cache_simulation.
+    if executor is None or trace.sidecar_path is None:
+        # a trace without a sidecar would have to be parsed again by every worker
+        executor = None
+        workers = 1
+    if submitted is None:
+        submitted = {}
+    pending = []
+    for section in sweep_sections(cache_type):
+        keys = [point_key(trace, section, point) for point in section.points]
+        cached = store.lookup(keys) if store is not None else {}
+        rows = [None] * len(section.points)
+        missing = []
+        shared = []
+        for i, (key, point) in enumerate(zip(keys, section.points)):
+            if key in cached:
+                rows[i] = _row_from_record(section, point, cached[key])
+            elif key in submitted:
+                shared.append((i, submitted[key]))
+            else:
+                missing.append(i)
+
+        futures = []
+        for indices in _split_points(section, missing, workers):
+            points = [section.points[i] for i in indices]
+            if executor is None:
+                future = Future()
+                future.set_result(simulate_points(section.kind, section.cache_class, points, trace))
+            else:
+                future = executor.submit(_simulate_points_task, section.kind, section.cache_class, points,
+                                         trace.source_path, trace.sidecar_path)
+            futures.append((indices, future))
+            for position, i in enumerate(indices):
+                submitted[keys[i]] = (future, position)
+        pending.append((section, keys, rows, futures, shared))
+    return cache_type, pending, store
+
+
+def print_l1_header():
+    print("|" + ('-' * 15 + "|")*10)
+    print(f'|{"Assoc. Level":15}|{"L1I accesses":15}|{"L1I misses":15}|{"L1I hit rate":15}|{"L1D accesses":15}|{"L1D misses":15}|{"L1D hit rate":15}|{"AMAT":15}|{"Memory bytes":15}|{"Bytes/cycle":15}|')
+    print("|" + ('-' * 15 + "|")*10)
+
+
+def print_l1_l2_header():
+    print("|"+('-' * 13 + "|")*13)
+    print(f'|{"Assoc. Level":13}|{"L1I accesses":13}|{"L1I misses":13}|{"L1I hit rate":13}|{"L1D accesses":13}|{"L1D misses":13}|{"L1D hit rate":13}|{"L2 accesses":13}|{"L2 misses":13}|{"L2 hit rate":13}|{"AMAT":13}|{"Memory bytes":13}|{"Bytes/cycle":13}|')
+    print("|"+('-' * 13 + "|")*13)
+
+
+def plot_sweep(section, stats, plot_path=None):
+    # matplotlib is only imported once something is plotted; with plot_path the figure
+    # is written there as a PNG instead of being shown
+    import matplotlib
+    if plot_path is not None:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.plot(section.x_values, stats[0], marker='o', label='L1 Data Hit Rate')
+    plt.plot(section.x_values, stats[1], marker='o', label='L1 Instruction Hit Rate')
+    plt.plot(section.x_values, stats[2], marker='o', label='L2 Hit Rate')
+    plt.plot(section.x_values, stats[3], marker='o', label='AMAT')
+    plt.xlabel(section.x_label)
+    plt.ylabel('Percentage(%) or AMAT(cycle)')
+    plt.title(section.plot_title)
+    plt.legend()
+    if plot_path is None:
         plt.show()
+    else:
+        plt.savefig(plot_path)
+        plt.close()
+
+
+def sweep_plot_stats(rows):
+    # the series print_l1_l2_stats collects for plot_sweep
+    return [[calculate_percentage(l1i_stats.access_hits, l1i_stats.access_total) for _, l1i_stats, _ in rows],
+            [calculate_percentage(l1d_stats.access_hits, l1d_stats.access_total) for l1d_stats, _, _ in rows],
+            [calculate_percentage(l2_stats.access_hits, l2_stats.access_total) for _, _, l2_stats in rows],
+            [l1_l2_amat(*row) for row in rows]]
+
+
+def plot_file_name(trace_name, section):
+    slug = "".join(ch if ch.isalnum() else "-" for ch in section.plot_title.lower()).strip("-")
+    return f"{trace_name}-{slug}.png"
+
+
+def collect_cache_simulation(simulation):
+    # Yields (section, rows) for each table of a submit_cache_simulation result once its
+    # points are done, saving newly simulated points to the result store
+    _, pending, store = simulation
+    for section, keys, rows, futures, shared in pending:
+        # rows are placed by point index, whatever order the workers finish in
+        records = []
+        for indices, future in futures:
+            for i, row in zip(indices, future.result()):
+                rows[i] = row
+                records.append((keys[i], [[stats.access_hits, stats.access_misses, stats.access_total,
+                                           stats.bytes_from_next_level, stats.bytes_to_next_level]
+                                          for stats in row], row_amat(section, row)))
+        # points run for another table are saved by that table
+        for i, (future, position) in shared:
+            rows[i] = future.result()[position]
+        if store is not None and records:
+            store.save(records)
+        yield section, rows
+
+
+def report_cache_simulation(simulation, plots=True, plot_dir=None, trace_name=None):
+    # Prints the tables; Part 6 sweeps are also plotted when `plots` is set, shown on
+    # screen or, with plot_dir, written there as <trace_name>-<plot title>.png
+    cache_type, pending, _ = simulation
+    if not pending:
+        return
+    print(f"******{cache_type}******")
+    for section, rows in collect_cache_simulation(simulation):
+        if section.title is not None:
+            print(section.title)
+        if section.kind == "l1":
+            print_l1_header()
+            for l1d_stats, l1i_stats in rows:
+                print_l1_stats(l1d_stats, l1i_stats)
+        else:
+            l1i_hit_rates = []
+            l1d_hit_rates = []
+            l2_hit_rates = []
+            amats = []
+            stats = [l1i_hit_rates, l1d_hit_rates, l2_hit_rates, amats]
+            print_l1_l2_header()
+            for l1d_stats, l1i_stats, l2_stats in rows:
+                print_l1_l2_stats(l1d_stats, l1i_stats, l2_stats, stats)
+            if section.x_values is not None and plots:
+                plot_path = None
+                if plot_dir is not None:
+                    plot_path = os.path.join(plot_dir, plot_file_name(trace_name, section))
+                plot_sweep(section, stats, plot_path)
+
+
+RECORD_LEVEL_FIELDS = ["size", "block_size", "associativity", "accesses", "misses", "hit_rate",
+                       "bytes_from_next_level", "bytes_to_next_level"]
+RECORD_FIELDS = (["trace", "part", "sweep"]
+                 + [f"{name}_{field}" for name in ("L1D", "L1I", "L2") for field in RECORD_LEVEL_FIELDS]
+                 + ["amat", "memory_traffic", "bandwidth"])
+
+
+def simulation_records(simulation, trace_name, plot_dir=None):
+    # One flat dict per simulated point (RECORD_FIELDS), for the CSV and JSON outputs.
+    # With plot_dir, Part 6 sweeps are plotted there like report_cache_simulation does.
+    cache_type = simulation[0]
+    records = []
+    for section, rows in collect_cache_simulation(simulation):
+        if section.x_values is not None and plot_dir is not None:
+            plot_sweep(section, sweep_plot_stats(rows), os.path.join(plot_dir, plot_file_name(trace_name, section)))
+        sweep = section.title.strip(" *") if section.title is not None else None
+        for point, row in zip(section.points, rows):
+            record = {"trace": trace_name, "part": cache_type, "sweep": sweep}
+            for (name, _, _, _), stats in zip(_row_levels(section, point), row):
+                record[f"{name}_size"] = stats.total_size_bytes
+                record[f"{name}_block_size"] = stats.block_size_bytes
+                record[f"{name}_associativity"] = stats.set_associativity
+                record[f"{name}_accesses"] = stats.access_total
+                record[f"{name}_misses"] = stats.access_misses
+                record[f"{name}_hit_rate"] = round(calculate_percentage(stats.access_hits, stats.access_total), 4)
+                record[f"{name}_bytes_from_next_level"] = stats.bytes_from_next_level
+                record[f"{name}_bytes_to_next_level"] = stats.bytes_to_next_level
+            levels = row_levels(section, row)
+            record["amat"] = round(row_amat(section, row), 4)
+            record["memory_traffic"] = memory_traffic(levels)
+            record["bandwidth"] = round(effective_bandwidth(levels, MISS_PENALTY), 4)
+            records.append(record)
+    return records
+
+
+MULTICORE_RECORD_FIELDS = ["core", "trace", "L1D_accesses", "L1D_misses", "L1D_hit_rate",
+                           "L1I_accesses", "L1I_misses", "L1I_hit_rate", "L2_accesses", "L2_misses",
+                           "L2_hit_rate", "amat", "evicted_by_other_cores", "evicted_other_cores",
+                           "memory_traffic"]
+
+
+def multicore_records(system, trace_names):
+    # One dict per core (MULTICORE_RECORD_FIELDS), then the totals with core "all"
+    records = []
+    for core, trace_name in enumerate(trace_names):
+        levels = system.core_levels(core)
+        (l1d_cache, l1i_cache), (l2_share,) = levels
+        record = {"core": core, "trace": trace_name}
+        for name, caches in (("L1D", [l1d_cache]), ("L1I", [l1i_cache]), ("L2", [l2_share])):
+            _add_multicore_counters(record, name, caches)
+        record["amat"] = round(system.amat(core), 4)
+        record["evicted_by_other_cores"] = system.l2_cache.evicted_by_other_cores(core)
+        record["evicted_other_cores"] = system.l2_cache.evicted_other_cores(core)
+        record["memory_traffic"] = memory_traffic(levels)
+        records.append(record)
+    record = {"core": "all", "trace": None}
+    for name, caches in (("L1D", system.l1d_caches), ("L1I", system.l1i_caches), ("L2", [system.l2_cache])):
+        _add_multicore_counters(record, name, caches)
+    record["amat"] = round(system.amat(), 4)
+    record["evicted_by_other_cores"] = record["evicted_other_cores"] = system.inter_core_evictions()
+    record["memory_traffic"] = memory_traffic(system.levels())
+    records.append(record)
+    return records
+
+
+def _add_multicore_counters(record, name, caches):
+    hits = sum(cache.access_hits for cache in caches)
+    total = sum(cache.access_total for cache in caches)
+    record[f"{name}_accesses"] = total
+    record[f"{name}_misses"] = sum(cache.access_misses for cache in caches)
+    record[f"{name}_hit_rate"] = round(calculate_percentage(hits, total), 4)
 
-def main():
+
+def write_records(records, output_format, file, fields=RECORD_FIELDS):
+    if output_format == "json":
+        json.dump(records, file, indent=2)
+        file.write("\n")
+    else:
+        writer = csv.DictWriter(file, fields, restval="")
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def simulate_cache(cache_type, trace, workers=1, store=None):
+    if workers > 1 and trace.sidecar_path is not None:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            report_cache_simulation(submit_cache_simulation(cache_type, trace, executor, workers, store))
+    else:
+        report_cache_simulation(submit_cache_simulation(cache_type, trace, store=store))
+
+
+CACHE_TYPES = {"1": "Part2-WriteThrough", "2": "Part4-WriteBack", "3": "Part5-WriteBack with L2",
+               "4": "Part6-Data Collection"}
+# Multi-core mode: private L1s and a shared L2 configured like Part 5
+MULTICORE_L1_CONFIG = (1024, 32, 2)
+MULTICORE_L2_CONFIG = (16384, 128, 8)
+# Profiled with --profile-dir: the Part 5 L1s and 8-way L2 unless chosen otherwise
+PROFILE_L1_CONFIG = (1024, 32, 2)
+PROFILE_L2_CONFIG = (16384, 128, 8)
+# Blocks whose access counts a CacheProfile keeps, per hottest block it reports
+PROFILE_BLOCKS_PER_TOP = 1024
+
+
+def profile_trace(trace, l1_config=PROFILE_L1_CONFIG, l2_config=PROFILE_L2_CONFIG, sample_every=1):
+    # Run write-back L1s (and an L2 unless l2_config is None) over the trace with every
+    # cache instrumented; -> {level name: CacheProfile}
+    l2_cache = WriteBackCache(*l2_config, L2_HIT_TIME, MISS_PENALTY, None) if l2_config is not None else None
+    caches = {"L1D": WriteBackCache(*l1_config, L1_HIT_TIME, MISS_PENALTY, l2_cache),
+              "L1I": WriteBackCache(*l1_config, L1_HIT_TIME, MISS_PENALTY, l2_cache)}
+    if l2_cache is not None:
+        caches["L2"] = l2_cache
+    profiles = {name: instrument(cache, sample_every) for name, cache in caches.items()}
+    run_trace(caches["L1D"], caches["L1I"], trace, l2_cache)
+    return profiles
+
+
+def write_profiles(profiles, profile_dir, trace_name):
+    # <trace_name>-<level>.csv and .json per profile; returns the paths written
+    paths = []
+    for name, profile in profiles.items():
+        path = os.path.join(profile_dir, f"{trace_name}-{name.lower()}")
+        profile.write_csv(path + ".csv")
+        profile.write_json(path + ".json")
+        paths += [path + ".csv", path + ".json"]
+    return paths
+
+
+def run_cache_simulations(cache_types, trace_paths, workers=None, result_store_path=DEFAULT_RESULT_STORE,
+                          output_format="table", plots=True, plot_dir=None, profile_dir=None,
+                          profile_configs=(PROFILE_L1_CONFIG, PROFILE_L2_CONFIG), profile_sample_every=1):
+    # Fan the (trace, configuration) points of every trace and part out over one process
+    # pool (none with workers=1), then report them trace by trace in the usual order.
+    # With profile_dir, each trace is also run through instrumented caches of
+    # profile_configs (L1 config, L2 config or None) while the pool works, and their
+    # profiles are written there (see write_profiles).
+    workers = workers or os.cpu_count() or 1
+    # points simulated by earlier runs come straight from the result store
+    store = ResultStore(result_store_path) if result_store_path else None
+    records = []
+    with contextlib.ExitStack() as stack:
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers)) if workers > 1 else None
+        simulations = []
+        # points shared between the parts and traces of this run are simulated once
+        submitted = {}
+        for path in trace_paths:
+            # parse once per trace, every configuration of the sweep reuses it
+            trace = load_trace(path)
+            if trace.ingest is not None:
+                print(f"Parsed {os.path.basename(path)}: {trace.ingest.accesses} accesses "
+                      f"({trace.ingest.accesses_per_second:,.0f} accesses/s)", file=sys.stderr)
+            simulations.append((trace, [submit_cache_simulation(cache_type, trace, executor, workers, store,
+                                                                submitted)
+                                        for cache_type in cache_types]))
+        for path, (trace, trace_simulations) in zip(trace_paths, simulations):
+            trace_name = os.path.basename(path)
+            if profile_dir is not None:
+                paths = write_profiles(profile_trace(trace, *profile_configs, profile_sample_every), profile_dir,
+                                       trace_name)
+                print(f"Profiled {trace_name}: {', '.join(paths)}", file=sys.stderr)
+            if output_format == "table":
+                print(f"File name: {trace_name}")
+            for simulation in trace_simulations:
+                if output_format == "table":
+                    report_cache_simulation(simulation, plots, plot_dir, trace_name)
+                else:
+                    records.extend(simulation_records(simulation, trace_name, plot_dir if plots else None))
+    if store is not None:
+        store.close()
+    if output_format != "table":
+        write_records(records, output_format, sys.stdout)
+
+
+def run_multicore_simulation(trace_paths, interleave="round-robin", output_format="table"):
+    # One core per trace; interleave is "round-robin" or "timestamp" (third trace field)
+    traces = [load_trace(path) for path in trace_paths]
+    timestamps = [read_trace_timestamps(path) for path in trace_paths] if interleave == "timestamp" else None
+    trace_names = [os.path.basename(path) for path in trace_paths]
+    system = MultiCoreSystem(len(traces), MULTICORE_L1_CONFIG, MULTICORE_L2_CONFIG).run(traces, timestamps)
+    if output_format == "table":
+        for core, trace_name in enumerate(trace_names):
+            print(f"Core {core}: {trace_name}")
+        print_multicore_stats(system)
+    else:
+        write_records(multicore_records(system, trace_names), output_format, sys.stdout, MULTICORE_RECORD_FIELDS)
+    for trace in traces:
+        trace.close()
+    return system
+
+
+def interactive_main(workers=None, result_store_path=DEFAULT_RESULT_STORE):
     print("Select the cache simulation:")
     print("1. Write-Through Cache (Part 1 & 2)")
     print("2. Write-Back Cache (Part 3 & 4)")
@@ -362,23 +2969,96 @@ def main():
     pathC = "C:/Users/quang/Desktop/GradClass/Learning/CS529-Com_Architecture/Project/traces/tex.trace"
     file_path = [pathA, pathB, pathC]
 
-    for path in file_path:
-        print(f"File name: {os.path.basename(path)}")
-        if choice == "1":
-            simulate_cache("Part2-WriteThrough", path)
-            # print('-' * 140)
-        elif choice == "2":
-            simulate_cache("Part4-WriteBack", path)
-            # print('-' * 140)
-        elif choice == "3":
-            simulate_cache("Part5-WriteBack with L2", path)
-            # print('-' * 140)
-        elif choice == "4":
-            simulate_cache("Part6-Data Collection", path)
-            # print('-' * 140)
-        else:
+    if choice not in CACHE_TYPES:
+        for path in file_path:
+            print(f"File name: {os.path.basename(path)}")
             print("Invalid choice. Please enter either 1, 2, 3 or 4.")
+        return
+    run_cache_simulations([CACHE_TYPES[choice]], file_path, workers, result_store_path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Simulate the project cache configurations on memory access traces. "
+                    "Without trace arguments, asks for the part to run on the default traces.")
+    parser.add_argument("traces", nargs="*", help="trace files (plain, .gz, .xz or .zst)")
+    parser.add_argument("-p", "--part", type=cache_parts, action="extend", metavar="PART[,PART...]",
+                        help="parts to run, comma-separated or repeated: 1 write-through, 2 write-back, "
+                             "3 L1+L2, 4 Part 6 sweeps (default: all)")
+    parser.add_argument("-f", "--format", choices=["table", "csv", "json"], default="table")
+    parser.add_argument("-o", "--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--plot-dir", help="write the Part 6 plots to this directory as PNG files")
+    parser.add_argument("-j", "--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--result-store", help=f"SQLite result store (default: {DEFAULT_RESULT_STORE})")
+    parser.add_argument("--no-result-store", action="store_true", help="simulate every point again")
+    parser.add_argument("--multi-core", action="store_true",
+                        help="run the traces together, one core each, with private L1s and a shared L2 "
+                             "configured like Part 5 (ignores --part)")
+    parser.add_argument("--interleave", choices=["round-robin", "timestamp"], default="round-robin",
+                        help="multi-core access order: cores in turn, or by the timestamp in the third "
+                             "field of each trace line (default: round-robin)")
+    parser.add_argument("--profile-dir",
+                        help="also run each trace through instrumented caches and write their per-set "
+                             "profiles to this directory as <trace>-<level>.csv/.json")
+    parser.add_argument("--profile-l1", type=cache_config, default=PROFILE_L1_CONFIG, metavar="SIZE,BLOCK,ASSOC",
+                        help="profiled write-back L1D/L1I configuration (default: %(default)s)")
+    parser.add_argument("--profile-l2", type=cache_config, default=PROFILE_L2_CONFIG,
+                        metavar="SIZE,BLOCK,ASSOC|none",
+                        help="profiled L2 configuration, none for L1s only (default: %(default)s)")
+    parser.add_argument("--profile-sample", type=int, default=1, metavar="N",
+                        help="profile every N-th set (default: 1)")
+    args = parser.parse_args(argv)
+    if args.profile_l1 is None:
+        parser.error("--profile-l1 needs a configuration")
+    args.part = list(dict.fromkeys(args.part)) if args.part else list(CACHE_TYPES)
+    return args
+
+
+def cache_parts(text):
+    # argparse type for a comma-separated list of CACHE_TYPES keys
+    parts = [part.strip() for part in text.split(",")]
+    for part in parts:
+        if part not in CACHE_TYPES:
+            raise argparse.ArgumentTypeError(f"expected parts among {', '.join(CACHE_TYPES)}, got {text!r}")
+    return parts
+
+
+def cache_config(text):
+    # argparse type for SIZE,BLOCK,ASSOC; "none" gives None
+    if text.lower() == "none":
+        return None
+    try:
+        config = tuple(int(field) for field in text.split(","))
+    except ValueError:
+        config = ()
+    if len(config) != 3 or min(config) <= 0 or config[0] % (config[1] * config[2]):
+        raise argparse.ArgumentTypeError(f"expected SIZE,BLOCK,ASSOC with SIZE a multiple of BLOCK*ASSOC, got {text!r}")
+    return config
+
+
+def main(workers=None, result_store_path=DEFAULT_RESULT_STORE, argv=None):
+    args = parse_args(argv)
+    if not args.traces:
+        interactive_main(workers, result_store_path)
+        return
+
+    if args.plot_dir is not None:
+        os.makedirs(args.plot_dir, exist_ok=True)
+    if args.profile_dir is not None:
+        os.makedirs(args.profile_dir, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        if args.output is not None:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(args.output, "w", newline=""))))
+        if args.multi_core:
+            run_multicore_simulation(args.traces, args.interleave, args.format)
+            return
+        run_cache_simulations([CACHE_TYPES[part] for part in args.part], args.traces,
+                              args.workers or workers,
+                              None if args.no_result_store else args.result_store or result_store_path,
+                              args.format, plots=args.plot_dir is not None, plot_dir=args.plot_dir,
+                              profile_dir=args.profile_dir, profile_configs=(args.profile_l1, args.profile_l2),
+                              profile_sample_every=args.profile_sample)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
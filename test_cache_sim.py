@@ -0,0 +1,676 @@
+import csv
+import functools
+import json
+import os
+import random
+import tempfile
+
+import numpy as np
+import pytest
+
+import cache_bench
+import cache_sim
+
+
+def accesses_of(trace):
+    access_types, addresses = trace.as_arrays()
+    return access_types.tolist(), addresses.tolist()
+
+
+def test_load_trace_sidecar(tmp_path):
+    path = str(tmp_path / "trace.txt")
+    with open(path, "w") as file:
+        file.write("0 1a\n1 ff  # a write\n\n2 400 7\n")
+    expected = ([0, 1, 2], [0x1a, 0xff, 0x400])
+
+    trace = cache_sim.load_trace(path)
+    assert os.path.exists(path + cache_sim.TRACE_SUFFIX)
+    assert trace.ingest is not None and trace.source_path == path
+    assert accesses_of(trace) == expected
+    trace.close()
+    trace = cache_sim.load_trace(path)
+    assert trace.ingest is None and trace.source_path == path
+    assert accesses_of(trace) == expected
+    trace.close()
+
+    # a changed size, then the same size with a new mtime
+    for text in ["0 1a\n1 ff\n", "0 2b\n1 ee\n"]:
+        with open(path, "w") as file:
+            file.write(text)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        trace = cache_sim.load_trace(path)
+        assert trace.ingest is not None
+        assert accesses_of(trace) == ([0, 1], [int(line.split()[1], 16) for line in text.splitlines()])
+        trace.close()
+
+    sidecar_mtime = os.stat(path + cache_sim.TRACE_SUFFIX).st_mtime_ns
+    trace = cache_sim.load_trace(path, use_sidecar=False)
+    assert trace.ingest is not None and trace.source_path == path
+    assert accesses_of(trace) == ([0, 1], [0x2b, 0xee])
+    assert os.stat(path + cache_sim.TRACE_SUFFIX).st_mtime_ns == sidecar_mtime
+
+
+@pytest.mark.parametrize("use_sidecar", [True, False])
+def test_load_empty_trace(tmp_path, use_sidecar):
+    path = str(tmp_path / "empty.txt")
+    with open(path, "w") as file:
+        file.write("# nothing but a comment\n")
+    for _ in range(2):
+        trace = cache_sim.load_trace(path, use_sidecar=use_sidecar)
+        assert len(trace) == 0 and accesses_of(trace) == ([], [])
+        assert trace.digest == cache_sim.Trace(np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.uint64)).digest
+        trace.close()
+
+
+def test_sidecar_in_temp_directory(tmp_path, monkeypatch):
+    # the trace's directory cannot take the sidecar: it goes to the temp directory, and
+    # workers map it instead of parsing the trace again
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path / "tmp"))
+    os.mkdir(tmp_path / "tmp")
+    path = str(tmp_path / "trace.txt")
+    access_types, addresses = cache_bench.mixed_trace(3000)
+    with open(path, "w") as file:
+        file.writelines(f"{access_type} {address:x}\n" for access_type, address in
+                        zip(access_types.tolist(), addresses.tolist()))
+    os.mkdir(path + cache_sim.TRACE_SUFFIX)
+
+    trace = cache_sim.load_trace(path)
+    assert trace.ingest is not None and os.path.dirname(trace.sidecar_path) == str(tmp_path / "tmp")
+    trace.close()
+    trace = cache_sim.load_trace(path)
+    assert trace.ingest is None and os.path.dirname(trace.sidecar_path) == str(tmp_path / "tmp")
+    assert trace.digest == cache_sim.Trace(access_types, addresses).digest
+
+    monkeypatch.setattr(cache_sim, "_worker_traces", {})
+    monkeypatch.setattr(cache_sim, "TraceReader", None)
+    section = cache_sim.sweep_sections(cache_sim.CACHE_TYPES["2"])[0]
+    rows = cache_sim._simulate_points_task(section.kind, section.cache_class, section.points, path,
+                                           trace.sidecar_path)
+    expected = cache_sim.simulate_points(section.kind, section.cache_class, section.points, trace)
+    assert [[counters(stats) for stats in row] for row in rows] == \
+        [[counters(stats) for stats in row] for row in expected]
+    trace.close()
+
+
+def run_classes(cache_class, configs, accesses):
+    caches = []
+    for config in configs:
+        cache = cache_class(*config, 1, 100, None)
+        for write, address in accesses:
+            if write:
+                cache.write_to_cache(address, write_flag=True, next_level_cache=None)
+            else:
+                cache.read_from_cache(address, next_level_cache=None)
+        caches.append(cache)
+    return caches
+
+
+def counters(stats):
+    return [stats.access_hits, stats.access_misses, stats.access_total,
+            stats.bytes_from_next_level, stats.bytes_to_next_level]
+
+
+@pytest.mark.parametrize("cache_class", [cache_sim.WriteThroughCache, cache_sim.WriteBackCache])
+@pytest.mark.parametrize("batch_size", [1, 13, 1 << 16])
+def test_sweep_matches_classes(cache_class, batch_size, monkeypatch):
+    monkeypatch.setattr(cache_sim.StackDistanceSweep, "batch_size", batch_size)
+    rng = random.Random(11)
+    for span in [64, 1024, 8192]:
+        accesses = [(rng.random() < 0.3, rng.randrange(span)) for _ in range(1500)]
+        # several associativities per set count, power-of-two and other set counts
+        configs = [(block_size * associativity * num_sets, block_size, associativity)
+                   for block_size in [8, 32] for associativity in [1, 2, 4, 8] for num_sets in [1, 2, 3, 4, 6]]
+        sweep = cache_sim.StackDistanceSweep(cache_class, configs, 1, 100)
+        for write, address in accesses:
+            if write:
+                sweep.write_to_cache(address, True, None)
+            else:
+                sweep.read_from_cache(address, None)
+        expected = run_classes(cache_class, configs, accesses)
+        assert [counters(stats) for stats in sweep.results()] == [counters(cache) for cache in expected]
+
+
+@pytest.mark.parametrize("cache_class", [cache_sim.WriteThroughCache, cache_sim.WriteBackCache])
+def test_full_block_writes_skip_the_fetch(cache_class):
+    # the writebacks of a cache above with the same block size
+    rng = random.Random(12)
+    accesses = [(rng.random() < 0.3, rng.randrange(8192) // 32 * 32) for _ in range(3000)]
+    configs = [(32 * associativity * num_sets, 32, associativity) for associativity in [1, 2, 4] for num_sets in [1, 4]]
+    sweep = cache_sim.StackDistanceSweep(cache_class, configs, 1, 100)
+    caches = [cache_class(*config, 1, 100, None) for config in configs]
+    read_misses = [0] * len(caches)
+    for write, address in accesses:
+        if write:
+            sweep.write_to_cache(address, True, None, size_bytes=32)
+        else:
+            sweep.read_from_cache(address, None)
+        for i, cache in enumerate(caches):
+            if write:
+                cache.write_to_cache(address, True, None, size_bytes=32)
+            else:
+                misses = cache.access_misses
+                cache.read_from_cache(address, None)
+                read_misses[i] += cache.access_misses - misses
+    for stats, cache, misses in zip(sweep.results(), caches, read_misses):
+        assert counters(stats) == counters(cache)
+        # only read misses fetch
+        assert cache.bytes_from_next_level == misses * 32
+    with pytest.raises(ValueError):
+        sweep.write_to_cache(0, True, None)
+
+
+@pytest.mark.parametrize("cache_class", [cache_sim.WriteThroughCache, cache_sim.WriteBackCache])
+@pytest.mark.parametrize("write_allocate", [True, False])
+def test_write_allocate_traffic(cache_class, write_allocate):
+    # a direct-mapped L1 of two 32-byte blocks over a write-back L2
+    l2_cache = cache_sim.WriteBackCache(4096, 32, 4, 10, 100, None)
+    l1_cache = cache_class(64, 32, 1, 1, 100, l2_cache, write_allocate=write_allocate)
+    l1_cache.write_to_cache(0x100, True, l2_cache)
+    l1_cache.write_to_cache(0x104, True, l2_cache)
+    assert (0x100 // 32 in l1_cache.cache[0]) == write_allocate
+    # only a write-allocate miss fetches the block
+    assert l1_cache.bytes_from_next_level == (32 if write_allocate else 0)
+    written_through = cache_class is cache_sim.WriteThroughCache or not write_allocate
+    assert l1_cache.bytes_to_next_level == (8 if written_through else 0)
+
+    # 0x200 maps to the same set: a dirty victim goes back to the L2 at its own address
+    l2_writes = l2_cache.access_total - l2_cache.access_misses
+    l1_cache.read_from_cache(0x200, l2_cache)
+    assert l1_cache.bytes_from_next_level == (64 if write_allocate else 32)
+    if written_through:
+        assert l1_cache.bytes_to_next_level == 8
+    else:
+        assert l1_cache.bytes_to_next_level == 32
+        assert l2_cache.access_total - l2_cache.access_misses == l2_writes + 1
+        assert l2_cache.dirty[l2_cache.cache[0x100 // 32 % l2_cache.num_sets][0x100 // 32]] == 1
+    assert 0x200 // 32 in l1_cache.cache[0]
+    # the L2 only ever fetched the blocks the L1 read or allocated
+    assert l2_cache.bytes_from_next_level == 64
+    assert l2_cache.bytes_to_next_level == 0
+
+
+def test_write_buffer_drains():
+    # a write-through L2 without write allocate passes on exactly the bytes it receives
+    l2_cache = cache_sim.WriteThroughCache(4096, 32, 4, 10, 100, None, write_allocate=False)
+    l1d_cache = cache_sim.WriteThroughCache(1024, 32, 2, 1, 100, l2_cache, write_buffer_entries=4)
+    l1i_cache = cache_sim.WriteThroughCache(1024, 32, 2, 1, 100, l2_cache, write_buffer_entries=4)
+    cache_sim.run_trace(l1d_cache, l1i_cache, cache_sim.Trace(*cache_bench.mixed_trace(20000)), l2_cache)
+    assert l1d_cache.write_buffer == {}
+    assert l2_cache.bytes_to_next_level == l1d_cache.bytes_to_next_level
+
+    # a read miss sends the pending words of its block ahead of the fetch
+    l1d_cache.write_to_cache(0, True, l2_cache)
+    l1d_cache.write_to_cache(4, True, l2_cache)
+    assert l1d_cache.write_buffer == {0: 0b11}
+    writes = l2_cache.access_total
+    l1d_cache.read_from_cache(1 << 20, l2_cache)
+    l1d_cache._invalidate(0, 0)
+    l1d_cache.read_from_cache(0, l2_cache)
+    assert 0 not in l1d_cache.write_buffer
+    assert l2_cache.access_total == writes + 3
+    assert l2_cache.bytes_to_next_level == l1d_cache.bytes_to_next_level
+
+
+@pytest.mark.parametrize("cache_type", list(cache_sim.CACHE_TYPES.values()))
+def test_project_sweeps_match_classes(cache_type):
+    trace = cache_sim.Trace(*cache_bench.mixed_trace(20000))
+    for section in cache_sim.sweep_sections(cache_type):
+        rows = cache_sim.simulate_points(section.kind, section.cache_class, section.points, trace)
+        for point, row in zip(section.points, rows):
+            if section.kind == "l1":
+                l1d_cache = section.cache_class(*point, 1, 100, None)
+                l1i_cache = section.cache_class(*point, 1, 100, None)
+                caches = [l1d_cache, l1i_cache]
+                cache_sim.run_trace(l1d_cache, l1i_cache, trace, None)
+            else:
+                l1_config, l2_config = point
+                l2_cache = cache_sim.WriteBackCache(*l2_config, 10, 100, None)
+                l1d_cache = cache_sim.WriteBackCache(*l1_config, 1, 100, l2_cache)
+                l1i_cache = cache_sim.WriteBackCache(*l1_config, 1, 100, l2_cache)
+                caches = [l1d_cache, l1i_cache, l2_cache]
+                cache_sim.run_trace(l1d_cache, l1i_cache, trace, l2_cache)
+            assert [counters(stats) for stats in row] == [counters(cache) for cache in caches]
+
+
+def test_shared_points_simulated_once(monkeypatch):
+    trace = cache_sim.Trace(*cache_bench.mixed_trace(5000))
+    simulated = []
+    simulate_points = cache_sim.simulate_points
+
+    def counting_simulate_points(kind, cache_class, points, trace):
+        simulated.extend(points)
+        return simulate_points(kind, cache_class, points, trace)
+
+    monkeypatch.setattr(cache_sim, "simulate_points", counting_simulate_points)
+    submitted = {}
+    # the same trace twice, as a plain and a compressed copy would be
+    simulations = [cache_sim.submit_cache_simulation(cache_type, trace, submitted=submitted)
+                   for _ in range(2) for cache_type in cache_sim.CACHE_TYPES.values()]
+    keys = {cache_sim.point_key(trace, section, point)
+            for cache_type in cache_sim.CACHE_TYPES.values()
+            for section in cache_sim.sweep_sections(cache_type) for point in section.points}
+    assert len(simulated) == len(keys)
+    for simulation in simulations:
+        for section, rows in cache_sim.collect_cache_simulation(simulation):
+            expected = simulate_points(section.kind, section.cache_class, section.points, trace)
+            assert [[counters(stats) for stats in row] for row in rows] == \
+                [[counters(stats) for stats in row] for row in expected]
+
+
+@pytest.mark.parametrize("l2_block_size", [32, 128])
+def test_hierarchy_counts_like_classes(l2_block_size):
+    # the Part 5 configuration, and one whose L1 writebacks fill whole L2 blocks
+    levels = [{"name": "L1", "total_size_bytes": 1024, "block_size_bytes": 32, "set_associativity": 2,
+               "hit_time": 1, "split": True},
+              {"name": "L2", "total_size_bytes": 16384, "block_size_bytes": l2_block_size, "set_associativity": 8,
+               "hit_time": 10}]
+    trace = cache_sim.Trace(*cache_bench.mixed_trace(20000))
+    hierarchy = cache_sim.CacheHierarchy(levels).run(trace)
+    l2_cache = cache_sim.WriteBackCache(16384, l2_block_size, 8, 10, 100, None)
+    l1d_cache = cache_sim.WriteBackCache(1024, 32, 2, 1, 100, l2_cache)
+    l1i_cache = cache_sim.WriteBackCache(1024, 32, 2, 1, 100, l2_cache)
+    cache_sim.run_trace(l1d_cache, l1i_cache, trace, l2_cache)
+    assert [counters(cache) for cache in hierarchy.caches()] == \
+        [counters(cache) for cache in [l1d_cache, l1i_cache, l2_cache]]
+    assert hierarchy.amat() == pytest.approx(cache_sim.calculate_amat(
+        [1, 10], [cache_sim.calculate_percentage(l1d_cache.access_misses + l1i_cache.access_misses,
+                                                 l1d_cache.access_total + l1i_cache.access_total),
+                  cache_sim.calculate_percentage(l2_cache.access_misses, l2_cache.access_total)], 100))
+
+
+def resident_blocks(replacement_policy, blocks, set_associativity=4, num_sets=1):
+    # blocks cached after reading `blocks` (block addresses, 8-byte blocks)
+    cache = cache_sim.WriteBackCache(8 * set_associativity * num_sets, 8, set_associativity, 1, 100, None,
+                                     replacement_policy)
+    for block in blocks:
+        cache.read_from_cache(block * 8, None)
+    return cache
+
+
+def test_fifo_ignores_hits():
+    assert set(resident_blocks("fifo", [0, 1, 2, 3, 0, 4]).tags) == {1, 2, 3, 4}
+    assert set(resident_blocks("lru", [0, 1, 2, 3, 0, 4]).tags) == {0, 2, 3, 4}
+
+
+def test_two_way_plru_is_lru():
+    rng = random.Random(3)
+    blocks = [rng.randrange(40) for _ in range(3000)]
+    plru = resident_blocks("plru", blocks, 2, 8)
+    lru = resident_blocks("lru", blocks, 2, 8)
+    assert counters(plru) == counters(lru) and plru.tags == lru.tags
+
+
+def test_four_way_plru_victim():
+    replacement = cache_sim.TreePLRUReplacement(2, 4)
+    for line in [4, 5, 6, 7, 4]:
+        replacement.insert(line)
+    # the root points away from way 0, and the right subtree away from way 3
+    assert replacement.victim(4) == 6
+    replacement.touch(6)
+    assert replacement.victim(4) == 5
+    assert replacement.victim(0) == 0  # the other set is untouched
+    # where LRU would evict way 1
+    assert set(resident_blocks("plru", [0, 1, 2, 3, 0, 4]).tags) == {0, 1, 3, 4}
+
+
+def test_srrip_ageing():
+    replacement = cache_sim.SRRIPReplacement(1, 4)
+    for line in range(4):
+        replacement.insert(line)
+    assert list(replacement.rrpv) == [2, 2, 2, 2]
+    replacement.touch(1)
+    # the set ages by one until way 0 reaches the maximum
+    assert replacement.victim(0) == 0
+    assert list(replacement.rrpv) == [3, 1, 3, 3]
+    replacement.insert(0)
+    assert replacement.victim(0) == 2
+    assert list(replacement.rrpv) == [2, 1, 3, 3]
+    replacement.invalidate(1)
+    assert replacement.rrpv[1] == 3
+
+
+def test_brrip_inserts_long_once_in_32():
+    replacement = cache_sim.BRRIPReplacement(1, 4)
+    inserted = []
+    for fill in range(96):
+        replacement.insert(fill % 4)
+        inserted.append(replacement.rrpv[fill % 4])
+    assert [fill + 1 for fill, rrpv in enumerate(inserted) if rrpv != 3] == [32, 64, 96]
+    assert {rrpv for rrpv in inserted if rrpv != 3} == {2}
+
+
+def test_random_replacement_is_reproducible():
+    rng = random.Random(4)
+    blocks = [rng.randrange(64) for _ in range(2000)]
+    runs = [resident_blocks(functools.partial(cache_sim.RandomReplacement, seed=seed), blocks, 4, 4)
+            for seed in [7, 7, 8]]
+    assert counters(runs[0]) == counters(runs[1]) and runs[0].tags == runs[1].tags
+    assert runs[0].tags != runs[2].tags
+
+
+def checkpointed_caches(replacement_policy, write_buffer_entries=None):
+    if write_buffer_entries is None:
+        l2_cache = cache_sim.WriteBackCache(4096, 64, 4, 10, 100, None, replacement_policy)
+        return [cache_sim.WriteBackCache(512, 32, 2, 1, 100, l2_cache, replacement_policy)
+                for _ in range(2)] + [l2_cache]
+    l2_cache = cache_sim.WriteThroughCache(4096, 64, 4, 10, 100, None, replacement_policy, write_allocate=False)
+    return [cache_sim.WriteThroughCache(512, 32, 2, 1, 100, l2_cache, replacement_policy,
+                                        write_buffer_entries=write_buffer_entries) for _ in range(2)] + [l2_cache]
+
+
+def cache_state(caches):
+    return [(counters(cache), cache.tags, bytes(cache.dirty), getattr(cache, "write_buffer", None))
+            for cache in caches]
+
+
+@pytest.mark.parametrize("replacement_policy, write_buffer_entries",
+                         [(name, None) for name in cache_sim.REPLACEMENT_POLICIES] + [("lru", 4)])
+def test_checkpoint_resume_matches_full_run(tmp_path, replacement_policy, write_buffer_entries):
+    trace = cache_sim.Trace(*cache_bench.mixed_trace(20000))
+    full = checkpointed_caches(replacement_policy, write_buffer_entries)
+    cache_sim.run_trace(full[0], full[1], trace, full[2])
+
+    # a run killed part way through, resumed with fresh caches
+    checkpoint_path = str(tmp_path / "run.npz")
+    killed = checkpointed_caches(replacement_policy, write_buffer_entries)
+    read_from_cache = killed[0].read_from_cache
+    reads = []
+
+    def failing_read(*args, **kwargs):
+        reads.append(args)
+        if len(reads) == 5000:
+            raise KeyboardInterrupt
+        return read_from_cache(*args, **kwargs)
+
+    killed[0].read_from_cache = failing_read
+    with pytest.raises(KeyboardInterrupt):
+        cache_sim.run_trace(killed[0], killed[1], trace, killed[2], checkpoint_path, checkpoint_interval=3000)
+    loaded = checkpointed_caches(replacement_policy, write_buffer_entries)
+    position, _ = cache_sim.load_checkpoint(checkpoint_path, cache_sim.checkpoint_caches(*loaded))
+    assert 0 < position < len(trace) and position % 3000 == 0
+    resumed = checkpointed_caches(replacement_policy, write_buffer_entries)
+    cache_sim.run_trace(resumed[0], resumed[1], trace, resumed[2], checkpoint_path, checkpoint_interval=3000)
+    assert cache_state(resumed) == cache_state(full)
+
+
+def test_checkpoint_rejects_other_runs(tmp_path):
+    access_types, addresses = cache_bench.mixed_trace(10000)
+    checkpoint_path = str(tmp_path / "run.npz")
+    caches = checkpointed_caches("lru")
+    cache_sim.run_trace(caches[0], caches[1], cache_sim.Trace(access_types, addresses), caches[2],
+                        checkpoint_path, checkpoint_interval=4000)
+    other_addresses = addresses.copy()
+    other_addresses[100] += 1
+    caches = checkpointed_caches("lru")
+    with pytest.raises(ValueError, match="start of this trace"):
+        cache_sim.run_trace(caches[0], caches[1], cache_sim.Trace(access_types, other_addresses), caches[2],
+                            checkpoint_path)
+    for other_caches in [checkpointed_caches("plru"), checkpointed_caches("lru", 4),
+                         [cache_sim.WriteBackCache(512, 32, 2, 1, 100, None) for _ in range(2)]]:
+        with pytest.raises(ValueError):
+            cache_sim.run_trace(other_caches[0], other_caches[1], cache_sim.Trace(access_types, addresses),
+                                other_caches[2] if len(other_caches) > 2 else None, checkpoint_path)
+
+
+def make_trace(access_types, addresses):
+    return cache_sim.Trace(np.array(access_types, dtype=np.uint8), np.array(addresses, dtype=np.uint64))
+
+
+def test_interleave_traces():
+    traces = [make_trace([0, 1, 2], [10, 11, 12]), make_trace([2], [20]), make_trace([0, 0], [30, 31])]
+
+    def merged(batch_size, timestamps=None):
+        batches = list(cache_sim.interleave_traces(traces, timestamps, batch_size))
+        return [np.concatenate(arrays).tolist() for arrays in zip(*batches)]
+
+    # round robin, a core drops out when its trace ends
+    assert merged(1 << 16) == [[0, 1, 2, 0, 2, 0], [0, 2, 0, 1, 0, 2], [10, 20, 30, 11, 31, 12]]
+    for batch_size in [1, 2, 4]:
+        assert merged(batch_size) == merged(1 << 16)
+    timestamps = [np.array([5, 7, 9], dtype=np.uint64), np.array([7], dtype=np.uint64),
+                  np.array([1, 9], dtype=np.uint64)]
+    assert merged(1 << 16, timestamps) == [[2, 0, 0, 1, 0, 2], [0, 0, 1, 2, 2, 0], [30, 10, 11, 20, 12, 31]]
+    assert merged(2, timestamps) == merged(1 << 16, timestamps)
+
+
+def test_multi_core_attribution():
+    # one-block L1s and a single 2-way set of L2, all reads:
+    # core 0 misses on 0x000, core 1 hits it, core 0 brings in 0x100, core 1's 0x200
+    # evicts core 0's 0x000 and core 0's 0x300 evicts its own 0x100
+    system = cache_sim.MultiCoreSystem(2, (32, 32, 1), (64, 32, 2))
+    system.run([make_trace([0, 0, 0], [0x000, 0x100, 0x300]), make_trace([0, 0], [0x000, 0x200])])
+    assert [counters(port) for port in system.ports] == [[0, 3, 3, 96, 0], [1, 1, 2, 32, 0]]
+    assert counters(system.l2_cache) == [1, 4, 5, 128, 0]
+    assert system.l2_cache.inter_core_evictions == [[0, 0], [1, 0]]
+    assert system.l2_cache.evicted_by_other_cores(0) == 1 and system.l2_cache.evicted_other_cores(1) == 1
+
+
+def test_single_core_matches_run_trace():
+    trace = cache_sim.Trace(*cache_bench.mixed_trace(20000))
+    system = cache_sim.MultiCoreSystem(1, (1024, 32, 2), (16384, 128, 8))
+    system.run([trace])
+    l2_cache = cache_sim.WriteBackCache(16384, 128, 8, 10, 100, None)
+    l1d_cache = cache_sim.WriteBackCache(1024, 32, 2, 1, 100, l2_cache)
+    l1i_cache = cache_sim.WriteBackCache(1024, 32, 2, 1, 100, l2_cache)
+    cache_sim.run_trace(l1d_cache, l1i_cache, trace, l2_cache)
+    assert [counters(cache) for cache in [system.l1d_caches[0], system.l1i_caches[0], system.l2_cache,
+                                          system.ports[0]]] == \
+        [counters(cache) for cache in [l1d_cache, l1i_cache, l2_cache, l2_cache]]
+
+
+def test_result_store_reuses_points(tmp_path, monkeypatch):
+    trace = cache_sim.Trace(*cache_bench.mixed_trace(5000))
+    cache_type = cache_sim.CACHE_TYPES["3"]
+    simulated = []
+    simulate_points = cache_sim.simulate_points
+
+    def counting_simulate_points(kind, cache_class, points, trace):
+        simulated.extend(points)
+        return simulate_points(kind, cache_class, points, trace)
+
+    def simulate(trace):
+        del simulated[:]
+        store = cache_sim.ResultStore(str(tmp_path / "results.sqlite"))
+        rows = [row for _, section_rows in
+                cache_sim.collect_cache_simulation(cache_sim.submit_cache_simulation(cache_type, trace, store=store))
+                for row in section_rows]
+        store.close()
+        return [[counters(stats) for stats in row] for row in rows]
+
+    monkeypatch.setattr(cache_sim, "simulate_points", counting_simulate_points)
+    points = [point for section in cache_sim.sweep_sections(cache_type) for point in section.points]
+    first = simulate(trace)
+    assert len(simulated) == len(points)
+    assert simulate(trace) == first and simulated == []
+
+    # another trace, or another simulator version, misses
+    access_types, addresses = trace.as_arrays()
+    other_addresses = addresses.copy()
+    other_addresses[0] += 4096
+    simulate(cache_sim.Trace(access_types, other_addresses))
+    assert len(simulated) == len(points)
+    monkeypatch.setattr(cache_sim, "SIMULATOR_VERSION", cache_sim.SIMULATOR_VERSION + 1)
+    assert simulate(trace) == first and len(simulated) == len(points)
+
+    # another configuration misses too
+    section = cache_sim.sweep_sections(cache_type)[0]
+    (l1_config, l2_config), *_ = section.points
+    store = cache_sim.ResultStore(str(tmp_path / "results.sqlite"))
+    keys = [cache_sim.point_key(trace, section, point) for point in
+            [(l1_config, l2_config), (l1_config, (l2_config[0] * 2, *l2_config[1:]))]]
+    assert list(store.lookup(keys)) == keys[:1]
+    store.close()
+
+
+@pytest.mark.parametrize("cache_class", [cache_sim.WriteThroughCache, cache_sim.WriteBackCache])
+def test_profile_totals_match_cache(cache_class):
+    trace = cache_sim.Trace(*cache_bench.mixed_trace(20000))
+    l2_cache = cache_sim.WriteBackCache(4096, 64, 4, 10, 100, None)
+    l1d_cache = cache_class(1024, 32, 2, 1, 100, l2_cache)
+    l1i_cache = cache_class(1024, 32, 2, 1, 100, l2_cache)
+    caches = [l1d_cache, l1i_cache, l2_cache]
+    profiles = [cache_sim.instrument(cache) for cache in caches]
+    cache_sim.run_trace(l1d_cache, l1i_cache, trace, l2_cache)
+    for cache, profile in zip(caches, profiles):
+        assert (sum(profile.hits), sum(profile.misses)) == (cache.access_hits, cache.access_misses)
+        assert sum(profile.reuse_distances) + profile.cold_accesses == cache.access_total
+        assert sum(profile.block_accesses.values()) == cache.access_total
+
+    # a sampled profile counts the same as the cache does on the sampled sets
+    plain = cache_class(1024, 32, 2, 1, 100, None)
+    sampled = cache_class(1024, 32, 2, 1, 100, None)
+    profile = cache_sim.instrument(sampled, sample_every=8)
+    expected = [0, 0]
+    for access_type, address in trace:
+        if access_type == 2:
+            continue
+        hits = plain.access_hits
+        misses = plain.access_misses
+        for cache in [plain, sampled]:
+            if access_type:
+                cache.write_to_cache(address, write_flag=True, next_level_cache=None)
+            else:
+                cache.read_from_cache(address, next_level_cache=None)
+        if not plain.find_set_and_block(address)[0] % 8:
+            expected[0] += plain.access_hits - hits
+            expected[1] += plain.access_misses - misses
+    assert counters(sampled) == counters(plain)
+    assert [sum(profile.hits), sum(profile.misses)] == expected
+    assert sum(profile.reuse_distances) + profile.cold_accesses == sum(expected)
+
+
+def test_profile_keeps_the_hottest_blocks(monkeypatch):
+    monkeypatch.setattr(cache_sim, "PROFILE_BLOCKS_PER_TOP", 50)
+    cache = cache_sim.WriteBackCache(1024, 32, 2, 1, 100, None)
+    profile = cache_sim.instrument(cache, top_n=2)
+    rng = random.Random(9)
+    for i in range(20000):
+        # blocks 0 and 1 take a third of the accesses each, the rest are spread thin
+        block = i % 3 if i % 3 < 2 else rng.randrange(2, 1 << 20)
+        cache.read_from_cache(block * 32, None)
+        assert len(profile.block_accesses) <= 100
+    assert profile.hottest_blocks() == [(0, 6667), (32, 6667)]
+
+
+def test_command_line_outputs(tmp_path):
+    trace_path = str(tmp_path / "mixed.trace")
+    access_types, addresses = cache_bench.mixed_trace(2000)
+    with open(trace_path, "w") as file:
+        file.writelines(f"{access_type} {address:x}\n" for access_type, address in
+                        zip(access_types.tolist(), addresses.tolist()))
+    trace = cache_sim.Trace(access_types, addresses)
+
+    # -p before the trace takes only its own value
+    csv_path = str(tmp_path / "results.csv")
+    plot_dir = str(tmp_path / "plots")
+    cache_sim.main(argv=["-p", "1,4", trace_path, "-f", "csv", "-o", csv_path, "--plot-dir", plot_dir,
+                         "-j", "1", "--no-result-store"])
+    sections = [section for part in "14" for section in cache_sim.sweep_sections(cache_sim.CACHE_TYPES[part])]
+    with open(csv_path, newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert len(rows) == sum(len(section.points) for section in sections)
+    assert [row["part"] for row in rows[:1] + rows[-1:]] == [cache_sim.CACHE_TYPES["1"], cache_sim.CACHE_TYPES["4"]]
+    assert sorted(os.listdir(plot_dir)) == sorted(cache_sim.plot_file_name("mixed.trace", section)
+                                                  for section in sections if section.x_values is not None)
+
+    json_path = str(tmp_path / "results.json")
+    cache_sim.main(argv=[trace_path, "-p", "3", "-p", "3", "-f", "json", "-o", json_path, "-j", "1",
+                         "--no-result-store"])
+    with open(json_path) as file:
+        records = json.load(file)
+    (section,) = cache_sim.sweep_sections(cache_sim.CACHE_TYPES["3"])
+    rows = cache_sim.simulate_points(section.kind, section.cache_class, section.points, trace)
+    assert len(records) == len(rows)
+    for record, row in zip(records, rows):
+        assert (record["trace"], record["part"]) == ("mixed.trace", cache_sim.CACHE_TYPES["3"])
+        assert [[record[f"{name}_accesses"], record[f"{name}_misses"]] for name in ["L1D", "L1I", "L2"]] == \
+            [[stats.access_total, stats.access_misses] for stats in row]
+        assert record["amat"] == round(cache_sim.row_amat(section, row), 4)
+
+    with pytest.raises(SystemExit):
+        cache_sim.parse_args(["-p", "5", trace_path])
+
+
+def policy_violations(hierarchy):
+    # blocks an inclusive level is missing from the levels above it, and blocks an
+    # exclusive level shares with the level right above it
+    violations = []
+    for depth, caches in enumerate(hierarchy.levels):
+        lower = caches[0]
+        lower_blocks = set(lower.tags) - {-1}
+        if lower.policy == "inclusive":
+            for upper in hierarchy.caches_above(depth):
+                ratio = lower.block_size_bytes // upper.block_size_bytes
+                violations += [(lower.name, upper.name, block) for block in upper.tags
+                               if block != -1 and block // ratio not in lower_blocks]
+        elif lower.policy == "exclusive" and depth:
+            for upper in hierarchy.levels[depth - 1]:
+                violations += [(lower.name, upper.name, block) for block in upper.tags if block in lower_blocks]
+    return violations
+
+
+@pytest.mark.parametrize("l2_policy", ["non-inclusive", "inclusive"])
+def test_exclusive_l3_below_writeback_fills(l2_policy):
+    levels = [{"name": "L1", "total_size_bytes": 1024, "block_size_bytes": 32, "set_associativity": 2,
+               "hit_time": 1, "split": True},
+              {"name": "L2", "total_size_bytes": 4096, "block_size_bytes": 64, "set_associativity": 4,
+               "hit_time": 10, "policy": l2_policy},
+              {"name": "L3", "total_size_bytes": 16384, "block_size_bytes": 64, "set_associativity": 8,
+               "hit_time": 30, "policy": "exclusive"}]
+    hierarchy = cache_sim.CacheHierarchy(levels)
+    access_types, addresses = cache_bench.mixed_trace(20000)
+    for start in range(0, len(access_types), 50):
+        hierarchy.run_batch(access_types[start:start + 50], addresses[start:start + 50])
+        assert policy_violations(hierarchy) == []
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_inclusion_and_exclusion_hold(seed):
+    rng = random.Random(seed)
+    for _ in range(20):
+        block_size = rng.choice([16, 32])
+        levels = [{"name": "L1", "total_size_bytes": block_size * rng.choice([2, 4, 8]), "block_size_bytes": block_size,
+                   "set_associativity": rng.choice([1, 2]), "hit_time": 1, "split": rng.random() < 0.5}]
+        for depth in range(rng.choice([1, 2, 3])):
+            policy = rng.choice(cache_sim.HIERARCHY_POLICIES)
+            if policy != "exclusive":
+                block_size *= rng.choice([1, 2])
+            associativity = rng.choice([1, 2, 4])
+            levels.append({"name": f"L{depth + 2}", "total_size_bytes": block_size * associativity * rng.choice([1, 2, 4]),
+                           "block_size_bytes": block_size, "set_associativity": associativity,
+                           "hit_time": 10 * (depth + 1), "policy": policy})
+        access_types = np.array([rng.choice([0, 0, 1, 2]) for _ in range(600)], dtype=np.uint8)
+        addresses = np.array([rng.randrange(2048) for _ in range(600)], dtype=np.uint64)
+        hierarchy = cache_sim.CacheHierarchy(levels)
+        batch_size = rng.choice([5, 50, 600])
+        for start in range(0, len(access_types), batch_size):
+            hierarchy.run_batch(access_types[start:start + batch_size], addresses[start:start + batch_size])
+            assert policy_violations(hierarchy) == [], levels
+
+
+def test_variant_traffic_matches_full_hierarchy():
+    upper = [{"name": "L1", "total_size_bytes": 1024, "block_size_bytes": 32, "set_associativity": 2,
+              "hit_time": 1, "split": True}]
+    variants = [[{"name": "L2", "total_size_bytes": 4096, "block_size_bytes": block_size, "set_associativity": 4,
+                  "hit_time": 10, "policy": policy}]
+                for policy, block_size in [("non-inclusive", 64), ("exclusive", 32)]]
+    trace = cache_sim.Trace(*cache_bench.mixed_trace(20000))
+
+    def traffic(caches, extra=False):
+        return [(cache.name, cache.bytes_from_next_level,
+                 cache.bytes_to_next_level + (cache.clean_victim_bytes if extra else 0)) for cache in caches]
+
+    for mixed in [variants, variants[:1], variants[1:]]:
+        upper_hierarchy, lowers = cache_sim.simulate_hierarchy_variants(upper, mixed, trace)
+        for variant, lower in zip(mixed, lowers):
+            full = cache_sim.CacheHierarchy(upper + variant).run(trace)
+            exclusive = variant[0]["policy"] == "exclusive"
+            assert traffic(upper_hierarchy.caches(), exclusive) + traffic(lower.caches()) == traffic(full.caches())
+
+    # an inclusive level anywhere below would have to back-invalidate the recorded levels
+    inclusive_l3 = [{"name": "L3", "total_size_bytes": 16384, "block_size_bytes": 64, "set_associativity": 8,
+                     "hit_time": 30, "policy": "inclusive"}]
+    for variant in [variants[0] + inclusive_l3, variants[1] + inclusive_l3]:
+        with pytest.raises(ValueError):
+            cache_sim.simulate_hierarchy_variants(upper, [variant], trace)